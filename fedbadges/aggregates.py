@@ -0,0 +1,304 @@
+""" Daily activity aggregates, to count messages without querying datanommer.
+
+Most ``previous`` filters count the messages of a user, optionally restricted to some
+categories or topics. The aggregates table keeps the number of messages of each user on each
+topic and day, so those counts become a sum over a few rows instead of a query on datanommer's
+messages table.
+
+The consumers feed the table from the messages they receive, starting at the time the first one
+was started (``fed_since``). The ``fedbadges-backfill-aggregates`` command adds the older
+messages from datanommer, and the table is only used for counting once it has completed.
+"""
+
+import datetime
+import logging
+import threading
+import time
+
+import datanommer.models
+from sqlalchemy import (
+    Column,
+    Date,
+    func,
+    Index,
+    insert,
+    Integer,
+    MetaData,
+    select,
+    Table,
+    Unicode,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+
+
+log = logging.getLogger(__name__)
+
+# The filters that can be answered from the aggregates, the users filter is required.
+ANSWERABLE_FILTERS = frozenset(["users", "categories", "topics"])
+DEFAULT_STATE_CHECK_INTERVAL = 60  # seconds
+
+_UPSERTS = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
+
+metadata = MetaData()
+
+activity = Table(
+    "user_activity",
+    metadata,
+    Column("username", Unicode, primary_key=True),
+    Column("topic", Unicode, primary_key=True),
+    Column("day", Date, primary_key=True),
+    Column("category", Unicode, nullable=False),
+    Column("count", Integer, nullable=False),
+    Index("ix_user_activity_category", "username", "category"),
+)
+
+state = Table(
+    "user_activity_state",
+    metadata,
+    Column("name", Unicode, primary_key=True),
+    Column("value", Unicode, nullable=False),
+)
+
+
+def get_category(topic: str):
+    """Return the category of a topic, the way datanommer computes it."""
+    index = 2 if "VirtualTopic" in topic else 3
+    try:
+        return topic.split(".")[index]
+    except IndexError:
+        return "Unclassified"
+
+
+def get_sent_at(message):
+    sent_at = message._properties.headers.get("sent-at")
+    if sent_at:
+        try:
+            return datetime.datetime.fromisoformat(sent_at.replace("Z", "+00:00"))
+        except ValueError:
+            pass
+    return datetime.datetime.now(tz=datetime.timezone.utc)
+
+
+class ActivityAggregates:
+    """Maintain and query the activity aggregates table.
+
+    It does nothing until it is configured with a :class:`~fedbadges.db.SessionProvider`.
+    """
+
+    def __init__(self, state_check_interval=DEFAULT_STATE_CHECK_INTERVAL):
+        self.state_check_interval = state_check_interval
+        self._sessions = None
+        self.fed_since = None
+        self._complete = False
+        self._state_checked = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_configured(self):
+        return self._sessions is not None
+
+    def configure(self, sessions, feed=True):
+        """Create the tables if needed and start feeding them."""
+        self._sessions = sessions
+        metadata.create_all(sessions.engine)
+        if not feed:
+            return
+        session = sessions.session
+        try:
+            # Messages are timestamped to the second
+            now = datetime.datetime.now(tz=datetime.timezone.utc).replace(microsecond=0)
+            # The first consumer to start decides where the backfill stops.
+            self._upsert(session, state, [{"name": "fed_since", "value": now.isoformat()}])
+            session.commit()
+            self._read_state()
+        finally:
+            sessions.release()
+
+    def _get_state(self, session):
+        return dict(session.execute(select(state.c.name, state.c.value)).all())
+
+    def _read_state(self):
+        try:
+            values = self._get_state(self._sessions.session)
+        finally:
+            self._sessions.release()
+        self.fed_since = datetime.datetime.fromisoformat(values["fed_since"])
+        self._complete = "complete" in values
+        self._state_checked = time.monotonic()
+
+    @property
+    def is_complete(self):
+        """Whether the table has all the messages, and can be used for counting."""
+        if not self.is_configured:
+            return False
+        with self._lock:
+            if not self._complete and (
+                time.monotonic() - self._state_checked > self.state_check_interval
+            ):
+                # Check if the backfill has finished
+                self._read_state()
+        return self._complete
+
+    def record(self, message):
+        """Count this message in the activity of its users."""
+        if not self.is_configured:
+            return
+        sent_at = get_sent_at(message)
+        if sent_at < self.fed_since:
+            # The backfill takes care of it
+            return
+        try:
+            usernames = set(message.usernames)
+        except Exception:
+            log.exception("Could not get the users of %s on %s", message.id, message.topic)
+            return
+        if not usernames:
+            return
+        day = sent_at.astimezone(datetime.timezone.utc).date()
+        category = get_category(message.topic)
+        self.add(
+            [
+                dict(username=username, topic=message.topic, day=day, category=category, count=1)
+                for username in usernames
+            ]
+        )
+
+    def add(self, rows, session=None):
+        """Add message counts to the table.
+
+        Each row has the ``username``, ``topic``, ``day``, ``category`` and ``count`` keys.
+        """
+        own_session = session is None
+        if own_session:
+            session = self._sessions.session
+        try:
+            self._upsert(session, activity, rows, increment="count")
+            if own_session:
+                session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            if own_session:
+                self._sessions.release()
+
+    def _upsert(self, session, table, rows, increment=None):
+        if not rows:
+            return
+        dialect_insert = _UPSERTS.get(session.get_bind().dialect.name)
+        if dialect_insert is None:
+            raise NotImplementedError(
+                f"Unsupported database for the aggregates: {session.get_bind().dialect.name}"
+            )
+        statement = dialect_insert(table)
+        primary_key = [column.name for column in table.primary_key]
+        if increment is None:
+            statement = statement.on_conflict_do_nothing(index_elements=primary_key)
+        else:
+            statement = statement.on_conflict_do_update(
+                index_elements=primary_key,
+                set_={increment: table.c[increment] + statement.excluded[increment]},
+            )
+        session.execute(statement, rows)
+
+    def can_answer(self, search_kwargs: dict):
+        """Whether the count of messages matching these grep arguments is in the table.
+
+        Messages with several of the users would be counted once per user, so only a single
+        user is supported.
+        """
+        if not set(search_kwargs).issubset(ANSWERABLE_FILTERS):
+            return False
+        if not all(isinstance(value, list) for value in search_kwargs.values()):
+            return False
+        if len(search_kwargs.get("users", [])) != 1:
+            return False
+        return self.is_complete
+
+    def count(self, users, categories=None, topics=None):
+        query = select(func.coalesce(func.sum(activity.c.count), 0)).where(
+            activity.c.username.in_(users)
+        )
+        if categories:
+            query = query.where(activity.c.category.in_(categories))
+        if topics:
+            query = query.where(activity.c.topic.in_(topics))
+        try:
+            return self._sessions.session.scalar(query)
+        finally:
+            self._sessions.release()
+
+    def backfill(self, start: datetime.datetime, end: datetime.datetime):
+        """Add the messages that datanommer has between these dates, and record the progress.
+
+        The dates must be naive, in UTC, like datanommer's timestamps.
+        """
+        Message = datanommer.models.Message
+        users_messages = datanommer.models.users_assoc_table
+        User = datanommer.models.User
+        day = func.date(Message.timestamp)
+        query = (
+            select(User.name, Message.topic, day, func.min(Message.category), func.count())
+            .join(
+                users_messages,
+                (users_messages.c.msg_id == Message.id)
+                & (users_messages.c.msg_timestamp == Message.timestamp),
+            )
+            .join(User, User.id == users_messages.c.user_id)
+            .where(Message.timestamp >= start, Message.timestamp < end)
+            .group_by(User.name, Message.topic, day)
+        )
+        rows = [
+            dict(
+                username=username,
+                topic=topic,
+                day=day if isinstance(day, datetime.date) else datetime.date.fromisoformat(day),
+                category=category,
+                count=count,
+            )
+            for username, topic, day, category, count in datanommer.models.session.execute(query)
+        ]
+        datanommer.models.session.remove()
+        # The counts and the progress are written in the same transaction, so that the backfill
+        # can be resumed.
+        session = self._sessions.session
+        try:
+            self.add(rows, session=session)
+            session.execute(state.delete().where(state.c.name == "backfilled_until"))
+            session.execute(insert(state).values(name="backfilled_until", value=end.isoformat()))
+            session.commit()
+        finally:
+            self._sessions.release()
+        return len(rows)
+
+    def get_backfill_state(self):
+        """Return where the backfill is and where it must stop, as naive UTC datetimes.
+
+        Returns ``None`` instead if no consumer has started feeding the table yet.
+        """
+        try:
+            values = self._get_state(self._sessions.session)
+        finally:
+            self._sessions.release()
+        if "fed_since" not in values:
+            return None
+        fed_since = datetime.datetime.fromisoformat(values["fed_since"])
+        fed_since = fed_since.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        backfilled_until = values.get("backfilled_until")
+        if backfilled_until is not None:
+            backfilled_until = datetime.datetime.fromisoformat(backfilled_until)
+        return backfilled_until, fed_since
+
+    def mark_complete(self):
+        session = self._sessions.session
+        try:
+            self._upsert(session, state, [{"name": "complete", "value": "true"}])
+            session.commit()
+        finally:
+            self._sessions.release()
+
+
+aggregates = ActivityAggregates()
@@ -0,0 +1,224 @@
+""" Write badge awards to tahrir.
+
+All the awards produced by a message (or a batch of messages) are written in a single
+transaction: the missing persons are created in bulk, then the assertions are inserted,
+ignoring the ones that already exist.
+"""
+
+import datetime
+import logging
+import threading
+import typing
+import uuid
+from collections import OrderedDict
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from tahrir_api.dbapi import TahrirDatabase
+from tahrir_api.model import Assertion, Badge, get_assertion_recipient, Person
+from tahrir_messages import BadgeAwardV1
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_KNOWN_PERSONS_SIZE = 10000
+
+# Dialects that support INSERT ... ON CONFLICT DO NOTHING
+_CONFLICT_SAFE_INSERTS = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
+
+
+class Award(typing.NamedTuple):
+    username: str
+    badge_id: str
+    link: str | None = None
+
+    @property
+    def email(self):
+        return f"{self.username}@fedoraproject.org"
+
+
+class AwardWriter:
+    """Write awards to tahrir in a single transaction.
+
+    Persons that are known to exist are kept in a small LRU cache to avoid looking them up
+    again. This object can be shared between threads.
+    """
+
+    def __init__(self, known_persons_size: int = DEFAULT_KNOWN_PERSONS_SIZE):
+        # Emails are compared in lower case, like tahrir does
+        self._known_persons = OrderedDict()  # lowercased email -> (person id, nickname)
+        self._known_persons_size = known_persons_size
+        self._lock = threading.Lock()
+
+    def write(self, tahrir: TahrirDatabase, awards: list[Award]):
+        """Add the assertions for these awards and commit.
+
+        Returns:
+            The list of awards that were actually added, excluding those that already existed.
+        """
+        # Deduplicate, keeping the order
+        awards = list(dict.fromkeys(awards))
+        if not awards:
+            return []
+        session = tahrir.session
+        try:
+            persons = self._get_persons(session, {award.email for award in awards})
+            badges = {
+                badge.id: badge
+                for badge in session.scalars(
+                    select(Badge).where(Badge.id.in_({award.badge_id for award in awards}))
+                )
+            }
+            added = self._add_assertions(session, awards, persons, badges)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        self._remember_persons(persons)
+
+        if tahrir.notification_callback:
+            for award in added:
+                badge = badges[award.badge_id]
+                person_id, nickname = persons[award.email.lower()]
+                body = dict(
+                    badge=dict(
+                        name=badge.name,
+                        description=badge.description,
+                        image_url=badge.image,
+                        badge_id=badge.id,
+                    ),
+                    user=dict(username=nickname, badges_user_id=person_id),
+                )
+                tahrir.notification_callback(BadgeAwardV1(body=body))
+        return added
+
+    def dump_known_persons(self):
+        """Return the known persons, for snapshots."""
+        with self._lock:
+            return list(self._known_persons.items())
+
+    def load_known_persons(self, known_persons):
+        self._remember_persons({email.lower(): person for email, person in known_persons})
+
+    def _get_persons(self, session, emails):
+        """Return the persons with these emails, creating the missing ones.
+
+        Returns:
+            A dict of (person id, nickname) by lowercased email.
+        """
+        emails = {email.lower(): email for email in emails}
+        persons = {}
+        with self._lock:
+            for key in emails:
+                if key in self._known_persons:
+                    self._known_persons.move_to_end(key)
+                    persons[key] = self._known_persons[key]
+        missing = emails.keys() - persons.keys()
+        if not missing:
+            return persons
+        persons.update(self._query_persons(session, missing))
+        # The persons that don't exist, in any case
+        missing -= persons.keys()
+        if not missing:
+            return persons
+        _insert_ignoring_conflicts(
+            session,
+            Person,
+            [
+                dict(email=emails[key], nickname=emails[key].split("@")[0])
+                for key in sorted(missing)
+            ],
+        )
+        persons.update(self._query_persons(session, missing))
+        return persons
+
+    def _query_persons(self, session, emails):
+        query = select(Person.id, Person.email, Person.nickname).where(
+            func.lower(Person.email).in_(emails)
+        )
+        return {
+            email.lower(): (person_id, nickname)
+            for person_id, email, nickname in session.execute(query)
+        }
+
+    def _remember_persons(self, persons):
+        with self._lock:
+            self._known_persons.update(persons)
+            while len(self._known_persons) > self._known_persons_size:
+                self._known_persons.popitem(last=False)
+
+    def _add_assertions(self, session, awards, persons, badges):
+        issued_on = datetime.datetime.now(tz=datetime.timezone.utc)
+        rows = {}
+        for award in awards:
+            badge = badges.get(award.badge_id)
+            if badge is None:
+                log.warning("Can't award %s to %s: no such badge", award.badge_id, award.username)
+                continue
+            if badge.legacy:
+                log.warning(
+                    "Can't award %s to %s: it is a legacy badge", award.badge_id, award.username
+                )
+                continue
+            if award.email.lower() not in persons:
+                # The person could not be created, probably a nickname conflict
+                log.warning("Can't award %s to %s: no such person", award.badge_id, award.username)
+                continue
+            person_id = persons[award.email.lower()][0]
+            salt = str(uuid.uuid4())
+            rows[(award.badge_id, person_id)] = (
+                award,
+                dict(
+                    id=f"{award.badge_id} -> {person_id}",
+                    badge_id=award.badge_id,
+                    person_id=person_id,
+                    salt=salt,
+                    issued_on=issued_on,
+                    issued_for=award.link,
+                    recipient=get_assertion_recipient(award.email, salt),
+                ),
+            )
+        if not rows:
+            return []
+        inserted = _insert_ignoring_conflicts(
+            session,
+            Assertion,
+            [row for _award, row in rows.values()],
+            returning=(Assertion.badge_id, Assertion.person_id),
+        )
+        return [rows[key][0] for key in inserted]
+
+
+def _insert_ignoring_conflicts(session, model, rows, returning=None):
+    """Insert the rows, skipping those that conflict with existing rows.
+
+    Returns:
+        The values of the ``returning`` columns for the rows that were inserted.
+    """
+    if not rows:
+        return []
+    dialect_insert = _CONFLICT_SAFE_INSERTS.get(session.get_bind().dialect.name)
+    if dialect_insert is None:
+        return _insert_ignoring_conflicts_one_by_one(session, model, rows, returning)
+    statement = dialect_insert(model).on_conflict_do_nothing()
+    if returning is None:
+        session.execute(statement, rows)
+        return []
+    return [tuple(result) for result in session.execute(statement.returning(*returning), rows)]
+
+
+def _insert_ignoring_conflicts_one_by_one(session, model, rows, returning=None):
+    inserted = []
+    for row in rows:
+        try:
+            with session.begin_nested():
+                session.execute(insert(model).values(**row))
+        except IntegrityError:
+            continue
+        if returning is not None:
+            inserted.append(tuple(row[column.key] for column in returning))
+    return inserted
@@ -1,20 +1,550 @@
+import json
 import logging
+import math
+import pickle
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter, defaultdict, deque, OrderedDict
+from contextlib import contextmanager
 
 import pymemcache
-from dogpile.cache import make_region
+from dogpile.cache import make_region, register_backend
+from dogpile.cache.api import BytesBackend, CacheBackend, NO_VALUE
+from dogpile.cache.backends.memcached import GenericMemcachedBackend, PyMemcacheBackend
+from dogpile.cache.backends.memory import MemoryBackend
+from dogpile.cache.backends.redis import RedisBackend
 from dogpile.cache.proxy import ProxyBackend
+from dogpile.cache.region import RegionInvalidationStrategy
+
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 log = logging.getLogger(__name__)
 cache = make_region()
 
 VERY_LONG_EXPIRATION_TIME = 86400 * 365  # a year
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024  # bytes
+DEFAULT_INVALIDATION_CHECK_INTERVAL = 10  # seconds
+DEFAULT_L1_FAMILIES = ()
+INVALIDATION_KEY = "cache_invalidation"
+# The version of the counting definition of each badge the counters were built with
+COUNTER_VERSIONS_KEY = "counter_versions"
+# The version of each badge when versions were first recorded: the counters stored without a
+# version were built with it.
+LEGACY_COUNTER_VERSIONS_KEY = "legacy_counter_versions"
+DEFAULT_PROCESSED_MESSAGES_WINDOW = 3600  # seconds
+# The key families that change after they're computed. A snapshot of them would be stale when
+# it's restored, and they would lose what happened in between: they are not snapshotted.
+UNSNAPSHOTTED_FAMILIES = frozenset(
+    [
+        "messages_count",
+        "processed_message",
+        COUNTER_VERSIONS_KEY,
+        LEGACY_COUNTER_VERSIONS_KEY,
+        INVALIDATION_KEY,
+    ]
+)
+DEFAULT_COMPRESS_THRESHOLD = 16 * 1024  # bytes
+# Memcached's default item size limit is 1MB, leave some room for the key and the flags.
+DEFAULT_MAX_ITEM_SIZE = 1000 * 1000  # bytes
+
+register_backend("fedbadges.bounded_memory", "fedbadges.cached", "BoundedMemoryBackend")
 
 
 def configure(**kwargs):
     if not cache.is_configured:
+        l1_arguments = kwargs.pop("l1", None)
+        codec_arguments = kwargs.pop("codec", {})
+        check_interval = kwargs.pop(
+            "invalidation_check_interval", DEFAULT_INVALIDATION_CHECK_INTERVAL
+        )
         kwargs["wrap"] = [ErrorLoggingProxy]
+        kwargs["region_invalidator"] = SharedInvalidationStrategy(cache, check_interval)
         cache.configure(**kwargs)
+        # The in-process backends keep the values as they are, there's nothing to encode
+        if isinstance(cache.actual_backend, (GenericMemcachedBackend, BytesBackend)):
+            cache.wrap(CodecProxy(**codec_arguments))
+        if l1_arguments is not None:
+            cache.wrap(TwoTierProxy(**l1_arguments))
+
+
+def invalidate_cache(hard=True):
+    """Invalidate all the values in the cache, in all the consumer processes."""
+    cache.invalidate(hard=hard)
+
+
+def key_family(key: str):
+    """Return the family of a cache key: what comes before the first pipe."""
+    return key.split("|", 1)[0]
+
+
+class BoundedMemoryBackend(CacheBackend):
+    """An in-process LRU cache backend with a memory budget.
+
+    The size of the values is approximated by the length of their pickled form. The least
+    recently used values are evicted when the total size goes over ``max_size`` bytes, when
+    there are more than ``max_items`` values, or when a key family (see :func:`key_family`) has
+    more values than its limit in ``family_limits``. Values older than ``ttl`` seconds are
+    dropped.
+
+    It can be shared between threads.
+    """
+
+    def __init__(self, arguments):
+        self.max_size = arguments.get("max_size", DEFAULT_MAX_SIZE)
+        self.max_items = arguments.get("max_items")
+        self.ttl = arguments.get("ttl")
+        self.family_limits = arguments.get("family_limits", {})
+        self._lock = threading.Lock()
+        # key -> (value, size, expiration)
+        self._entries = OrderedDict()
+        # family -> keys, in LRU order
+        self._families = defaultdict(OrderedDict)
+        self.size = 0
+        self.counters = Counter()
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def get_multi(self, keys):
+        with self._lock:
+            return [self._get(key) for key in keys]
+
+    def set(self, key, value):
+        size = self._get_size(value)
+        with self._lock:
+            self._set(key, value, size)
+
+    def set_multi(self, mapping):
+        sizes = {key: self._get_size(value) for key, value in mapping.items()}
+        with self._lock:
+            for key, value in mapping.items():
+                self._set(key, value, sizes[key])
+
+    def delete(self, key):
+        with self._lock:
+            self._delete(key)
+
+    def delete_multi(self, keys):
+        with self._lock:
+            for key in keys:
+                self._delete(key)
+
+    def stats(self):
+        with self._lock:
+            return {"items": len(self._entries), "size": self.size, **self.counters}
+
+    def dump(self):
+        """Return the values that can be snapshotted."""
+        with self._lock:
+            return {
+                key: entry[0]
+                for key, entry in self._entries.items()
+                if key_family(key) not in UNSNAPSHOTTED_FAMILIES
+            }
+
+    def load(self, values):
+        for key, value in values.items():
+            if key_family(key) in UNSNAPSHOTTED_FAMILIES:
+                continue
+            # Don't overwrite what has been computed since the start
+            if self.get(key) is NO_VALUE:
+                self.set(key, value)
+
+    # Called with the lock held
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.counters["misses"] += 1
+            return NO_VALUE
+        if entry[2] is not None and entry[2] < time.monotonic():
+            self._delete(key)
+            self.counters["expirations"] += 1
+            self.counters["misses"] += 1
+            return NO_VALUE
+        self._entries.move_to_end(key)
+        self._families[key_family(key)].move_to_end(key)
+        self.counters["hits"] += 1
+        return entry[0]
+
+    def _set(self, key, value, size):
+        if size > self.max_size:
+            self.counters["too_large"] += 1
+            self._delete(key)
+            return
+        self._delete(key)
+        expiration = time.monotonic() + self.ttl if self.ttl else None
+        self._entries[key] = (value, size, expiration)
+        family = key_family(key)
+        self._families[family][key] = None
+        self.size += size
+        self._evict(family)
+
+    def _delete(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= entry[1]
+        family = key_family(key)
+        family_keys = self._families[family]
+        family_keys.pop(key, None)
+        if not family_keys:
+            del self._families[family]
+
+    def _evict(self, family):
+        family_limit = self.family_limits.get(family)
+        while family_limit is not None and len(self._families[family]) > family_limit:
+            self._delete(next(iter(self._families[family])))
+            self.counters[f"evictions.{family}"] += 1
+        while self.size > self.max_size or (
+            self.max_items is not None and len(self._entries) > self.max_items
+        ):
+            self._delete(next(iter(self._entries)))
+            self.counters["evictions"] += 1
+
+    def _get_size(self, value):
+        try:
+            return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            # Can't be pickled, make a rough guess
+            return 1024
+
+
+class TwoTierProxy(ProxyBackend):
+    """Keep the values of some key families in process, in front of the shared cache.
+
+    The in-process tier is a :class:`BoundedMemoryBackend`, the keyword arguments other than
+    ``families`` are passed to it. Values still carry their creation time, so invalidating the
+    region applies to both tiers.
+    """
+
+    def __init__(self, families=DEFAULT_L1_FAMILIES, **arguments):
+        super().__init__()
+        self.families = frozenset(families)
+        self.l1 = BoundedMemoryBackend(arguments)
+
+    def _in_l1(self, key):
+        return key_family(key) in self.families
+
+    def _get_multi(self, keys, l2_get_multi):
+        keys = list(keys)
+        values = dict(zip(keys, self.l1.get_multi(keys), strict=True))
+        missing = [key for key in keys if values[key] is NO_VALUE]
+        if missing:
+            # A single round trip to the shared cache
+            l2_values = dict(zip(missing, l2_get_multi(missing), strict=True))
+            values.update(l2_values)
+            self.l1.set_multi(
+                {
+                    key: value
+                    for key, value in l2_values.items()
+                    if value is not NO_VALUE and self._in_l1(key)
+                }
+            )
+        return [values[key] for key in keys]
+
+    def _set_multi(self, mapping, l2_set_multi):
+        l2_set_multi(mapping)
+        self.l1.set_multi({key: value for key, value in mapping.items() if self._in_l1(key)})
+
+    def get(self, key):
+        return self._get_multi([key], self.proxied.get_multi)[0]
+
+    def get_multi(self, keys):
+        return self._get_multi(keys, self.proxied.get_multi)
+
+    def get_serialized(self, key):
+        return self._get_multi([key], self.proxied.get_serialized_multi)[0]
+
+    def get_serialized_multi(self, keys):
+        return self._get_multi(keys, self.proxied.get_serialized_multi)
+
+    def set(self, key, value):
+        self._set_multi({key: value}, self.proxied.set_multi)
+
+    def set_multi(self, mapping):
+        self._set_multi(mapping, self.proxied.set_multi)
+
+    def set_serialized(self, key, value):
+        self._set_multi({key: value}, self.proxied.set_serialized_multi)
+
+    def set_serialized_multi(self, mapping):
+        self._set_multi(mapping, self.proxied.set_serialized_multi)
+
+    def delete(self, key):
+        self.l1.delete(key)
+        self.proxied.delete(key)
+
+    def delete_multi(self, keys):
+        keys = list(keys)
+        self.l1.delete_multi(keys)
+        self.proxied.delete_multi(keys)
+
+
+class SharedInvalidationStrategy(RegionInvalidationStrategy):
+    """Share the region invalidation between processes through the cache backend.
+
+    The invalidation time is stored in the backend, and re-read at most every
+    ``check_interval`` seconds.
+    """
+
+    def __init__(self, region, check_interval=DEFAULT_INVALIDATION_CHECK_INTERVAL):
+        self._region = region
+        self._check_interval = check_interval
+        self._lock = threading.Lock()
+        self._invalidated = None
+        self._is_hard_invalidated = None
+        self._last_check = None
+
+    def _read(self):
+        backend = self._region.actual_backend
+        if backend.serializer is None:
+            value = backend.get(INVALIDATION_KEY)
+        else:
+            value = backend.get_serialized(INVALIDATION_KEY)
+            value = NO_VALUE if value is NO_VALUE else json.loads(value)
+        return None if value is NO_VALUE else value
+
+    def _write(self, value):
+        backend = self._region.actual_backend
+        if backend.serializer is None:
+            backend.set(INVALIDATION_KEY, value)
+        else:
+            backend.set_serialized(INVALIDATION_KEY, json.dumps(value).encode("ascii"))
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._last_check is not None and now - self._last_check < self._check_interval:
+            return
+        with self._lock:
+            self._last_check = now
+        try:
+            value = self._read()
+        except Exception:
+            log.exception("Could not read the cache invalidation time")
+            return
+        if value is not None:
+            self._invalidated = value["time"]
+            self._is_hard_invalidated = value["hard"]
+
+    def invalidate(self, hard=True):
+        self._invalidated = time.time()
+        self._is_hard_invalidated = bool(hard)
+        self._write({"time": self._invalidated, "hard": self._is_hard_invalidated})
+
+    def is_invalidated(self, timestamp):
+        self._refresh()
+        return self._invalidated is not None and timestamp < self._invalidated
+
+    def was_hard_invalidated(self):
+        self._refresh()
+        return self._is_hard_invalidated is True
+
+    def is_hard_invalidated(self, timestamp):
+        return self.was_hard_invalidated() and self.is_invalidated(timestamp)
+
+    def was_soft_invalidated(self):
+        self._refresh()
+        return self._is_hard_invalidated is False
+
+    def is_soft_invalidated(self, timestamp):
+        return self.was_soft_invalidated() and self.is_invalidated(timestamp)
+
+
+def get_cache_stats():
+    """Return the statistics of the in-process cache tiers, if any."""
+    if not cache.is_configured:
+        return None
+    backend = cache.backend
+    while backend is not None:
+        if isinstance(backend, TwoTierProxy):
+            return backend.l1.stats()
+        if isinstance(backend, BoundedMemoryBackend):
+            return backend.stats()
+        backend = getattr(backend, "proxied", None)
+    return None
+
+
+def dump_memory_cache():
+    """Return the content of the cache if it is stored in memory, for snapshots."""
+    if not cache.is_configured:
+        return None
+    backend = cache.actual_backend
+    # The values carry their creation time, they will expire as usual once loaded back.
+    if isinstance(backend, BoundedMemoryBackend):
+        return backend.dump()
+    if isinstance(backend, MemoryBackend):
+        return {
+            key: value
+            for key, value in backend._cache.items()
+            if key_family(key) not in UNSNAPSHOTTED_FAMILIES
+        }
+    return None
+
+
+def load_memory_cache(values):
+    if not cache.is_configured:
+        return
+    backend = cache.actual_backend
+    if isinstance(backend, BoundedMemoryBackend):
+        backend.load(values)
+    elif isinstance(backend, MemoryBackend):
+        for key, value in values.items():
+            if key_family(key) in UNSNAPSHOTTED_FAMILIES:
+                continue
+            # Don't overwrite what has been computed since the start
+            backend._cache.setdefault(key, value)
+
+
+class CodecProxy(ProxyBackend):
+    """Compress the large serialized values, and split those that are still too large.
+
+    This applies to backends that store bytes (memcached, Redis). The backends that serialize the
+    values themselves, like ``dogpile.cache.pymemcache``, receive the region's values as they are:
+    the large ones are pickled here to be encoded. Encoded values start with a marker that the
+    region's serialized values can't start with, so values that were stored before are still
+    read.
+    """
+
+    MARKER = b"\x00fb"
+    ZLIB = b"z"
+    ZSTD = b"s"
+    CHUNKED = b"c"
+    RAW = b"r"
+
+    def __init__(
+        self,
+        compress_threshold=DEFAULT_COMPRESS_THRESHOLD,
+        max_item_size=DEFAULT_MAX_ITEM_SIZE,
+        compression="zstd",
+    ):
+        super().__init__()
+        self.compress_threshold = compress_threshold
+        self.max_item_size = max_item_size
+        if compression == "zstd" and zstandard is None:
+            compression = "zlib"
+        if compression not in ("zstd", "zlib", None):
+            raise ValueError(f"Unknown cache compression: {compression}")
+        self.compression = compression
+
+    def get_serialized(self, key):
+        return self.get_serialized_multi([key])[0]
+
+    def get_serialized_multi(self, keys):
+        keys = list(keys)
+        values = self.proxied.get_serialized_multi(keys)
+        return [
+            self._decode(key, value, self.proxied.get_serialized_multi)
+            for key, value in zip(keys, values, strict=True)
+        ]
+
+    def set_serialized(self, key, value):
+        self.set_serialized_multi({key: value})
+
+    def set_serialized_multi(self, mapping):
+        self._set_encoded_multi(mapping, self.proxied.set_serialized_multi)
+
+    def get(self, key):
+        return self.get_multi([key])[0]
+
+    def get_multi(self, keys):
+        keys = list(keys)
+        values = self.proxied.get_multi(keys)
+        return [self._unpickle(key, value) for key, value in zip(keys, values, strict=True)]
+
+    def set(self, key, value):
+        self.set_multi({key: value})
+
+    def set_multi(self, mapping):
+        small = {}
+        large = {}
+        for key, value in mapping.items():
+            pickled = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            if len(pickled) < self.compress_threshold:
+                # The backend serializes it
+                small[key] = value
+            else:
+                large[key] = pickled
+        if small:
+            self.proxied.set_multi(small)
+        if large:
+            self._set_encoded_multi(large, self.proxied.set_multi, force=True)
+
+    def _unpickle(self, key, value):
+        if not isinstance(value, bytes) or not value.startswith(self.MARKER):
+            return value
+        value = self._decode(key, value, self.proxied.get_multi)
+        if value is NO_VALUE:
+            return NO_VALUE
+        try:
+            return pickle.loads(value)  # noqa: S301
+        except Exception as e:
+            log.warning("Could not unpickle the cached value for %s: %r", key, e)
+            return NO_VALUE
+
+    def _set_encoded_multi(self, mapping, set_multi, force=False):
+        encoded = {}
+        for key, value in mapping.items():
+            value = self._compress(value, force=force)
+            if len(value) <= self.max_item_size:
+                encoded[key] = value
+                continue
+            # Split it, the chunks must be stored before the manifest that points to them
+            chunk_id = uuid.uuid4().hex
+            chunks = {
+                f"{key}|chunk|{chunk_id}|{index}": value[start : start + self.max_item_size]
+                for index, start in enumerate(range(0, len(value), self.max_item_size))
+            }
+            set_multi(chunks)
+            encoded[key] = self.MARKER + self.CHUNKED + f"{chunk_id}|{len(chunks)}".encode()
+        set_multi(encoded)
+
+    def _compress(self, value, force=False):
+        if self.compression is None:
+            # Pickled values must carry the marker to be recognized
+            return self.MARKER + self.RAW + value if force else value
+        if len(value) < self.compress_threshold:
+            return value
+        if self.compression == "zstd":
+            return self.MARKER + self.ZSTD + zstandard.ZstdCompressor().compress(value)
+        return self.MARKER + self.ZLIB + zlib.compress(value)
+
+    def _decode(self, key, value, get_multi):
+        if not isinstance(value, bytes) or not value.startswith(self.MARKER):
+            return value
+        codec = value[len(self.MARKER) : len(self.MARKER) + 1]
+        data = value[len(self.MARKER) + 1 :]
+        try:
+            if codec == self.CHUNKED:
+                chunk_id, count = data.decode().split("|")
+                chunks = get_multi(
+                    [f"{key}|chunk|{chunk_id}|{index}" for index in range(int(count))]
+                )
+                if any(chunk is NO_VALUE or chunk is None for chunk in chunks):
+                    # Some chunks were evicted
+                    return NO_VALUE
+                return self._decode(key, b"".join(chunks), get_multi)
+            if codec == self.RAW:
+                return data
+            if codec == self.ZLIB:
+                return zlib.decompress(data)
+            if codec == self.ZSTD:
+                if zstandard is None:
+                    return NO_VALUE
+                return zstandard.ZstdDecompressor().decompress(data)
+        except Exception as e:
+            log.warning("Could not decode the cached value for %s: %r", key, e)
+            return NO_VALUE
+        log.warning("Unknown encoding for the cached value of %s", key)
+        return NO_VALUE
 
 
 class ErrorLoggingProxy(ProxyBackend):
@@ -27,8 +557,268 @@ class ErrorLoggingProxy(ProxyBackend):
                 length = len(value[1])
             log.exception("Could not set the value in the cache (len=%s)", length)
 
+    def set_multi(self, mapping):
+        try:
+            self.proxied.set_multi(mapping)
+        except pymemcache.exceptions.MemcacheServerError:
+            log.exception("Could not set the values in the cache (keys=%s)", list(mapping))
+
+    def set_serialized(self, key, value):
+        try:
+            self.proxied.set_serialized(key, value)
+        except pymemcache.exceptions.MemcacheServerError:
+            log.exception("Could not set the value in the cache (len=%s)", len(value))
+
+    def set_serialized_multi(self, mapping):
+        try:
+            self.proxied.set_serialized_multi(mapping)
+        except pymemcache.exceptions.MemcacheServerError:
+            log.exception(
+                "Could not set the values in the cache (len=%s)",
+                [len(value) for value in mapping.values()],
+            )
+
+
+class MessageMemo:
+    """Remember values computed while processing a message, for the other rules.
+
+    It can be shared between the threads working on the same message. Each value is only
+    computed once, the other threads asking for it wait for the result.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._key_locks = {}
+
+    def get_or_create(self, key, creator, *args):
+        with self._lock:
+            if key in self._values:
+                return self._values[key]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                if key in self._values:
+                    return self._values[key]
+            value = creator(*args)
+            with self._lock:
+                self._values[key] = value
+                del self._key_locks[key]
+            return value
+
+
+# The memos of the messages being processed, by message id
+_message_memos = {}
+
+
+@contextmanager
+def message_memo(message_id: str):
+    """Keep a memo for this message while it is being processed."""
+    _message_memos[message_id] = MessageMemo()
+    try:
+        yield _message_memos[message_id]
+    finally:
+        _message_memos.pop(message_id, None)
+
+
+def get_message_memo(message_id: str):
+    """Return the memo of this message, or ``None`` if it is not being processed."""
+    return _message_memos.get(message_id)
+
+
+# The processed messages marked by this process, oldest first
+_processed_marks = deque()
+_processed_marks_lock = threading.Lock()
+
+
+def _processed_message_key(message_id: str):
+    key = f"processed_message|{message_id}"
+    return cache.key_mangler(key) if cache.key_mangler else key
+
+
+def is_message_processed(message_id: str, window: int = DEFAULT_PROCESSED_MESSAGES_WINDOW):
+    """Return whether a consumer processed this message in the last ``window`` seconds."""
+    backend = cache.actual_backend
+    if isinstance(backend, GenericMemcachedBackend):
+        return backend.client.get(_processed_message_key(message_id)) is not None
+    if isinstance(backend, RedisBackend):
+        return bool(backend.reader_client.exists(_processed_message_key(message_id)))
+    value = cache.get(f"processed_message|{message_id}", expiration_time=window)
+    return value is not NO_VALUE
+
 
-def get_cached_messages_count(badge_id: str, candidate: str, get_previous_fn):
+def claim_message(message_id: str, window: int = DEFAULT_PROCESSED_MESSAGES_WINDOW):
+    """Remember that this message is being processed, unless it already was.
+
+    With memcached and Redis, the mark is added only if it doesn't exist, in a single operation,
+    and the server expires it after ``window`` seconds: two consumers can't both claim the same
+    message. With the other backends, like the in-process ones, it is only atomic within this
+    process and the marks are deleted after the window.
+
+    Returns:
+        Whether the message was claimed, ``False`` if it was processed in the last ``window``
+        seconds.
+    """
+    backend = cache.actual_backend
+    # The servers expire keys with a precision of a second
+    ttl = max(1, math.ceil(window))
+    if isinstance(backend, PyMemcacheBackend):
+        return bool(backend.client.add(_processed_message_key(message_id), 1, ttl, noreply=False))
+    if isinstance(backend, GenericMemcachedBackend):
+        return bool(backend.client.add(_processed_message_key(message_id), 1, ttl))
+    if isinstance(backend, RedisBackend):
+        return bool(
+            backend.writer_client.set(_processed_message_key(message_id), 1, nx=True, ex=ttl)
+        )
+    key = f"processed_message|{message_id}"
+    now = time.monotonic()
+    expired = []
+    with _processed_marks_lock:
+        if is_message_processed(message_id, window):
+            return False
+        cache.set(key, True)
+        # The in-process backends never expire values on their own
+        _processed_marks.append((now, key))
+        while _processed_marks and _processed_marks[0][0] < now - window:
+            expired.append(_processed_marks.popleft()[1])
+    if expired:
+        cache.delete_multi(expired)
+    return True
+
+
+def get_counter_versions():
+    """Return the recorded versions of the badges counters, by badge id."""
+    versions = cache.get(COUNTER_VERSIONS_KEY, expiration_time=VERY_LONG_EXPIRATION_TIME)
+    return {} if versions is NO_VALUE else versions
+
+
+def record_counter_versions(versions: dict):
+    """Record the versions of the badges counters.
+
+    The counters of the previous versions are not deleted, they will just never be read again and
+    expire or get evicted. The first version recorded for a badge reuses the counters stored
+    without a version, until it changes.
+
+    Returns:
+        The badges whose counters were invalidated: ``{badge_id: (old, new)}``.
+    """
+    recorded = get_counter_versions()
+    legacy = cache.get(LEGACY_COUNTER_VERSIONS_KEY, expiration_time=VERY_LONG_EXPIRATION_TIME)
+    legacy = {} if legacy is NO_VALUE else legacy
+    new_legacy = {
+        badge_id: version
+        for badge_id, version in versions.items()
+        if badge_id not in recorded and badge_id not in legacy
+    }
+    if new_legacy:
+        cache.set(LEGACY_COUNTER_VERSIONS_KEY, {**legacy, **new_legacy})
+    changed = {
+        badge_id: (recorded[badge_id], version)
+        for badge_id, version in versions.items()
+        if badge_id in recorded and recorded[badge_id] != version
+    }
+    if any(recorded.get(badge_id) != version for badge_id, version in versions.items()):
+        cache.set(COUNTER_VERSIONS_KEY, {**recorded, **versions})
+    return changed
+
+
+def get_first_seen(kind: str, values, get_missing_fn):
+    """Return when datanommer first saw each of these topics or categories.
+
+    Those never change, so they are kept for good once known. ``get_missing_fn`` receives the
+    values that are not in the cache and returns a dict of their first-seen times, the values
+    that were never seen are left out and looked up again next time.
+
+    Returns:
+        The first-seen times by value, ``None`` for the values that were never seen.
+    """
+    keys = {f"first_seen|{kind}|{value}": value for value in values}
+    if not keys:
+        return {}
+
+    def creator(*missing):
+        found = get_missing_fn([keys[key] for key in missing])
+        return [found.get(keys[key]) for key in missing]
+
+    first_seen = cache.get_or_create_multi(
+        list(keys),
+        creator=creator,
+        expiration_time=VERY_LONG_EXPIRATION_TIME,
+        should_cache_fn=lambda value: value is not None,
+    )
+    return dict(zip(keys.values(), first_seen, strict=True))
+
+
+def _get_legacy_counts(badge_id: str, candidates, version):
+    """Return the counts stored without a version, if they were built with this version."""
+    if version is None:
+        return {}
+    legacy = cache.get(LEGACY_COUNTER_VERSIONS_KEY, expiration_time=VERY_LONG_EXPIRATION_TIME)
+    if legacy is NO_VALUE or legacy.get(badge_id) != version:
+        return {}
+    counts = get_messages_counts(badge_id, candidates)
+    return {candidate: count for candidate, count in counts.items() if count is not None}
+
+
+def _messages_count_key(badge_id, candidate, version):
+    if version is None:
+        return f"messages_count|{badge_id}|{candidate}"
+    return f"messages_count|{badge_id}|{version}|{candidate}"
+
+
+def get_messages_counts(badge_id: str, candidates, version=None):
+    """Return the cached messages counts of several candidates, without computing them.
+
+    Returns:
+        The counts by candidate, ``None`` for the candidates who have no count.
+    """
+    keys = [_messages_count_key(badge_id, candidate, version) for candidate in candidates]
+    values = cache.get_multi(keys, expiration_time=VERY_LONG_EXPIRATION_TIME)
+    return {
+        candidate: None if value is NO_VALUE else value
+        for candidate, value in zip(candidates, values, strict=True)
+    }
+
+
+def set_messages_counts(badge_id: str, counts: dict, version=None):
+    """Replace the cached messages counts of several candidates."""
+    cache.set_multi(
+        {
+            _messages_count_key(badge_id, candidate, version): value
+            for candidate, value in counts.items()
+        }
+    )
+
+
+def replace_messages_counts(badge_id: str, expected: dict, counts: dict, version=None):
+    """Replace the cached messages counts that still have their ``expected`` value.
+
+    The counts that changed meanwhile are left alone: the increments they got would be lost.
+
+    Returns:
+        The candidates whose count was replaced.
+    """
+    current = get_messages_counts(badge_id, list(counts), version)
+    replaced = {
+        candidate: value
+        for candidate, value in counts.items()
+        if current[candidate] is not None and current[candidate] == expected[candidate]
+    }
+    if replaced:
+        set_messages_counts(badge_id, replaced, version)
+    return set(replaced)
+
+
+def get_cached_messages_count(badge_id: str, candidate: str, get_previous_fn, version=None):
+    return get_cached_messages_counts(badge_id, [candidate], get_previous_fn, version)[candidate]
+
+
+def get_cached_messages_counts(badge_id: str, candidates, get_previous_fn, version=None):
+    """Increment and return the messages count of several candidates.
+
+    The counts are read and written in one cache round trip each. The ``version`` of the rule's
+    counting definition is part of the keys, so changing the definition starts new counts.
+    """
     # This could also be stored in the database, but:
     # - rules that have a "previous" query can regenerate the value
     # - rules that don't have a "previous" query currently don't need to count as they award
@@ -36,14 +826,25 @@ def get_cached_messages_count(badge_id: str, candidate: str, get_previous_fn):
     # If at some point in the future we have rules that need counting but can't have a "previous"
     # query, then this data will not be rebuildable anymore and we should store it in a database
     # table linking badges and users.
-    key = f"messages_count|{badge_id}|{candidate}"
-    current_value = cache.get_or_create(
-        key,
-        creator=lambda c: get_previous_fn(c) - 1,
-        creator_args=((candidate,), {}),
-        expiration_time=VERY_LONG_EXPIRATION_TIME,
+    keys = {
+        _messages_count_key(badge_id, candidate, version): candidate for candidate in candidates
+    }
+    if not keys:
+        return {}
+
+    def creator(*missing):
+        # The counts stored before the counters were versioned are carried over, rebuilding them
+        # all at once from datanommer would flood it.
+        legacy = _get_legacy_counts(badge_id, [keys[key] for key in missing], version)
+        return [
+            legacy[keys[key]] if keys[key] in legacy else get_previous_fn(keys[key]) - 1
+            for key in missing
+        ]
+
+    current_values = cache.get_or_create_multi(
+        list(keys), creator=creator, expiration_time=VERY_LONG_EXPIRATION_TIME
     )
-    # Add one (the current message), store it, return it
-    new_value = current_value + 1
-    cache.set(key, new_value)
-    return new_value
+    # Add one (the current message), store them, return them
+    new_values = {key: value + 1 for key, value in zip(keys, current_values, strict=True)}
+    cache.set_multi(new_values)
+    return {keys[key]: value for key, value in new_values.items()}
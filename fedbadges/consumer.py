@@ -6,9 +6,11 @@ Authors:  Ross Delinger
 """
 
 import asyncio
+import atexit
 import datetime
 import logging
 import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
 import datanommer.models
@@ -17,16 +19,49 @@ from fedora_messaging.api import Message
 from fedora_messaging.config import conf as fm_config
 from sqlalchemy.exc import SQLAlchemyError
 
+from .aggregates import aggregates
 from .aio import Periodic
+from .awards import Award, AwardWriter, DEFAULT_KNOWN_PERSONS_SIZE
+from .cached import (
+    claim_message,
+    DEFAULT_PROCESSED_MESSAGES_WINDOW,
+    dump_memory_cache,
+    get_cache_stats,
+    load_memory_cache,
+    message_memo,
+    record_counter_versions,
+)
 from .cached import configure as configure_cache
+from .db import make_engine, query_time_budget, QueryTimeoutError, SessionProvider
+from .deferral import (
+    DEFAULT_DEFERRAL_PERIOD,
+    DEFAULT_DEFERRED_MAX_PENDING,
+    DEFAULT_DEFERRED_RETRIES,
+    DEFAULT_DEFERRED_WORKERS,
+    DeferralLane,
+)
 from .fas import FASProxy
+from .outbox import AwardOutbox, DEFAULT_DRAIN_BATCH_SIZE, DEFAULT_DRAIN_INTERVAL
+from .pipeline import DEFAULT_QUEUE_SIZE, DEFAULT_WORKERS, Pipeline
+from .publisher import DEFAULT_BATCH_SIZE, NotificationPublisher
+from .recent import DEFAULT_RECENT_MESSAGES_MAX_SIZE, recent_messages
+from .reconcile import (
+    CounterReconciler,
+    DEFAULT_RECONCILE_BATCH_SIZE,
+    DEFAULT_RECONCILE_MAX_PENDING,
+    DEFAULT_RECONCILE_QUERIES_PER_SECOND,
+    pending_counters,
+)
+from .rules import DEFAULT_MAX_REMOVED_RULES_RATIO, RuleSet
 from .rulesrepo import RulesRepo
-from .utils import datanommer_has_message, notification_callback
+from .snapshot import DEFAULT_SNAPSHOT_INTERVAL, DEFAULT_SNAPSHOT_MAX_AGE, Snapshot
+from .utils import datanommer_has_message
 
 
 log = logging.getLogger(__name__)
 
 DEFAULT_RULES_RELOAD_INTERVAL = 15  # in minutes
+DEFAULT_POOL_STATS_INTERVAL = 15  # in minutes
 MAX_WAIT_DATANOMMER = 5  # seconds
 
 
@@ -34,7 +69,39 @@ class FedoraBadgesConsumer:
 
     def __init__(self):
         self.config = fm_config["consumer_config"]
-        self.badge_rules = []
+        self.badge_rules = RuleSet()
+        # Rules are loaded and compiled in their own thread, with their own DB session.
+        self._rules_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="fedbadges-rules"
+        )
+        self._award_writer = AwardWriter(
+            self.config.get("known_persons_cache_size", DEFAULT_KNOWN_PERSONS_SIZE)
+        )
+        self._publisher = NotificationPublisher(
+            spool_path=self.config.get("notifications_spool"),
+            batch_size=self.config.get("notifications_batch_size", DEFAULT_BATCH_SIZE),
+        )
+        outbox_path = self.config.get("award_outbox")
+        self._outbox = AwardOutbox(outbox_path) if outbox_path else None
+        self._snapshot = self._make_snapshot()
+        self._processed_messages_window = self.config.get(
+            "processed_messages_window", DEFAULT_PROCESSED_MESSAGES_WINDOW
+        )
+        recent_messages_days = self.config.get("recent_messages_days")
+        if recent_messages_days:
+            recent_messages.configure(
+                recent_messages_days,
+                self.config.get("recent_messages_max_size", DEFAULT_RECENT_MESSAGES_MAX_SIZE),
+            )
+        # The rules whose queries go over their time budget are processed in their own lane
+        self.deferral_lane = DeferralLane(
+            self,
+            workers=self.config.get("deferred_workers", DEFAULT_DEFERRED_WORKERS),
+            retries=self.config.get("deferred_retries", DEFAULT_DEFERRED_RETRIES),
+            max_pending=self.config.get("deferred_max_pending", DEFAULT_DEFERRED_MAX_PENDING),
+            query_timeout=self.config.get("deferred_query_timeout"),
+            period=self.config.get("deferral_period", DEFAULT_DEFERRAL_PERIOD),
+        )
         self.loop = asyncio.get_event_loop()
         self._ready = self.loop.create_task(self.setup())
         if not self.loop.is_running():
@@ -46,21 +113,44 @@ class FedoraBadgesConsumer:
         # 1) Initialize our connection to the Tahrir DB
         # 2) Initialize our connection to the datanommer DB.
         # 3) Load our badge definitions and rules from YAML.
-        # Cache
-        await self.loop.run_in_executor(None, self._initialize_cache)
-
-        # Tahrir stuff.
-        await self.loop.run_in_executor(None, self._initialize_tahrir_connection)
-
-        # Datanommer stuff
-        await self.loop.run_in_executor(None, self._initialize_datanommer_connection)
-
-        # FASJSON stuff
-        self.fasjson = await self.loop.run_in_executor(
-            None, FASProxy, self.config["fasjson_base_url"]
+        self.startup_timings = {}
+        start = time.perf_counter()
+
+        # Notifications are published in the background
+        self._publisher.start()
+        atexit.register(self._publisher.stop)
+
+        # The cache, Tahrir, datanommer, the aggregates and FASJSON don't depend on each other.
+        stages = [
+            self._run_startup_stage("cache", self._initialize_cache),
+            self._run_startup_stage("tahrir", self._initialize_tahrir_connection),
+            self._run_startup_stage("datanommer", self._initialize_datanommer_connection),
+        ]
+        if self.config.get("aggregates_db_uri"):
+            stages.append(self._run_startup_stage("aggregates", self._initialize_aggregates))
+        *_stages, self.fasjson = await asyncio.gather(
+            *stages,
+            self._run_startup_stage(
+                "fasjson",
+                FASProxy,
+                self.config["fasjson_base_url"],
+                self.config.get("fasjson_spec_cache"),
+                self.config.get("user_creation_times"),
+            ),
         )
 
+        # Warm up the in-process caches
+        if self._snapshot is not None:
+            await self._run_startup_stage("snapshot", self._snapshot.restore)
+            atexit.register(self._snapshot.save)
+            self._snapshot_task = Periodic(
+                partial(self.loop.run_in_executor, None, self._snapshot.save),
+                self.config.get("snapshot_interval", DEFAULT_SNAPSHOT_INTERVAL) * 60,
+            )
+            await self._snapshot_task.start()
+
         # Load badge definitions
+        stage_start = time.perf_counter()
         self._rules_repo = RulesRepo(self.config, self.issuer_id, self.fasjson)
         self._rules_repo.setup()
 
@@ -68,9 +158,59 @@ class FedoraBadgesConsumer:
             "rules_reload_interval", DEFAULT_RULES_RELOAD_INTERVAL
         )
         self._refresh_badges_task = Periodic(
-            partial(self.loop.run_in_executor, None, self._reload_rules), rules_reload_inteval * 60
+            partial(self.loop.run_in_executor, self._rules_executor, self._reload_rules),
+            rules_reload_inteval * 60,
         )
         await self._refresh_badges_task.start(run_now=True)
+        self.startup_timings["rules"] = time.perf_counter() - stage_start
+
+        pool_stats_interval = self.config.get("pool_stats_interval", DEFAULT_POOL_STATS_INTERVAL)
+        self._pool_stats_task = Periodic(self._log_pool_stats, pool_stats_interval * 60)
+        await self._pool_stats_task.start()
+
+        if self._outbox is not None:
+            self._outbox_task = Periodic(
+                partial(self.loop.run_in_executor, None, self._drain_outbox),
+                self.config.get("award_outbox_interval", DEFAULT_DRAIN_INTERVAL),
+            )
+            await self._outbox_task.start(run_now=True)
+
+        reconcile_interval = self.config.get("reconcile_interval")
+        if reconcile_interval:
+            await self._start_reconciler(reconcile_interval)
+
+        self.startup_timings["total"] = time.perf_counter() - start
+        log.info(
+            "Started in %.2f seconds (%s)",
+            self.startup_timings["total"],
+            ", ".join(
+                f"{stage}: {duration:.2f}s"
+                for stage, duration in self.startup_timings.items()
+                if stage != "total"
+            ),
+        )
+
+    def _make_snapshot(self):
+        path = self.config.get("snapshot")
+        if not path:
+            return None
+        snapshot = Snapshot(
+            path, max_age=self.config.get("snapshot_max_age", DEFAULT_SNAPSHOT_MAX_AGE)
+        )
+        snapshot.register("cache", dump_memory_cache, load_memory_cache)
+        snapshot.register(
+            "known_persons",
+            self._award_writer.dump_known_persons,
+            self._award_writer.load_known_persons,
+        )
+        return snapshot
+
+    async def _run_startup_stage(self, name, func, *args):
+        start = time.perf_counter()
+        try:
+            return await self.loop.run_in_executor(None, func, *args)
+        finally:
+            self.startup_timings[name] = time.perf_counter() - start
 
     def _initialize_cache(self):
         cache_args = self.config.get("cache")
@@ -81,11 +221,11 @@ class FedoraBadgesConsumer:
         if not database_uri:
             raise ValueError("Badges consumer requires a database uri")
         issuer = self.config["badge_issuer"]
-        self.tahrir = tahrir_api.dbapi.TahrirDatabase(
-            dburi=database_uri,
-            autocommit=False,
-            notification_callback=notification_callback,
+        self._tahrir_sessions = SessionProvider.from_config(
+            database_uri, self.config.get("database_pool")
         )
+        # The session is thread-scoped, this client can be shared between threads.
+        self.tahrir = self._get_tahrir_client(self._tahrir_sessions.session)
         self.issuer_id = self.tahrir.add_issuer(
             issuer.get("issuer_origin"),
             issuer.get("issuer_name"),
@@ -95,28 +235,117 @@ class FedoraBadgesConsumer:
         self.tahrir.session.commit()
 
     def _get_tahrir_client(self, session=None):
-        return self.tahrir
+        if session is None:
+            return self.tahrir
+        return tahrir_api.dbapi.TahrirDatabase(
+            session=session,
+            autocommit=False,
+            notification_callback=self._publisher,
+        )
 
     def _initialize_datanommer_connection(self):
-        datanommer.models.init(self.config["datanommer_db_uri"])
+        # We only read from datanommer
+        engine = make_engine(
+            self.config["datanommer_db_uri"],
+            read_only=True,
+            **self.config.get("datanommer_pool", {}),
+        )
+        datanommer.models.init(engine=engine)
+        self._datanommer_sessions = SessionProvider(engine, session=datanommer.models.session)
+
+    def _initialize_aggregates(self):
+        aggregates.configure(
+            SessionProvider.from_config(
+                self.config["aggregates_db_uri"], self.config.get("aggregates_pool")
+            )
+        )
+
+    async def _start_reconciler(self, interval):
+        pending_counters.max_size = self.config.get(
+            "reconcile_max_pending", DEFAULT_RECONCILE_MAX_PENDING
+        )
+        reconciler = CounterReconciler(
+            self,
+            batch_size=self.config.get("reconcile_batch_size", DEFAULT_RECONCILE_BATCH_SIZE),
+            queries_per_second=self.config.get(
+                "reconcile_queries_per_second", DEFAULT_RECONCILE_QUERIES_PER_SECOND
+            ),
+        )
+        # A single thread of its own, so it never takes more than one DB connection.
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fedbadges-reconcile")
+        self._reconcile_task = Periodic(
+            partial(self.loop.run_in_executor, executor, reconciler.run), interval * 60
+        )
+        await self._reconcile_task.start()
+
+    def _log_pool_stats(self):
+        for name, provider in (
+            ("tahrir", self._tahrir_sessions),
+            ("datanommer", self._datanommer_sessions),
+        ):
+            log.info("Connection pool stats for %s: %r", name, provider.stats())
+        cache_stats = get_cache_stats()
+        if cache_stats is not None:
+            log.info("Cache stats: %r", cache_stats)
+        if recent_messages.is_configured:
+            log.info("Recent messages index stats: %r", recent_messages.stats())
+        log.info("Deferral lane stats: %r", self.deferral_lane.stats())
 
     def award_badge(self, username, badge_rule, link=None):
-        email = f"{username}@fedoraproject.org"
-        client = self._get_tahrir_client(self.tahrir.session)
-        client.add_person(email)
-        self.tahrir.session.commit()
-        client.add_assertion(badge_rule.badge_id, email, None, link)
-        self.tahrir.session.commit()
+        self.award_badges([Award(username, badge_rule.badge_id, link)])
+
+    def award_badges(self, awards: list[Award]):
+        if self._outbox is not None:
+            # They will be written to tahrir in the background
+            self._outbox.append(awards)
+            return
+        # All the awards are written in a single transaction
+        self._award_writer.write(self._get_tahrir_client(), awards)
+
+    def _drain_outbox(self):
+        self._outbox.drain(
+            self._award_writer,
+            self._get_tahrir_client(),
+            batch_size=self.config.get("award_outbox_batch_size", DEFAULT_DRAIN_BATCH_SIZE),
+        )
 
     def __call__(self, message: Message):
+        if not self._claim(message):
+            return
+        self._record_activity(message)
         try:
-            self._process_message(message)
+            # The rules analyzing this message share the datanommer counts
+            with message_memo(message.id):
+                self._process_message(message)
         except SQLAlchemyError:
             log.exception("Could not process message %s on %s", message.id, message.topic)
             # If we don't rollback, following queryies will fail: https://sqlalche.me/e/20/8s2b
             self.tahrir.session.rollback()
-        # Always rollback the datanommer transaction after processing, it's read-only.
-        datanommer.models.session.rollback()
+        # Give the datanommer connection back to the pool, it's read-only so there is nothing to
+        # commit or rollback.
+        self._datanommer_sessions.release()
+
+    def _claim(self, message: Message):
+        """Return whether the message must be processed, and remember it if so.
+
+        Redelivered messages would increment the counters a second time. The message is
+        remembered before any counter is incremented, so that a crash or a failed ack while it's
+        processed doesn't count it twice either.
+        """
+        if not self._processed_messages_window:
+            return True
+        if not claim_message(message.id, self._processed_messages_window):
+            log.info("Skipping %s on %s: it was already processed", message.id, message.topic)
+            return False
+        return True
+
+    def _record_activity(self, message: Message):
+        # Before processing, so that the counts include this message like datanommer's do
+        recent_messages.add(message)
+        try:
+            aggregates.record(message)
+        except SQLAlchemyError:
+            log.exception("Could not record the activity of %s on %s", message.id, message.topic)
 
     def _process_message(self, message: Message):
         # First thing, we receive the message, but we put ourselves to sleep to
@@ -133,16 +362,22 @@ class FedoraBadgesConsumer:
 
         log.debug("Updating cached values for %s on %s", message.id, message.topic)
 
-        datagrepper_url = self.config["datagrepper_url"]
-        link = f"{datagrepper_url}/v2/id?id={message.id}&is_raw=true&size=extra-large"
+        link = self._get_link(message)
 
         # Award every badge as appropriate.
         log.debug("Processing rules for %s on %s", message.id, message.topic)
 
         tahrir = self._get_tahrir_client()
-        for badge_rule in self.badge_rules:
+        awards = []
+        for badge_rule in self.badge_rules.for_message(message):
+            if self.deferral_lane.is_deferred(badge_rule):
+                if badge_rule.trigger.matches(message):
+                    self.deferral_lane.submit(badge_rule, message)
+                continue
             try:
-                for recipient in badge_rule.matches(message, tahrir):
+                with query_time_budget(badge_rule.query_timeout):
+                    recipients = badge_rule.matches(message, tahrir)
+                for recipient in recipients:
                     log.debug(
                         "Awarding %s to %s (message %s on %s)",
                         badge_rule.badge_id,
@@ -150,17 +385,55 @@ class FedoraBadgesConsumer:
                         message.id,
                         message.topic,
                     )
-                    self.award_badge(recipient, badge_rule, link)
+                    awards.append(Award(recipient, badge_rule.badge_id, link))
+            except QueryTimeoutError:
+                self.deferral_lane.defer(badge_rule, message)
             except Exception:
                 log.exception("Rule: %s, message: %s", repr(badge_rule), repr(message))
                 self.tahrir.session.rollback()
 
+        self.award_badges(awards)
+
         log.debug("Done with %s, %s", message.topic, message.id)
 
+    def _get_link(self, message: Message):
+        datagrepper_url = self.config["datagrepper_url"]
+        return f"{datagrepper_url}/v2/id?id={message.id}&is_raw=true&size=extra-large"
+
     def _reload_rules(self):
         log.debug("Check for badges updates in the repo")
-        tahrir = self._get_tahrir_client()
-        self.badge_rules = self._rules_repo.load_all(tahrir)
+        # Don't share the transaction with message processing
+        session = self._tahrir_sessions.session.session_factory()
+        try:
+            rule_set = self._rules_repo.load_all(self._get_tahrir_client(session), accept=False)
+        finally:
+            session.close()
+        if rule_set is self.badge_rules:
+            return
+        previous = self.badge_rules
+        if not previous:
+            # After a restart, compare with the rules of the previous run
+            previous = self._rules_repo.cached_definitions()
+        problems = rule_set.validate_against(
+            previous,
+            max_removed_ratio=self.config.get(
+                "rules_max_removed_ratio", DEFAULT_MAX_REMOVED_RULES_RATIO
+            ),
+        )
+        if problems:
+            # They will be loaded and checked again on the next reload
+            log.error("Not using the reloaded rules: %s", ", ".join(problems))
+            if self.badge_rules or not previous:
+                return
+            # Until then, use the rules of the previous run
+            rule_set = self._rules_repo.cached_rules()
+        else:
+            self._rules_repo.accept(rule_set)
+        # Swap the rules atomically: the messages being processed keep the set they started with.
+        self.badge_rules = rule_set
+        # The rules whose counting definition changed start new counts
+        for badge_id, (old, new) in record_counter_versions(rule_set.counting_versions()).items():
+            log.info("Counters of %s invalidated (version %s -> %s)", badge_id, old, new)
 
     def _wait_for_datanommer(self, message: Message):
         now = datetime.datetime.now(tz=datetime.timezone.utc)
@@ -183,3 +456,29 @@ class FedoraBadgesConsumer:
                 break
             log.debug("Waiting for the message to land in datanommer")
             time.sleep(0.5)
+
+
+class AsyncFedoraBadgesConsumer(FedoraBadgesConsumer):
+    """A consumer that processes the rules matching a message concurrently.
+
+    Set it as the Fedora Messaging callback to use the asyncio pipeline, see
+    :py:mod:`fedbadges.pipeline`.
+    """
+
+    async def setup(self):
+        await super().setup()
+        self._pipeline = Pipeline(
+            self,
+            workers=self.config.get("pipeline_workers", DEFAULT_WORKERS),
+            queue_size=self.config.get("pipeline_queue_size", DEFAULT_QUEUE_SIZE),
+        )
+
+    async def __call__(self, message: Message):
+        await self._ready
+        if not await self.loop.run_in_executor(None, self._claim, message):
+            return
+        await self.loop.run_in_executor(None, self._record_activity, message)
+        try:
+            await self._pipeline.process(message)
+        except SQLAlchemyError:
+            log.exception("Could not process message %s on %s", message.id, message.topic)
@@ -0,0 +1,194 @@
+""" Database engines and session scoping for fedbadges.
+
+Each thread that processes messages gets its own session from a
+``scoped_session`` registry, bound to an engine with a bounded connection pool.
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
+
+
+log = logging.getLogger(__name__)
+
+# PostgreSQL's error code when a statement is canceled, by the statement timeout for example
+QUERY_CANCELED = "57014"
+
+_query_budget = threading.local()
+
+
+class QueryTimeoutError(Exception):
+    """A query took longer than the time budget it was given."""
+
+
+class PoolWaitStats:
+    """Accumulate the time spent waiting for a connection from the pool."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.total_wait = 0.0
+            self.max_wait = 0.0
+
+    def record(self, duration: float):
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait += duration
+            if duration > self.max_wait:
+                self.max_wait = duration
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "total_wait": self.total_wait,
+                "max_wait": self.max_wait,
+                "avg_wait": self.total_wait / self.checkouts if self.checkouts else 0.0,
+            }
+
+
+class TimedQueuePool(QueuePool):
+    """A QueuePool that records how long each checkout waited for a connection."""
+
+    def __init__(self, *args, wait_stats=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_stats = wait_stats if wait_stats is not None else PoolWaitStats()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            self.wait_stats.record(time.perf_counter() - start)
+
+    def recreate(self):
+        # Keep the statistics across pool re-creations (engine.dispose(), etc)
+        new_pool = super().recreate()
+        new_pool.wait_stats = self.wait_stats
+        return new_pool
+
+
+def make_engine(
+    uri: str,
+    pool_size: int | None = None,
+    max_overflow: int | None = None,
+    pool_timeout: float | None = None,
+    pool_recycle: int | None = None,
+    pool_pre_ping: bool = True,
+    read_only: bool = False,
+):
+    """Create an engine with a bounded, instrumented connection pool.
+
+    Arguments:
+        uri: the database URI
+        pool_size: the number of connections to keep open in the pool
+        max_overflow: the number of connections to open beyond ``pool_size`` under load
+        pool_timeout: how long to wait for a connection before giving up, in seconds
+        pool_recycle: recycle connections after this many seconds
+        pool_pre_ping: test connections for liveness when they are checked out
+        read_only: run in autocommit mode, without a transaction to roll back after use
+
+    Returns:
+        The SQLAlchemy engine
+    """
+    url = make_url(uri)
+    engine_args = {"pool_pre_ping": pool_pre_ping}
+    if url.get_backend_name() != "sqlite":
+        # SQLite picks its own pool implementation depending on the database type
+        engine_args["poolclass"] = TimedQueuePool
+        pool_args = {
+            "pool_size": pool_size,
+            "max_overflow": max_overflow,
+            "pool_timeout": pool_timeout,
+            "pool_recycle": pool_recycle,
+        }
+        engine_args.update({key: value for key, value in pool_args.items() if value is not None})
+    if read_only:
+        # Nothing to commit or to roll back: don't open transactions at all, and don't
+        # issue a ROLLBACK when the connection is returned to the pool.
+        engine_args["isolation_level"] = "AUTOCOMMIT"
+        engine_args["pool_reset_on_return"] = None
+        if url.get_backend_name() == "postgresql":
+            engine_args["execution_options"] = {"postgresql_readonly": True}
+    return create_engine(uri, **engine_args)
+
+
+class SessionProvider:
+    """Hand out thread-scoped sessions bound to a pooled engine.
+
+    The ``session`` attribute is a ``scoped_session`` proxy: it can be used like a regular
+    session and will transparently use the current thread's session.
+    """
+
+    def __init__(self, engine, session=None):
+        self.engine = engine
+        if session is None:
+            session = scoped_session(sessionmaker(bind=engine, autoflush=False))
+        self.session = session
+
+    @classmethod
+    def from_config(cls, uri: str, pool_config: dict | None = None, read_only: bool = False):
+        engine = make_engine(uri, read_only=read_only, **(pool_config or {}))
+        return cls(engine)
+
+    def release(self):
+        """Close the current thread's session and return its connection to the pool."""
+        self.session.remove()
+
+    def stats(self):
+        stats = {"pool": self.engine.pool.status()}
+        wait_stats = getattr(self.engine.pool, "wait_stats", None)
+        if wait_stats is not None:
+            stats.update(wait_stats.as_dict())
+        return stats
+
+
+@contextmanager
+def query_time_budget(seconds: float | None):
+    """Limit the duration of each query run in this thread with :func:`statement_timeout`.
+
+    ``None`` means no limit.
+    """
+    previous = getattr(_query_budget, "seconds", None)
+    _query_budget.seconds = seconds
+    try:
+        yield
+    finally:
+        _query_budget.seconds = previous
+
+
+@contextmanager
+def statement_timeout(session):
+    """Apply the thread's query time budget to the statements run on this session.
+
+    The database cancels the statements that go over it, and :class:`QueryTimeoutError` is
+    raised. This needs a session in autocommit mode, and is only supported on PostgreSQL.
+    """
+    seconds = getattr(_query_budget, "seconds", None)
+    if not seconds or session.get_bind().dialect.name != "postgresql":
+        yield
+        return
+    session.execute(text(f"SET statement_timeout = {int(seconds * 1000)}"))
+    try:
+        yield
+    except OperationalError as e:
+        if getattr(e.orig, "pgcode", None) == QUERY_CANCELED:
+            raise QueryTimeoutError(f"The query took more than {seconds} seconds") from e
+        raise
+    finally:
+        # The connection goes back to the pool with its settings
+        try:
+            session.execute(text("RESET statement_timeout"))
+        except SQLAlchemyError:
+            log.exception("Could not reset the statement timeout")
@@ -0,0 +1,192 @@
+""" A separate lane for the rules whose datanommer queries are too slow.
+
+Each rule's datanommer queries get a time budget (``rule_query_timeout``), enforced by the
+database as a statement timeout. When a query goes over it, the rule is deferred: for a while,
+the messages that trigger it are processed in this lane instead of inline, in a pool of threads
+of its own, with a longer budget and retries. The expensive rules then can't hold up the cheap
+ones, or use all the database connections.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from .awards import Award
+from .db import query_time_budget, QueryTimeoutError
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_DEFERRED_WORKERS = 2
+DEFAULT_DEFERRED_RETRIES = 3
+DEFAULT_DEFERRED_MAX_PENDING = 1000
+DEFAULT_DEFERRAL_PERIOD = 3600  # seconds
+DEFAULT_RETRY_DELAY = 10  # seconds
+
+
+class DeferralLane:
+    """Process the deferred rules in the background.
+
+    The messages of a rule are processed one at a time, in order, so that they don't race on its
+    counters. At most ``max_pending`` messages wait in the lane: when it is full, submitting a
+    message blocks until there is room, which holds up the consumer instead of losing awards.
+
+    Arguments:
+        consumer: the consumer, to award the badges
+        workers: how many deferred rules can be processed at the same time
+        retries: how many times a deferred rule is tried again when it fails
+        max_pending: how many messages can wait in the lane before submitting blocks
+        query_timeout: the time budget of the deferred rules' queries, ``None`` for no limit
+        period: how long a rule stays deferred before it's tried inline again, in seconds
+        retry_delay: how long to wait before the first retry, it doubles every time
+    """
+
+    def __init__(
+        self,
+        consumer,
+        workers=DEFAULT_DEFERRED_WORKERS,
+        retries=DEFAULT_DEFERRED_RETRIES,
+        max_pending=DEFAULT_DEFERRED_MAX_PENDING,
+        query_timeout=None,
+        period=DEFAULT_DEFERRAL_PERIOD,
+        retry_delay=DEFAULT_RETRY_DELAY,
+    ):
+        self._consumer = consumer
+        self.retries = retries
+        self.max_pending = max_pending
+        self.query_timeout = query_timeout
+        self.period = period
+        self.retry_delay = retry_delay
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="fedbadges-deferred"
+        )
+        # When each deferred rule can be tried inline again, by badge id
+        self._deferred = {}
+        self._lock = threading.Lock()
+        # Notified when a message leaves the lane
+        self._room = threading.Condition(self._lock)
+        # The messages waiting to be processed, by badge id. A badge id is in the dict while one
+        # of the workers processes its messages.
+        self._queues = {}
+        self._pending = 0
+        # How many times submitting a message had to wait, and for how long in total
+        self._blocked = 0
+        self._blocked_time = 0.0
+
+    def is_deferred(self, rule):
+        with self._lock:
+            until = self._deferred.get(rule.badge_id)
+            if until is None:
+                return False
+            if until < time.monotonic():
+                if rule.badge_id in self._queues:
+                    # Let the lane finish, the messages of a rule are processed in order
+                    return True
+                log.info("Processing rule %s inline again", rule.badge_id)
+                del self._deferred[rule.badge_id]
+                return False
+            return True
+
+    def defer(self, rule, message):
+        """Defer a rule whose query went over its budget, and process this message in the lane."""
+        log.warning(
+            "Rule %s went over its query time budget of %s seconds on message %s, deferring it",
+            rule.badge_id,
+            rule.query_timeout,
+            message.id,
+        )
+        with self._lock:
+            self._deferred[rule.badge_id] = time.monotonic() + self.period
+        self.submit(rule, message)
+
+    def submit(self, rule, message):
+        """Queue a message for a rule, waiting for room in the lane if it is full."""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                log.warning(
+                    "The deferral lane is full, waiting to queue rule %s for message %s",
+                    rule.badge_id,
+                    message.id,
+                )
+                start = time.monotonic()
+                self._room.wait_for(lambda: self._pending < self.max_pending)
+                self._blocked += 1
+                self._blocked_time += time.monotonic() - start
+            self._pending += 1
+            queue = self._queues.get(rule.badge_id)
+            start_worker = queue is None
+            if start_worker:
+                queue = self._queues[rule.badge_id] = deque()
+            queue.append((rule, message))
+        log.debug(
+            "Processing rule %s for message %s in the deferral lane", rule.badge_id, message.id
+        )
+        if start_worker:
+            self._executor.submit(self._drain, rule.badge_id)
+
+    def _drain(self, badge_id):
+        # This runs in a worker thread, it's the only one processing this rule
+        while True:
+            with self._lock:
+                queue = self._queues[badge_id]
+                if not queue:
+                    del self._queues[badge_id]
+                    return
+                rule, message = queue.popleft()
+            try:
+                self._run(rule, message)
+            finally:
+                with self._lock:
+                    self._pending -= 1
+                    self._room.notify()
+
+    def _run(self, rule, message):
+        try:
+            awards = self._match(rule, message)
+            if awards:
+                self._consumer.award_badges(awards)
+        except Exception:
+            log.exception("Rule: %s, message: %s", repr(rule), repr(message))
+            self._consumer.tahrir.session.rollback()
+
+    def _match(self, rule, message):
+        link = self._consumer._get_link(message)
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                with query_time_budget(self.query_timeout):
+                    return [
+                        Award(recipient, rule.badge_id, link)
+                        for recipient in rule.matches(message, self._consumer.tahrir)
+                    ]
+            except (QueryTimeoutError, SQLAlchemyError):
+                log.warning(
+                    "Deferred rule %s failed on message %s (attempt %s of %s)",
+                    rule.badge_id,
+                    message.id,
+                    attempt + 1,
+                    self.retries + 1,
+                    exc_info=True,
+                )
+                self._consumer.tahrir.session.rollback()
+            finally:
+                self._consumer._datanommer_sessions.release()
+        log.error("Giving up on rule %s for message %s", rule.badge_id, message.id)
+        return []
+
+    def stats(self):
+        with self._lock:
+            return {
+                "deferred_rules": len(self._deferred),
+                "pending": self._pending,
+                "blocked": self._blocked,
+                "blocked_time": round(self._blocked_time, 3),
+            }
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
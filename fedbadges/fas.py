@@ -2,30 +2,185 @@
 
 # These are here just so they're available in globals()
 # for compiling lambda expressions
+import datetime
+import json
 import logging
+import os
 import re
+import sqlite3
 import sys
+import threading
+import time
 import traceback
+from urllib.parse import urlsplit
 
 import backoff
 import fasjson_client
+from bravado.client import SwaggerClient
+from fasjson_client.client import GssapiAuthenticator, RequestsClientFollowingRedirects
+from swagger_spec_validator.common import SwaggerValidationError
 
 
 log = logging.getLogger(__name__)
 
+# Try to refresh the cached API spec after that long
+DEFAULT_SPEC_CACHE_MAX_AGE = 60 * 60 * 24  # 1 day
+
 
 def _fasjson_backoff_hdlr(details):
     log.warning(f"FASJSON call failed. Retrying. {traceback.format_tb(sys.exc_info()[2])}")
 
 
+class CachedSpecClient(fasjson_client.Client):
+    """A FASJSON client that keeps the API spec in a local file.
+
+    The cached spec is refreshed from the server when it gets old, and an old spec is used if
+    the server can't be reached.
+    """
+
+    def __init__(self, url, spec_cache, spec_cache_max_age=DEFAULT_SPEC_CACHE_MAX_AGE, **kwargs):
+        self._spec_cache = spec_cache
+        self._spec_cache_max_age = spec_cache_max_age
+        super().__init__(url, **kwargs)
+
+    def _make_bravado_client(self):
+        cached_spec, age = self._read_cached_spec()
+        if cached_spec is not None and age < self._spec_cache_max_age:
+            api = self._make_bravado_client_from_spec(cached_spec)
+            if api is not None:
+                return api
+        try:
+            api = super()._make_bravado_client()
+        except fasjson_client.errors.ClientSetupError as e:
+            if cached_spec is None:
+                raise
+            log.warning("Could not refresh the FASJSON API spec, using the cached one: %s", e)
+            api = self._make_bravado_client_from_spec(cached_spec)
+            if api is None:
+                raise
+            return api
+        self._write_cached_spec(api.swagger_spec.client_spec_dict)
+        return api
+
+    def _make_bravado_client_from_spec(self, spec):
+        http_client = RequestsClientFollowingRedirects()
+        if self._auth:
+            http_client.authenticator = GssapiAuthenticator(
+                urlsplit(self._base_url).netloc, principal=self._principal
+            )
+        try:
+            # This validates the spec
+            return SwaggerClient.from_spec(
+                spec,
+                origin_url=self._spec_url,
+                http_client=http_client,
+                config=self._bravado_config,
+            )
+        except (SwaggerValidationError, ValueError, KeyError, TypeError) as e:
+            log.warning("The cached FASJSON API spec in %s is invalid: %r", self._spec_cache, e)
+            return None
+
+    def _read_cached_spec(self):
+        try:
+            with open(self._spec_cache) as f:
+                cached = json.load(f)
+            age = time.time() - os.stat(self._spec_cache).st_mtime
+        except FileNotFoundError:
+            return None, None
+        except (OSError, ValueError) as e:
+            log.warning("Could not read the cached FASJSON API spec: %r", e)
+            return None, None
+        if not isinstance(cached, dict) or cached.get("url") != self._spec_url:
+            # Cached for another server or API version
+            return None, None
+        return cached.get("spec"), age
+
+    def _write_cached_spec(self, spec):
+        tmp_path = f"{self._spec_cache}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"url": self._spec_url, "spec": spec}, f)
+            os.replace(tmp_path, self._spec_cache)
+        except (OSError, TypeError, ValueError) as e:
+            log.warning("Could not cache the FASJSON API spec: %r", e)
+
+
+def make_client(url: str, spec_cache: str | None = None):
+    """Build a FASJSON client, using a cached API spec if ``spec_cache`` is set."""
+    if spec_cache is None:
+        return fasjson_client.Client(url)
+    return CachedSpecClient(url, spec_cache=spec_cache)
+
+
+class UserCreationTimes:
+    """The creation time of the FAS users, which never changes.
+
+    They are kept in memory, and also in a local SQLite file if ``path`` is set so that they
+    survive restarts. Users that don't exist are not stored, they may be created later.
+    """
+
+    def __init__(self, path: str | None = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._times = {}
+        self._connection = None
+        if path is None:
+            return
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS creation_times "
+            "(username TEXT PRIMARY KEY, creation TEXT NOT NULL) WITHOUT ROWID"
+        )
+        self._times = dict(
+            self._connection.execute("SELECT username, creation FROM creation_times")
+        )
+
+    def __len__(self):
+        return len(self._times)
+
+    def get(self, username: str):
+        creation = self._times.get(username)
+        return None if creation is None else datetime.datetime.fromisoformat(creation)
+
+    def update(self, creation_times: dict[str, str]):
+        """Store creation times, as returned by FASJSON, by username."""
+        new = {
+            username: creation
+            for username, creation in creation_times.items()
+            if self._times.get(username) != creation
+        }
+        if not new:
+            return
+        with self._lock:
+            self._times.update(new)
+            if self._connection is not None:
+                with self._connection:
+                    self._connection.executemany(
+                        "INSERT OR REPLACE INTO creation_times (username, creation) VALUES (?, ?)",
+                        new.items(),
+                    )
+
+
 class FASProxy:
 
-    def __init__(self, url: str):
+    def __init__(self, url: str, spec_cache: str | None = None, creation_times: str | None = None):
         self._url = url
-        self._client = self._build_client()
+        self._spec_cache = spec_cache
+        self._client_instance = None
+        self._client_lock = threading.Lock()
+        self.creation_times = UserCreationTimes(creation_times)
+
+    @property
+    def _client(self):
+        # The client is built on first use, it needs to download the API spec.
+        if self._client_instance is None:
+            with self._client_lock:
+                if self._client_instance is None:
+                    self._client_instance = self._build_client()
+        return self._client_instance
 
     def _build_client(self):
-        return fasjson_client.Client(self._url)
+        return make_client(self._url, self._spec_cache)
 
     def user_exists(self, user: str):
         """Return true if the user exists in FAS."""
@@ -46,6 +201,21 @@ class FASProxy:
                 return None
             raise
 
+    def get_user_creation_time(self, username: str):
+        """Return when the user was created, or ``None`` if the user does not exist.
+
+        FASJSON is only asked the first time.
+        """
+        creation_time = self.creation_times.get(username)
+        if creation_time is not None:
+            return creation_time
+        log.debug("Getting creation time for: %r", username)
+        user = self.get_user(username)
+        if user is None:
+            return None
+        self.creation_times.update({username: user["creation"]})
+        return datetime.datetime.fromisoformat(user["creation"])
+
     def search_user(self, _fields=None, **search_args):
         _request_options = None
         if _fields:
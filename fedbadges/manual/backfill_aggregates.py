@@ -0,0 +1,60 @@
+import datetime
+import logging
+import sys
+
+import click
+import datanommer.models
+from fedora_messaging.config import conf as fm_config
+from sqlalchemy import func, select
+
+from fedbadges.aggregates import aggregates
+from fedbadges.db import SessionProvider
+
+from .utils import option_debug, setup_logging
+
+
+log = logging.getLogger(__name__)
+
+
+@click.command()
+@option_debug
+@click.option(
+    "--days", default=7, show_default=True, help="the number of days of messages to add at once"
+)
+def main(debug, days):
+    """Add the messages that datanommer received before the consumers fed the aggregates."""
+    setup_logging(debug=debug)
+    config = fm_config["consumer_config"]
+    if not config.get("aggregates_db_uri"):
+        log.error("The aggregates_db_uri option is not set")
+        sys.exit(1)
+    datanommer.models.init(uri=config["datanommer_db_uri"])
+    aggregates.configure(
+        SessionProvider.from_config(config["aggregates_db_uri"], config.get("aggregates_pool")),
+        feed=False,
+    )
+    backfill_state = aggregates.get_backfill_state()
+    if backfill_state is None:
+        log.error("Start a consumer with the aggregates_db_uri option first")
+        sys.exit(1)
+    start, end = backfill_state
+    if start is None:
+        start = datanommer.models.session.scalar(
+            select(func.min(datanommer.models.Message.timestamp))
+        )
+        datanommer.models.session.remove()
+    else:
+        log.info("Resuming from %s", start)
+
+    step = datetime.timedelta(days=days)
+    while start is not None and start < end:
+        chunk_end = min(start + step, end)
+        rows = aggregates.backfill(start, chunk_end)
+        log.info("Added the messages from %s to %s (%s rows)", start, chunk_end, rows)
+        start = chunk_end
+    aggregates.mark_complete()
+    log.info("The aggregates are complete")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,11 +3,11 @@ import subprocess
 import tempfile
 
 import click
-import fasjson_client
 from fedora_messaging.config import conf as fm_config
 from tahrir_api.dbapi import TahrirDatabase
 
 import fedbadges.utils
+from fedbadges.fas import make_client
 
 from .utils import award_badge, option_debug, setup_logging
 
@@ -49,7 +49,7 @@ def main(debug):
     badge = tahrir.get_badge(badge_id="badge-off!")
     if not badge:
         raise ValueError("badge does not exist")
-    fasjson = fasjson_client.Client(config["fasjson_base_url"])
+    fasjson = make_client(config["fasjson_base_url"], config.get("fasjson_spec_cache"))
     repos = ["tahrir", "tahrir-api", "fedbadges"]
     for repo in repos:
         with tempfile.TemporaryDirectory() as tmpdir:
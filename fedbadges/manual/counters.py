@@ -0,0 +1,71 @@
+import logging
+import os
+
+import click
+from fedora_messaging.config import conf as fm_config
+from tahrir_api.utils import convert_name_to_id
+
+from fedbadges.cached import configure as configure_cache
+from fedbadges.cached import get_counter_versions, record_counter_versions
+from fedbadges.rules import counting_version
+from fedbadges.rulesrepo import parse_yaml
+
+from .utils import option_debug, setup_logging
+
+
+log = logging.getLogger(__name__)
+
+
+def get_repo_versions(badges_repo):
+    versions = {}
+    rules_dir = os.path.join(badges_repo, "rules")
+    for root, _dirs, filenames in os.walk(rules_dir):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            with open(path, "rb") as f:
+                badge, error, _duration = parse_yaml(f.read())
+            if error is not None or not isinstance(badge, dict) or "name" not in badge:
+                log.warning("Could not read the rule in %s", path)
+                continue
+            versions[convert_name_to_id(badge["name"])] = counting_version(badge)
+    return versions
+
+
+@click.command()
+@option_debug
+@click.option(
+    "--record",
+    is_flag=True,
+    default=False,
+    help="record the current versions, like the consumer does when it loads the rules",
+)
+def main(debug, record):
+    """Report the counters key families invalidated by changes in the rules."""
+    setup_logging(debug=debug)
+    config = fm_config["consumer_config"]
+    configure_cache(**config.get("cache"))
+    versions = get_repo_versions(config["badges_repo"])
+    recorded = get_counter_versions()
+
+    changed = 0
+    for badge_id, version in sorted(versions.items()):
+        old = recorded.get(badge_id)
+        if old is None:
+            click.echo(f"new:       messages_count|{badge_id}|{version}")
+        elif old != version:
+            click.echo(f"changed:   messages_count|{badge_id}|{old} -> {version}")
+            changed += 1
+    removed = sorted(set(recorded) - set(versions))
+    for badge_id in removed:
+        click.echo(f"removed:   messages_count|{badge_id}|{recorded[badge_id]}")
+    click.echo(
+        f"{len(versions)} rules, {changed} with invalidated counters, {len(removed)} removed"
+    )
+
+    if record:
+        record_counter_versions(versions)
+        click.echo("Recorded the current versions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+import datetime
+import logging
+
+import click
+from fedora_messaging.config import conf as fm_config
+
+from fedbadges.fas import FASProxy
+
+from .utils import option_debug, setup_logging
+
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+
+@click.command()
+@option_debug
+@click.option("--group", help="only the members of this group")
+def main(debug, group):
+    """Store the creation time of all the FAS users."""
+    setup_logging(debug=debug)
+    config = fm_config["consumer_config"]
+    path = config.get("user_creation_times")
+    if not path:
+        raise click.UsageError("The user_creation_times option is not set")
+    fasjson = FASProxy(
+        config["fasjson_base_url"], config.get("fasjson_spec_cache"), creation_times=path
+    )
+    search_args = {"creation__before": datetime.datetime.now(tz=datetime.timezone.utc)}
+    if group:
+        search_args["group"] = [group]
+    batch = {}
+    total = 0
+    for user in fasjson.search_user(_fields=["username", "creation"], **search_args):
+        batch[user["username"]] = user["creation"]
+        if len(batch) >= BATCH_SIZE:
+            fasjson.creation_times.update(batch)
+            total += len(batch)
+            log.info("Stored %s creation times", total)
+            batch = {}
+    fasjson.creation_times.update(batch)
+    total += len(batch)
+    log.info("Done, %s creation times stored, %s known", total, len(fasjson.creation_times))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,7 @@ from fedora_messaging.config import conf as fm_config
 from tahrir_api.dbapi import TahrirDatabase
 
 import fedbadges.utils
+from fedbadges.fas import make_client
 
 from .utils import award_badge, option_debug, setup_logging
 
@@ -44,7 +45,7 @@ def main(debug):
         uri,
         notification_callback=fedbadges.utils.notification_callback,
     )
-    fasjson = fasjson_client.Client(config["fasjson_base_url"])
+    fasjson = make_client(config["fasjson_base_url"], config.get("fasjson_spec_cache"))
 
     group_badges = config["group_badges"]
 
@@ -31,7 +31,7 @@ def main(debug):
     if not badge:
         raise ValueError("badge does not exist")
 
-    fasjson = FASProxy(config["fasjson_base_url"])
+    fasjson = FASProxy(config["fasjson_base_url"], config.get("fasjson_spec_cache"))
 
     now = datetime.datetime.now(tz=datetime.timezone.utc)
     year = datetime.timedelta(days=365.5)
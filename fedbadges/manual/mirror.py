@@ -26,7 +26,7 @@ def main(debug):
         uri,
         notification_callback=fedbadges.utils.notification_callback,
     )
-    fasjson = FASProxy(config["fasjson_base_url"])
+    fasjson = FASProxy(config["fasjson_base_url"], config.get("fasjson_spec_cache"))
 
     url = "https://mirrormanager.fedoraproject.org/api/mirroradmins"
     response = requests.get(url, timeout=HTTP_TIMEOUT)
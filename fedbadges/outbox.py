@@ -0,0 +1,145 @@
+""" A durable outbox for badge awards.
+
+When it is enabled, the awards computed for a message are appended to a local SQLite database
+(in WAL mode) and the message can be acknowledged right away. A background job then writes the
+awards to tahrir, in batches and in order. Writing an award twice is harmless, so if the
+consumer crashes before an applied batch is removed from the outbox it will just be applied
+again.
+
+Awards that can't be written at all (invalid data, a constraint violation) are moved to a
+dead-letter table, so that they don't block the ones queued after them.
+"""
+
+import logging
+import sqlite3
+import threading
+
+from sqlalchemy.exc import DataError, IntegrityError
+
+from .awards import Award
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_DRAIN_BATCH_SIZE = 100
+DEFAULT_DRAIN_INTERVAL = 5  # seconds
+# The errors that writing the award again won't fix
+PERMANENT_ERRORS = (DataError, IntegrityError, TypeError, ValueError)
+
+
+class AwardOutbox:
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        # We handle transactions ourselves
+        self._connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        # An appended award must survive a power loss, the message will be acked.
+        self._connection.execute("PRAGMA synchronous=FULL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS awards ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "username TEXT NOT NULL, "
+            "badge_id TEXT NOT NULL, "
+            "link TEXT)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS dead_awards ("
+            "id INTEGER PRIMARY KEY, "
+            "username TEXT, "
+            "badge_id TEXT, "
+            "link TEXT, "
+            "error TEXT NOT NULL, "
+            "failed_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+        )
+
+    def append(self, awards: list[Award]):
+        if not awards:
+            return
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._connection.executemany(
+                    "INSERT INTO awards (username, badge_id, link) VALUES (?, ?, ?)",
+                    [(award.username, award.badge_id, award.link) for award in awards],
+                )
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def pending(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM awards").fetchone()[0]
+
+    def dead(self):
+        """Return the number of awards that could not be written."""
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM dead_awards").fetchone()[0]
+
+    def drain(self, writer, tahrir, batch_size: int = DEFAULT_DRAIN_BATCH_SIZE):
+        """Write the pending awards to tahrir.
+
+        Arguments:
+            writer (fedbadges.awards.AwardWriter): the object writing awards to tahrir
+            tahrir (tahrir_api.dbapi.TahrirDatabase): the tahrir client
+            batch_size: how many awards to write in each transaction
+
+        Returns:
+            The number of awards that were taken out of the outbox.
+        """
+        drained = 0
+        while True:
+            with self._lock:
+                rows = self._connection.execute(
+                    "SELECT id, username, badge_id, link FROM awards ORDER BY id LIMIT ?",
+                    (batch_size,),
+                ).fetchall()
+            if not rows:
+                break
+            try:
+                # If this fails otherwise, the awards stay in the outbox and will be retried next
+                # time.
+                writer.write(tahrir, [Award(*row[1:]) for row in rows])
+            except PERMANENT_ERRORS:
+                log.warning("Could not write a batch of awards, writing them one by one")
+                self._write_one_by_one(writer, tahrir, rows)
+            else:
+                with self._lock:
+                    self._connection.execute("DELETE FROM awards WHERE id <= ?", (rows[-1][0],))
+            drained += len(rows)
+        if drained:
+            log.debug("Wrote %s awards from the outbox", drained)
+        return drained
+
+    def _write_one_by_one(self, writer, tahrir, rows):
+        for row in rows:
+            award = Award(*row[1:])
+            try:
+                writer.write(tahrir, [award])
+            except PERMANENT_ERRORS as e:
+                log.error("Could not write %r, moving it to the dead awards: %r", award, e)
+                self._move_to_dead(row, repr(e))
+            else:
+                with self._lock:
+                    self._connection.execute("DELETE FROM awards WHERE id = ?", (row[0],))
+
+    def _move_to_dead(self, row, error):
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._connection.execute(
+                    "INSERT INTO dead_awards (id, username, badge_id, link, error) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (*row, error),
+                )
+                self._connection.execute("DELETE FROM awards WHERE id = ?", (row[0],))
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,179 @@
+""" An asyncio processing pipeline for incoming messages.
+
+The rules matching a message go through the following stages, connected by bounded queues:
+
+- trigger: the lightweight check, run in the event loop;
+- candidates: who would get the badge (tahrir and FASJSON lookups);
+- counting: the datanommer queries and the rule's condition;
+- award: adding the assertions in tahrir, in batches.
+
+The blocking stages run in a dedicated thread pool, and since database sessions are
+thread-scoped each worker uses its own sessions.
+"""
+
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+
+from fedora_messaging.api import Message
+
+from .awards import Award
+from .cached import message_memo
+from .db import query_time_budget, QueryTimeoutError
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+DEFAULT_QUEUE_SIZE = 100
+
+
+class Pipeline:
+
+    def __init__(self, consumer, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE):
+        self._consumer = consumer
+        self._workers = workers
+        self._queue_size = queue_size
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="fedbadges-pipeline"
+        )
+
+    async def process(self, message: Message):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._consumer._wait_for_datanommer, message)
+
+        # Trigger stage: it's cheap, run it right here.
+        rules = []
+        for rule in self._consumer.badge_rules.for_message(message):
+            if not rule.trigger.matches(message):
+                continue
+            if self._consumer.deferral_lane.is_deferred(rule):
+                # This waits when the lane is full, don't block the event loop
+                await loop.run_in_executor(
+                    self._executor, self._consumer.deferral_lane.submit, rule, message
+                )
+                continue
+            rules.append(rule)
+        if not rules:
+            log.debug("No rule triggered by %s on %s", message.id, message.topic)
+            return
+
+        link = self._consumer._get_link(message)
+        candidates_queue = asyncio.Queue(self._queue_size)
+        counting_queue = asyncio.Queue(self._queue_size)
+        award_queue = asyncio.Queue(self._queue_size)
+        workers = [
+            *self._start_stage(
+                candidates_queue,
+                partial(self._resolve_candidates, message),
+                counting_queue,
+                self._workers,
+            ),
+            *self._start_stage(
+                counting_queue, partial(self._count, message), award_queue, self._workers
+            ),
+            # Only one writer to tahrir, writing everything that is ready at once
+            *self._start_stage(
+                award_queue, partial(self._award, message, link), None, 1, batch=True
+            ),
+        ]
+        # The workers share the datanommer counts of this message through its memo
+        with message_memo(message.id):
+            try:
+                for rule in rules:
+                    await candidates_queue.put(rule)
+                # Workers only mark an item as done after they've passed on its result, so once a
+                # queue is joined the next one has received everything it will ever receive.
+                for queue in (candidates_queue, counting_queue, award_queue):
+                    await queue.join()
+            finally:
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+
+        log.debug("Done with %s, %s", message.topic, message.id)
+
+    def _start_stage(self, inbox, func, outbox, count, batch=False):
+        return [
+            asyncio.create_task(self._stage_worker(inbox, func, outbox, batch))
+            for _i in range(count)
+        ]
+
+    async def _stage_worker(self, inbox, func, outbox, batch):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await inbox.get()]
+            if batch:
+                while not inbox.empty():
+                    items.append(inbox.get_nowait())
+            try:
+                result = await loop.run_in_executor(
+                    self._executor, self._run, func, items if batch else items[0]
+                )
+                if result is not None and outbox is not None:
+                    await outbox.put(result)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Keep the worker alive, or nothing would drain this stage anymore
+                log.exception("Pipeline stage %s failed on %r", func, items)
+            finally:
+                for _item in items:
+                    inbox.task_done()
+
+    def _run(self, func, item):
+        # This runs in a worker thread
+        try:
+            return func(item)
+        finally:
+            # Give the connection back to the pool between stages, it's free for read-only
+            # sessions.
+            self._consumer._datanommer_sessions.release()
+
+    @contextmanager
+    def _rule_errors(self, rule, message):
+        try:
+            yield
+        except Exception:
+            log.exception("Rule: %s, message: %s", repr(rule), repr(message))
+            self._consumer.tahrir.session.rollback()
+
+    def _resolve_candidates(self, message, rule):
+        with self._rule_errors(rule, message):
+            log.debug("Checking match for rule %s", rule.badge_id)
+            candidates = rule.get_candidates(message, self._consumer.tahrir)
+            log.debug("Candidates: %r", candidates)
+            if candidates:
+                return rule, candidates
+
+    def _count(self, message, item):
+        rule, candidates = item
+        with self._rule_errors(rule, message):
+            try:
+                with query_time_budget(rule.query_timeout):
+                    awardees = rule.get_awardees(message, candidates)
+            except QueryTimeoutError:
+                self._consumer.deferral_lane.defer(rule, message)
+                return None
+            if awardees:
+                return rule, awardees
+
+    def _award(self, message, link, items):
+        awards = []
+        for rule, awardees in items:
+            for recipient in awardees:
+                log.debug(
+                    "Awarding %s to %s (message %s on %s)",
+                    rule.badge_id,
+                    recipient,
+                    message.id,
+                    message.topic,
+                )
+                awards.append(Award(recipient, rule.badge_id, link))
+        try:
+            self._consumer.award_badges(awards)
+        except Exception:
+            log.exception("Could not award %r for message %s", awards, message.id)
+            self._consumer.tahrir.session.rollback()
@@ -0,0 +1,201 @@
+""" Publish the notification messages in the background.
+
+Tahrir calls its notification callback for every award. Publishing synchronously would stall the
+badge processing whenever the broker is slow, so the messages are queued and sent by a worker
+thread, in batches. Messages that could not be sent yet are kept in a spool file, so they
+survive a restart.
+"""
+
+import logging
+import os
+import threading
+from collections import deque
+
+from fedora_messaging import api as fm_api
+from fedora_messaging import exceptions as fm_exceptions
+from fedora_messaging import message as fm_message
+from fedora_messaging.config import conf as fm_config
+from twisted.internet import defer, reactor, threads
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_RETRY_DELAY = 1  # seconds
+DEFAULT_MAX_RETRY_DELAY = 300  # seconds
+STOP_TIMEOUT = 5  # seconds
+# Publishing the message again won't fix these
+PERMANENT_ERRORS = (
+    fm_exceptions.ValidationError,
+    fm_exceptions.PublishForbidden,
+    fm_exceptions.PublishReturned,
+)
+
+
+@defer.inlineCallbacks
+def _twisted_publish_batch(messages, exchange):
+    published = 0
+    for message in messages:
+        try:
+            yield fm_api.twisted_publish(message, exchange=exchange)
+        except Exception as e:
+            return published, e
+        published += 1
+    return published, None
+
+
+def publish_batch(messages):
+    """Publish the messages in order.
+
+    Returns:
+        The number of messages that were published, and the error that stopped the publication
+        or ``None``.
+    """
+    exchange = fm_config["publish_exchange"]
+    if fm_api._twisted_service is None:
+        # We're not running in the consumer
+        published = 0
+        for message in messages:
+            try:
+                fm_api.publish(message=message, exchange=exchange)
+            except fm_exceptions.BaseException as e:
+                return published, e
+            published += 1
+        return published, None
+    # We're running in the consumer: one trip to the reactor for the whole batch
+    return threads.blockingCallFromThread(reactor, _twisted_publish_batch, messages, exchange)
+
+
+class NotificationPublisher:
+    """A notification callback for tahrir that publishes messages in the background."""
+
+    def __init__(
+        self,
+        spool_path: str | None = None,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        retry_delay: float = DEFAULT_RETRY_DELAY,
+        max_retry_delay: float = DEFAULT_MAX_RETRY_DELAY,
+    ):
+        self._spool_path = spool_path
+        self._batch_size = batch_size
+        self._retry_delay = retry_delay
+        self._max_retry_delay = max_retry_delay
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def __call__(self, message):
+        with self._condition:
+            self._queue.append(message)
+            self._append_to_spool(message)
+            self._condition.notify()
+
+    @property
+    def pending(self):
+        return len(self._queue)
+
+    def start(self):
+        with self._condition:
+            if self._running:
+                return
+            self._queue.extend(self._read_spool())
+            if self._queue:
+                log.info("Loaded %s unsent notifications from the spool", len(self._queue))
+            self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name="fedbadges-publisher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout: float = STOP_TIMEOUT):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self._queue:
+            log.warning("Stopping with %s unsent notifications", len(self._queue))
+
+    def _run(self):
+        delay = 0
+        while True:
+            with self._condition:
+                while self._running and not self._queue:
+                    self._condition.wait()
+                if not self._running:
+                    break
+                batch = [self._queue[i] for i in range(min(self._batch_size, len(self._queue)))]
+
+            try:
+                published, error = publish_batch(batch)
+            except Exception as e:
+                # Don't let the thread die, e.g. if the reactor is stopping
+                log.exception("Unexpected error while publishing the notifications")
+                published, error = 0, e
+
+            with self._condition:
+                for _i in range(published):
+                    self._queue.popleft()
+                if isinstance(error, PERMANENT_ERRORS):
+                    dropped = self._queue.popleft()
+                    log.error(
+                        "Dropping the notification %s on %s, it can't be published: %s",
+                        dropped.id,
+                        dropped.topic,
+                        error,
+                    )
+                    published += 1
+                    error = None
+                if published:
+                    self._write_spool()
+                if error is None:
+                    delay = 0
+                    continue
+                delay = min(max(delay * 2, self._retry_delay), self._max_retry_delay)
+                log.warning(
+                    "Publishing message failed: %s. %s messages pending, retrying in %s seconds",
+                    error,
+                    len(self._queue),
+                    delay,
+                )
+                # Wait before retrying, unless we're asked to stop
+                self._condition.wait_for(lambda: not self._running, timeout=delay)
+
+    # Spool file handling. Called with the condition held.
+
+    def _append_to_spool(self, message):
+        if self._spool_path is None:
+            return
+        try:
+            with open(self._spool_path, "a") as spool:
+                spool.write(fm_message.dumps(message))
+        except (OSError, fm_exceptions.ValidationError) as e:
+            log.warning("Could not write the notification to the spool: %s", e)
+
+    def _write_spool(self):
+        if self._spool_path is None:
+            return
+        tmp_path = f"{self._spool_path}.tmp"
+        try:
+            with open(tmp_path, "w") as spool:
+                if self._queue:
+                    spool.write(fm_message.dumps(list(self._queue)))
+            os.replace(tmp_path, self._spool_path)
+        except (OSError, fm_exceptions.ValidationError) as e:
+            log.warning("Could not rewrite the notifications spool: %s", e)
+
+    def _read_spool(self):
+        if self._spool_path is None or not os.path.exists(self._spool_path):
+            return []
+        messages = []
+        with open(self._spool_path) as spool:
+            for line in spool:
+                if not line.strip():
+                    continue
+                try:
+                    messages.extend(fm_message.loads(line))
+                except fm_exceptions.ValidationError as e:
+                    # Probably a partial write
+                    log.warning("Skipping invalid message in the notifications spool: %s", e)
+        return messages
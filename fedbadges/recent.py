@@ -0,0 +1,172 @@
+""" An in-memory index of the recent messages, by user.
+
+The consumer keeps the metadata of the messages it received in the last days, within a memory
+budget, so that counting the recent messages of a user doesn't need a datanommer query. The index
+only has the messages received since the consumer started, it only answers the queries whose
+time window it fully covers.
+
+Every message must go through this consumer for the index to be complete: don't enable it if
+several consumers share the queue.
+"""
+
+import datetime
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+
+from .aggregates import get_category, get_sent_at
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_RECENT_MESSAGES_MAX_SIZE = 64 * 1024 * 1024  # bytes
+# The filters that can be answered from the index, the users and the time window are required.
+ANSWERABLE_FILTERS = frozenset(["users", "categories", "topics", "packages", "start", "end"])
+# A rough estimate of the memory used by an entry, without its strings
+_ENTRY_OVERHEAD = 300  # bytes
+_USER_OVERHEAD = 100  # bytes
+
+
+class _Entry:
+    __slots__ = ("category", "msg_id", "packages", "size", "timestamp", "topic", "users")
+
+    def __init__(self, msg_id, timestamp, topic, category, users, packages):
+        self.msg_id = msg_id
+        self.timestamp = timestamp
+        self.topic = topic
+        self.category = category
+        self.users = users
+        self.packages = packages
+        self.size = (
+            _ENTRY_OVERHEAD
+            + len(msg_id)
+            + len(topic)
+            + sum(len(user) + _USER_OVERHEAD for user in users)
+            + sum(len(package) for package in packages)
+        )
+
+
+def _to_timestamp(value):
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            # Like datanommer's timestamps
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return value.timestamp()
+    return float(value)
+
+
+class RecentMessages:
+    """The messages of the last ``days``, indexed by user.
+
+    It does nothing until it is configured.
+    """
+
+    def __init__(self):
+        self.days = None
+        self.max_size = DEFAULT_RECENT_MESSAGES_MAX_SIZE
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self._messages = deque()
+        self._by_user = defaultdict(deque)
+        self.size = 0
+        # The index has all the messages sent after this timestamp
+        self.covers_since = time.time()
+
+    @property
+    def is_configured(self):
+        return self.days is not None
+
+    def configure(self, days, max_size=DEFAULT_RECENT_MESSAGES_MAX_SIZE):
+        with self._lock:
+            self.days = days
+            self.max_size = max_size
+            self._clear()
+
+    def __len__(self):
+        return len(self._messages)
+
+    def add(self, message):
+        if not self.is_configured:
+            return
+        try:
+            users = frozenset(message.usernames)
+            packages = frozenset(message.packages)
+        except Exception:
+            log.exception("Could not get the users of %s on %s", message.id, message.topic)
+            return
+        if not users:
+            return
+        timestamp = get_sent_at(message).timestamp()
+        if timestamp < time.time() - self.days * 86400:
+            return
+        entry = _Entry(
+            message.id,
+            timestamp,
+            message.topic,
+            get_category(message.topic),
+            users,
+            packages,
+        )
+        with self._lock:
+            self._messages.append(entry)
+            for user in users:
+                self._by_user[user].append(entry)
+            self.size += entry.size
+            self._evict()
+
+    def _evict(self):
+        oldest = time.time() - self.days * 86400
+        while self._messages and (
+            self.size > self.max_size or self._messages[0].timestamp < oldest
+        ):
+            entry = self._messages.popleft()
+            self.size -= entry.size
+            for user in entry.users:
+                user_entries = self._by_user[user]
+                # Entries are added in the same order everywhere
+                user_entries.popleft()
+                if not user_entries:
+                    del self._by_user[user]
+            self.covers_since = max(self.covers_since, entry.timestamp)
+
+    def can_answer(self, search_kwargs: dict):
+        """Whether the messages matching these grep arguments are all in the index."""
+        if not self.is_configured:
+            return False
+        if not set(search_kwargs).issubset(ANSWERABLE_FILTERS):
+            return False
+        if not search_kwargs.get("users") or search_kwargs.get("start") is None:
+            return False
+        try:
+            start = _to_timestamp(search_kwargs["start"])
+        except (TypeError, ValueError):
+            return False
+        # Messages sent in the same second as an evicted one may be gone as well
+        return start > self.covers_since
+
+    def count(self, users, start, end=None, categories=None, topics=None, packages=None):
+        start = _to_timestamp(start)
+        end = _to_timestamp(end) if end is not None else None
+        with self._lock:
+            entries = {
+                entry.msg_id: entry
+                for user in users
+                for entry in self._by_user.get(user, ())
+                if entry.timestamp >= start and (end is None or entry.timestamp <= end)
+            }
+        return sum(
+            1
+            for entry in entries.values()
+            if (not categories or entry.category in categories)
+            and (not topics or entry.topic in topics)
+            and (not packages or not entry.packages.isdisjoint(packages))
+        )
+
+    def stats(self):
+        return {"messages": len(self._messages), "users": len(self._by_user), "size": self.size}
+
+
+recent_messages = RecentMessages()
@@ -0,0 +1,193 @@
+""" Reconcile the cached messages counts with datanommer.
+
+The messages counts kept in the cache drift from what datanommer has over time: redelivered or
+missed messages, and concurrent consumers racing between reading a count and storing it. The
+rules record the counters they use, and a background job takes them in batches, counts again
+with the rule's ``previous`` query (in a single query for all the candidates of a rule when its
+filter allows it), stores the correct values and awards the badges that the drift had held back.
+
+The job is rate-limited so that it doesn't compete with the processing of live messages.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from .awards import Award
+from .cached import get_messages_counts, replace_messages_counts
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_RECONCILE_BATCH_SIZE = 100
+DEFAULT_RECONCILE_QUERIES_PER_SECOND = 2
+DEFAULT_RECONCILE_MAX_PENDING = 10000
+
+
+class PendingCounters:
+    """The counters used recently, with the message that last used them.
+
+    Only the ``max_size`` most recently used counters are kept, recording is disabled when it
+    is 0.
+    """
+
+    def __init__(self, max_size=0):
+        self.max_size = max_size
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, rule, msg, candidates):
+        if not self.max_size:
+            return
+        with self._lock:
+            for candidate in candidates:
+                key = (rule.badge_id, candidate)
+                self._pending[key] = (rule, msg)
+                self._pending.move_to_end(key)
+            while len(self._pending) > self.max_size:
+                self._pending.popitem(last=False)
+
+    def pop(self, count):
+        """Remove and return the ``count`` least recently used counters."""
+        with self._lock:
+            count = min(count, len(self._pending))
+            return [self._pending.popitem(last=False) for _i in range(count)]
+
+
+pending_counters = PendingCounters()
+
+
+class CounterReconciler:
+
+    def __init__(
+        self,
+        consumer,
+        batch_size=DEFAULT_RECONCILE_BATCH_SIZE,
+        queries_per_second=DEFAULT_RECONCILE_QUERIES_PER_SECOND,
+        pending=pending_counters,
+    ):
+        self._consumer = consumer
+        self.batch_size = batch_size
+        self.queries_per_second = queries_per_second
+        self._pending = pending
+        self._next_query = 0
+
+    def run(self):
+        start = time.perf_counter()
+        by_badge = {}
+        for (badge_id, candidate), (rule, msg) in self._pending.pop(self.batch_size):
+            by_badge.setdefault(badge_id, (rule, []))[1].append((candidate, msg))
+        checked = drifted = total_drift = 0
+        awards = []
+        for badge_id, (rule, items) in by_badge.items():
+            try:
+                result = self._reconcile_rule(rule, items)
+            except SQLAlchemyError:
+                log.exception("Could not reconcile the counters of %s", badge_id)
+                self._consumer.tahrir.session.rollback()
+                continue
+            checked += result[0]
+            drifted += len(result[1])
+            total_drift += sum(abs(drift) for drift in result[1].values())
+            awards.extend(result[2])
+        if awards:
+            try:
+                self._consumer.award_badges(awards)
+            except Exception:
+                log.exception("Could not award %r", awards)
+                self._consumer.tahrir.session.rollback()
+        if checked:
+            log.info(
+                "Reconciled %s counters in %.2f seconds: %s drifted by %s messages in total, "
+                "%s badges awarded, %s counters pending",
+                checked,
+                time.perf_counter() - start,
+                drifted,
+                total_drift,
+                len(awards),
+                len(self._pending),
+            )
+
+    def _reconcile_rule(self, rule, items):
+        """Count the messages again for the candidates of a rule.
+
+        Returns:
+            The number of counters checked, the drifts by candidate and the held back awards.
+        """
+        cached = get_messages_counts(
+            rule.badge_id, [candidate for candidate, _msg in items], rule.counting_version
+        )
+        # Expired or evicted counters will be computed again when needed
+        items = [(candidate, msg) for candidate, msg in items if cached[candidate] is not None]
+        checked = 0
+        corrected = {}
+        drifts = {}
+        awards = []
+        for candidate, msg, actual in self._count(rule, items):
+            checked += 1
+            if actual <= 0 or actual == cached[candidate]:
+                # Nothing counted means the query failed, don't trust it
+                continue
+            corrected[candidate] = actual
+            drifts[candidate] = actual - cached[candidate]
+            log.debug(
+                "Counter of %s for %s drifted: %s instead of %s",
+                rule.badge_id,
+                candidate,
+                cached[candidate],
+                actual,
+            )
+            if rule.condition(actual) and self._can_award(rule, candidate):
+                awards.append(Award(candidate, rule.badge_id, self._consumer._get_link(msg)))
+        # Live messages may have incremented these counters during the queries, those are left
+        # for the next time they're checked.
+        if corrected:
+            replaced = replace_messages_counts(
+                rule.badge_id, cached, corrected, rule.counting_version
+            )
+            for candidate in set(corrected) - replaced:
+                log.debug("Counter of %s for %s changed meanwhile", rule.badge_id, candidate)
+        return checked, drifts, awards
+
+    def _count(self, rule, items):
+        """Count the messages of the candidates, in a single query if the rule allows it."""
+        if not items:
+            return
+        self._throttle()
+        try:
+            counts = rule.previous.count_grouped([(msg, candidate) for candidate, msg in items])
+        finally:
+            self._consumer._datanommer_sessions.release()
+        if counts is not None:
+            for candidate, msg in items:
+                yield candidate, msg, counts[candidate]
+            return
+        for index, (candidate, msg) in enumerate(items):
+            if index:
+                self._throttle()
+            try:
+                actual = rule.previous.count(msg, candidate)
+            finally:
+                self._consumer._datanommer_sessions.release()
+            yield candidate, msg, actual
+
+    def _can_award(self, rule, candidate):
+        tahrir = self._consumer._get_tahrir_client()
+        email = f"{candidate}@fedoraproject.org"
+        return not tahrir.assertion_exists(rule.badge_id, email) and not tahrir.person_opted_out(
+            email
+        )
+
+    def _throttle(self):
+        if not self.queries_per_second:
+            return
+        now = time.monotonic()
+        if self._next_query > now:
+            time.sleep(self._next_query - now)
+        self._next_query = max(now, self._next_query) + 1 / self.queries_per_second
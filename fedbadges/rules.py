@@ -11,14 +11,23 @@ import datetime
 import functools
 import inspect
 import logging
+from collections import defaultdict
 from itertools import chain
 
 import datanommer.models
 from fedora_messaging.api import Message
+from sqlalchemy import func, select
+from sqlalchemy.exc import SQLAlchemyError
 from tahrir_api.dbapi import TahrirDatabase
+from tahrir_api.model import Badge
+from tahrir_api.utils import convert_name_to_id
 
-from fedbadges.cached import cache, get_cached_messages_count
+from fedbadges.aggregates import aggregates
+from fedbadges.cached import get_cached_messages_counts, get_first_seen, get_message_memo
+from fedbadges.db import statement_timeout
 from fedbadges.fas import distgit2fas, krb2fas, openid2fas
+from fedbadges.recent import recent_messages
+from fedbadges.reconcile import pending_counters
 from fedbadges.utils import (
     # These are all in-process utilities
     graceful,
@@ -32,6 +41,34 @@ from fedbadges.utils import (
 
 log = logging.getLogger(__name__)
 
+# The datanommer filters that a grouped count supports, besides the users
+GROUPABLE_FILTERS = frozenset(
+    [
+        "start",
+        "end",
+        "not_users",
+        "packages",
+        "not_packages",
+        "categories",
+        "not_categories",
+        "topics",
+        "not_topics",
+        "agents",
+        "not_agents",
+        "contains",
+    ]
+)
+
+# A reloaded rule set that lost more than this share of the rules is probably broken
+DEFAULT_MAX_REMOVED_RULES_RATIO = 0.5
+
+
+def to_naive_utc(value: datetime.datetime):
+    """Convert a datetime to a naive one in UTC, naive datetimes are assumed to be in UTC."""
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
 
 def validate_possible(possible, fields):
     fields_set = set(fields)
@@ -63,6 +100,15 @@ lambdas = frozenset(
 )
 
 
+def counting_version(badge_dict: dict):
+    """Return the version of a rule's counting definition.
+
+    The rule's messages counts are stored under it: changing the ``previous`` query starts new
+    counts for this rule only.
+    """
+    return json_hash(badge_dict.get("previous"))[:12]
+
+
 class BadgeRule:
     required = frozenset(
         [
@@ -131,6 +177,7 @@ class BadgeRule:
         else:
             # By default: only the current message
             self.previous = None
+        self.counting_version = counting_version(self._d)
 
         # self.recipient_key = self._d.get("recipient")
         self.recipient_getter = single_argument_lambda_factory(
@@ -148,7 +195,11 @@ class BadgeRule:
         self.recipient_krb2fas = self._d.get("recipient_krb2fas")
 
     def setup(self, tahrir: TahrirDatabase):
-        self.badge_id = self._d["badge_id"] = tahrir.add_badge(
+        if not register_badges(tahrir, [self]):
+            raise ValueError(f"Could not register the badge for {self._d['name']}")
+
+    def _add_badge(self, tahrir: TahrirDatabase):
+        return tahrir.add_badge(
             name=self._d["name"],
             image=self._d["image_url"],
             desc=self._d["description"],
@@ -156,7 +207,9 @@ class BadgeRule:
             tags=",".join(self._d.get("tags", [])),
             issuer_id=self.issuer_id,
         )
-        tahrir.session.commit()
+
+    def _set_badge_id(self, badge_id: str):
+        self.badge_id = self._d["badge_id"] = badge_id
 
     def __getitem__(self, key):
         return self._d[key]
@@ -164,7 +217,8 @@ class BadgeRule:
     def __repr__(self):
         return f"<fedbadges.models.BadgeRule: {self._d!r}>"
 
-    def _get_candidates(self, msg: Message, tahrir: TahrirDatabase):
+    def get_candidates(self, msg: Message, tahrir: TahrirDatabase):
+        """Return the users who would get the badge if the criteria matched."""
         try:
             candidates = self.recipient_getter(message=msg)
         except KeyError as e:
@@ -243,7 +297,7 @@ class BadgeRule:
         # Before proceeding further, let's see who would get this badge if
         # our more heavyweight checks matched up.
 
-        candidates = self._get_candidates(msg, tahrir)
+        candidates = self.get_candidates(msg, tahrir)
         log.debug("Candidates: %r", candidates)
 
         # If no-one would get the badge at this point, then no reason to waste
@@ -251,6 +305,16 @@ class BadgeRule:
         if not candidates:
             return frozenset()
 
+        return self.get_awardees(msg, candidates)
+
+    @property
+    def query_timeout(self):
+        """The time budget of each datanommer query of this rule, in seconds."""
+        timeouts = self.config.get("rule_query_timeouts", {})
+        return timeouts.get(self.badge_id, self.config.get("rule_query_timeout"))
+
+    def get_awardees(self, msg: Message, candidates):
+        """Return the candidates who match the rule's criteria."""
         if self.previous:
             previous_count_fn = functools.partial(self.previous.count, msg)
         else:
@@ -259,10 +323,20 @@ class BadgeRule:
         # Check our backend criteria -- possibly, perform datanommer queries.
         try:
             awardees = set()
-            for candidate in candidates:
-                messages_count = get_cached_messages_count(
-                    self.badge_id, candidate, previous_count_fn
+            if self.previous and self.previous.is_windowed:
+                # Messages leave the time window, the count can't be kept up to date by
+                # incrementing it: count them every time.
+                messages_counts = {
+                    candidate: previous_count_fn(candidate) for candidate in sorted(candidates)
+                }
+            else:
+                messages_counts = get_cached_messages_counts(
+                    self.badge_id, sorted(candidates), previous_count_fn, self.counting_version
                 )
+                if self.previous:
+                    # Check them against datanommer later
+                    pending_counters.add(self, msg, messages_counts)
+            for candidate, messages_count in messages_counts.items():
                 log.debug(
                     "Rule %s: message count for %s is %s", self.badge_id, candidate, messages_count
                 )
@@ -275,6 +349,102 @@ class BadgeRule:
         return awardees
 
 
+class RuleSet:
+    """An immutable collection of badge rules, indexed by the message category they trigger on.
+
+    Looking up the rules that may be triggered by a message then does not require checking the
+    trigger of every rule.
+    """
+
+    def __init__(self, badge_rules=()):
+        self._rules = tuple(badge_rules)
+        self._by_category = defaultdict(list)
+        self._any_category = []
+        for index, rule in enumerate(self._rules):
+            categories = rule.trigger.categories()
+            if categories is None:
+                self._any_category.append(index)
+                continue
+            for category in categories:
+                self._by_category[category].append(index)
+
+    def __iter__(self):
+        return iter(self._rules)
+
+    def __len__(self):
+        return len(self._rules)
+
+    def __repr__(self):
+        return f"<RuleSet: {len(self._rules)} rules>"
+
+    def for_message(self, msg: Message):
+        """Return the rules that may be triggered by this message, in order."""
+        try:
+            category = msg.topic.split(".")[3]
+        except IndexError:
+            category = None
+        indexes = set(self._any_category).union(self._by_category.get(category, []))
+        return [self._rules[index] for index in sorted(indexes)]
+
+    def counting_versions(self):
+        """Return the version of the counting definition of each rule, by badge id."""
+        return {rule.badge_id: rule.counting_version for rule in self._rules}
+
+    def validate_against(
+        self, previous: "RuleSet", max_removed_ratio: float = DEFAULT_MAX_REMOVED_RULES_RATIO
+    ):
+        """Compare with the rule set this one would replace.
+
+        Arguments:
+            previous: the rule set, or the definitions of the rules, this one would replace
+            max_removed_ratio: the share of the previous rules that can be missing
+
+        Returns:
+            A list of reasons why this rule set should not replace the previous one.
+        """
+        names = {rule["name"] for rule in self._rules}
+        previous_names = {rule["name"] for rule in previous}
+        added = names - previous_names
+        removed = previous_names - names
+        if added or removed:
+            log.info("Rules added: %r, rules removed: %r", sorted(added), sorted(removed))
+        problems = []
+        if previous_names and not names:
+            problems.append("no rule could be loaded")
+        elif len(removed) > len(previous_names) * max_removed_ratio:
+            problems.append(f"{len(removed)} of the {len(previous_names)} rules are missing")
+        return problems
+
+
+def register_badges(tahrir: TahrirDatabase, badge_rules: list[BadgeRule]):
+    """Make sure the rules' badges exist in tahrir, in a single transaction.
+
+    Returns:
+        The rules whose badge could be registered.
+    """
+    if not badge_rules:
+        return []
+    badge_ids = {convert_name_to_id(rule["name"]) for rule in badge_rules}
+    existing = set(tahrir.session.scalars(select(Badge.id).where(Badge.id.in_(badge_ids))))
+    try:
+        for rule in badge_rules:
+            badge_id = convert_name_to_id(rule["name"])
+            if badge_id not in existing:
+                badge_id = rule._add_badge(tahrir)
+                existing.add(badge_id)
+            rule._set_badge_id(badge_id)
+        tahrir.session.commit()
+    except SQLAlchemyError:
+        tahrir.session.rollback()
+        if len(badge_rules) == 1:
+            log.exception("Could not register the badge for %r", badge_rules[0]["name"])
+            return []
+        # Find the culprit(s)
+        log.warning("Could not register the badges in bulk, registering them one by one")
+        return [rule for rule in badge_rules if register_badges(tahrir, [rule])]
+    return badge_rules
+
+
 class AbstractChild:
     """Base class for shared behavior between trigger and criteria."""
 
@@ -341,6 +511,42 @@ class Trigger(AbstractTopLevelComparator):
         .union(lambdas)
     )
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Compile the lambda once and for all
+        if self.attribute == "lambda":
+            try:
+                self._func = single_argument_lambda_factory(
+                    expression=self.expected_value,
+                    name="message",
+                )
+            except SyntaxError as e:
+                raise ValueError(f"Invalid trigger lambda {self.expected_value!r}: {e}") from e
+
+    def categories(self):
+        """Return the message categories this trigger can match, or None if it can match any."""
+        if self.attribute == "category":
+            if not isinstance(self.expected_value, str):
+                # Not something we can index on, let the trigger decide
+                return None
+            return frozenset([self.expected_value])
+        if self.attribute == "any":
+            children_categories = [child.categories() for child in self.children]
+            if any(categories is None for categories in children_categories):
+                return None
+            return frozenset().union(*children_categories)
+        if self.attribute == "all":
+            children_categories = [
+                categories
+                for categories in (child.categories() for child in self.children)
+                if categories is not None
+            ]
+            if not children_categories:
+                return None
+            return frozenset.intersection(*children_categories)
+        # "not", "topic" and "lambda" can match messages in any category
+        return None
+
     @graceful(set())
     def matches(self, msg):
         # Check if we should just aggregate the results of our children.
@@ -348,12 +554,8 @@ class Trigger(AbstractTopLevelComparator):
         if self.children:
             return operators[self.attribute](child.matches(msg) for child in self.children)
         elif self.attribute == "lambda":
-            func = single_argument_lambda_factory(
-                expression=self.expected_value,
-                name="message",
-            )
             try:
-                return func(message=msg)
+                return self._func(message=msg)
             except KeyError as e:
                 log.debug("Could not check the trigger. KeyError: %s", e)
                 # The message body wasn't what we expected: no match
@@ -430,10 +632,16 @@ class DatanommerCounter(AbstractChild):
             )
         elif self._d["operation"] != "count":
             raise ValueError("Datanommer operations are either 'count' or a lambda")
+        self._operation_hash = json_hash(self._d["operation"])
 
         top_parent = self.get_top_parent()
         self.fasjson = getattr(top_parent, "fasjson", None)
 
+    @property
+    def is_windowed(self):
+        """Whether the query only counts the messages of a time window."""
+        return "start" in self._d["filter"] or "end" in self._d["filter"]
+
     def _build_filter_getters(self):
         _getter_arguments = ("message", "recipient")
         _getters = {}
@@ -453,7 +661,45 @@ class DatanommerCounter(AbstractChild):
         return total, pages, query
 
     def _get_start(self, search_kwargs):
-        # This is an optimization: don't search before the user was created
+        # This is an optimization: don't search before the first message that could match. The
+        # filters are ANDed, so the latest of their bounds applies.
+        bounds = [
+            self._get_users_start(search_kwargs),
+            self._get_first_seen_start("topics", search_kwargs),
+            self._get_first_seen_start("categories", search_kwargs),
+        ]
+        return max((to_naive_utc(bound) for bound in bounds if bound is not None), default=None)
+
+    def _add_time_bounds(self, search_kwargs):
+        if "start" in search_kwargs:
+            return
+        start = self._get_start(search_kwargs)
+        if start is None:
+            return
+        # The datanommer timestamps are naive, in UTC
+        search_kwargs["start"] = to_naive_utc(start)
+        if "end" not in search_kwargs:
+            search_kwargs["end"] = to_naive_utc(datetime.datetime.now(tz=datetime.timezone.utc))
+
+    def _get_first_seen_start(self, kind, search_kwargs):
+        values = search_kwargs.get(kind)
+        if not values or not isinstance(values, list):
+            return None
+        first_seen = get_first_seen(kind, values, functools.partial(self._query_first_seen, kind))
+        # Use the earliest of them because they are ORed. Values never seen have no messages.
+        return min((value for value in first_seen.values() if value is not None), default=None)
+
+    def _query_first_seen(self, kind, values):
+        log.debug("Getting the first-seen time of %s: %r", kind, values)
+        Message = datanommer.models.Message
+        column = {"topics": Message.topic, "categories": Message.category}[kind]
+        query = (
+            select(column, func.min(Message.timestamp)).where(column.in_(values)).group_by(column)
+        )
+        return dict(datanommer.models.session.execute(query).all())
+
+    def _get_users_start(self, search_kwargs):
+        # Don't search before the user was created
         if self.fasjson is None:
             return None
 
@@ -461,16 +707,9 @@ class DatanommerCounter(AbstractChild):
         if not any(arg in search_kwargs for arg in user_related_args):
             return None
 
-        def _get_user_creation_time(username):
-            log.debug("Getting creation time for: %r", username)
-            user = self.fasjson.get_user(username)
-            if user is None:
-                return None
-            return datetime.datetime.fromisoformat(user["creation"])
-
         start = None
         for username in chain(*[search_kwargs.get(arg, []) for arg in user_related_args]):
-            user_creation_time = _get_user_creation_time(username)
+            user_creation_time = self.fasjson.get_user_creation_time(username)
             if user_creation_time is None:
                 continue
             # start looking the day before, to avoid messing up with timezones
@@ -483,25 +722,82 @@ class DatanommerCounter(AbstractChild):
     def _query_with_operation(
         self, message: Message, search_kwargs: dict[str, int | str | list[str]]
     ):
-        if "start" not in search_kwargs:
-            start = self._get_start(search_kwargs)
-            if start is not None:
-                search_kwargs["start"] = start
-                if "end" not in search_kwargs:
-                    # user creation time is naive, let's keep the end dt naive as well
-                    # also, the datanommer column is currently naive, so, let's be consistent
-                    search_kwargs["end"] = datetime.datetime.now()
-
-        total, _pages, query = self._make_query(search_kwargs)
         if self._d["operation"] == "count":
-            return total
-        elif isinstance(self._d["operation"], dict):
+            # Try the in-process index, then the aggregates table
+            if recent_messages.can_answer(search_kwargs):
+                return recent_messages.count(**search_kwargs)
+            if aggregates.can_answer(search_kwargs):
+                return aggregates.count(**search_kwargs)
+
+        # The first-seen lookup is a datanommer query too, it gets the same budget
+        with statement_timeout(datanommer.models.session):
+            self._add_time_bounds(search_kwargs)
+            total, _pages, query = self._make_query(search_kwargs)
+            if self._d["operation"] == "count":
+                return total
             query_results = datanommer.models.session.scalars(query).all()
+        try:
+            return self._operation_func(message=message, results=query_results)
+        except KeyError as e:
+            log.debug("Could not run the lambda. KeyError: %s", e)
+            return 0
+
+    def count_grouped(self, items):
+        """Count the messages of several candidates in a single query, if possible.
+
+        That's the case when the operation is a count and the candidate is the only user in the
+        filter, the rest of the filter being the same for all of them.
+
+        Arguments:
+            items: a list of ``(message, candidate)`` pairs
+
+        Returns:
+            The counts by candidate, or ``None`` if they can't be counted in a single query.
+        """
+        if self._d["operation"] != "count" or not items:
+            return None
+        common = None
+        for msg, candidate in items:
             try:
-                return self._operation_func(message=message, results=query_results)
-            except KeyError as e:
-                log.debug("Could not run the lambda. KeyError: %s", e)
-                return 0
+                search_kwargs = {
+                    search_key: getter(message=msg, recipient=candidate)
+                    for search_key, getter in self._filter_getters.items()
+                }
+            except KeyError:
+                return None
+            if search_kwargs.pop("users", None) != [candidate]:
+                return None
+            if common is None:
+                common = search_kwargs
+            elif search_kwargs != common:
+                return None
+        if not set(common).issubset(GROUPABLE_FILTERS):
+            return None
+        search_kwargs = {**common, "users": [candidate for _msg, candidate in items]}
+        Message = datanommer.models.Message
+        users_messages = datanommer.models.users_assoc_table
+        User = datanommer.models.User
+        with statement_timeout(datanommer.models.session):
+            # The earliest bound of the candidates applies
+            self._add_time_bounds(search_kwargs)
+            users = search_kwargs.pop("users")
+            query = (
+                select(User.name, func.count())
+                .select_from(Message)
+                .join(
+                    users_messages,
+                    (users_messages.c.msg_id == Message.id)
+                    & (users_messages.c.msg_timestamp == Message.timestamp),
+                )
+                .join(User, User.id == users_messages.c.user_id)
+                .where(User.name.in_(users))
+                .group_by(User.name)
+            )
+            where = Message.make_query(**search_kwargs).whereclause
+            if where is not None:
+                query = query.where(where)
+            counts = dict(datanommer.models.session.execute(query).all())
+        return {candidate: counts.get(candidate, 0) for _msg, candidate in items}
 
     def count(self, msg: Message, candidate: str):
         try:
@@ -512,8 +808,13 @@ class DatanommerCounter(AbstractChild):
         except KeyError as e:
             log.debug("Could not compute the search kwargs. KeyError: %s", e)
             return 0
-        # Cache for other rules analyzing this message
-        cache_key = f"{msg.id}|{json_hash(search_kwargs)}|{json_hash(self._d['operation'])}"
-        return cache.get_or_create(
-            cache_key, self._query_with_operation, creator_args=((msg, search_kwargs), {})
+        # Remember it for other rules analyzing this message
+        memo = get_message_memo(msg.id)
+        if memo is None:
+            return self._query_with_operation(msg, search_kwargs)
+        return memo.get_or_create(
+            (json_hash(search_kwargs), self._operation_hash),
+            self._query_with_operation,
+            msg,
+            search_kwargs,
         )
@@ -1,15 +1,123 @@
 import datetime
+import hashlib
+import json
 import logging
+import multiprocessing
 import os
 import subprocess
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 import yaml
 
 import fedbadges.rules
+from fedbadges.utils import get_fedbadges_version
 
 
 log = logging.getLogger(__name__)
 
+# Bump this when the format of the rules cache changes
+RULES_CACHE_FORMAT = 1
+# Parse the rule files in parallel when there are at least that many to parse
+DEFAULT_YAML_PARALLEL_THRESHOLD = 200
+# Warn about rule files that take longer than that to parse
+SLOW_PARSE_TIME = 0.5  # seconds
+
+# Use libyaml if it is available, it is much faster
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def find_git_dir(directory):
+    """Find the git directory of the repository that contains this directory.
+
+    Returns:
+        The paths of the git directory (where ``HEAD`` is) and of the common directory (where the
+        refs are, it is different for worktrees), or ``None`` if it can't be found.
+    """
+    directory = os.path.abspath(directory)
+    while True:
+        dot_git = os.path.join(directory, ".git")
+        if os.path.isdir(dot_git):
+            git_dir = dot_git
+            break
+        if os.path.isfile(dot_git):
+            # Worktrees and submodules: the file points to the actual git directory
+            try:
+                with open(dot_git) as f:
+                    content = f.read().strip()
+            except OSError:
+                return None
+            if not content.startswith("gitdir:"):
+                return None
+            git_dir = os.path.join(directory, content[len("gitdir:") :].strip())
+            break
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+    common_dir = git_dir
+    try:
+        with open(os.path.join(git_dir, "commondir")) as f:
+            common_dir = os.path.join(git_dir, f.read().strip())
+    except FileNotFoundError:
+        pass
+    except OSError:
+        return None
+    return os.path.normpath(git_dir), os.path.normpath(common_dir)
+
+
+def read_head_commit(git_dir, common_dir):
+    """Read the commit that HEAD points to, without running git.
+
+    Returns:
+        The commit hash, or ``None`` if it can't be read (the caller should then ask git).
+    """
+    try:
+        with open(os.path.join(git_dir, "HEAD")) as f:
+            head = f.read().strip()
+    except OSError:
+        return None
+    if not head.startswith("ref:"):
+        # Detached HEAD
+        return head or None
+    ref = head[len("ref:") :].strip()
+    # Loose refs win over packed refs
+    for base_dir in (git_dir, common_dir):
+        try:
+            with open(os.path.join(base_dir, ref)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            continue
+        except OSError:
+            return None
+    try:
+        with open(os.path.join(common_dir, "packed-refs")) as f:
+            for line in f:
+                if line.startswith(("#", "^")):
+                    continue
+                commit, _sep, name = line.strip().partition(" ")
+                if name == ref:
+                    return commit
+    except OSError:
+        return None
+    return None
+
+
+def parse_yaml(content):
+    """Parse the content of a rule file. This can be run in another process.
+
+    Returns:
+        The parsed content or ``None``, the error as a string or ``None``, and the time it took.
+    """
+    start = time.perf_counter()
+    try:
+        result = yaml.load(content, Loader=SafeLoader)  # noqa: S506
+    except Exception as e:
+        return None, repr(e), time.perf_counter() - start
+    return result, None, time.perf_counter() - start
+
 
 class RulesRepo:
 
@@ -19,12 +127,28 @@ class RulesRepo:
         self.fasjson = fasjson
         self.directory = os.path.abspath(self.config["badges_repo"])
         self._last_rules_load = None
-        self.rules = []
+        self._last_head = None
+        self._git_dirs = find_git_dir(self.directory)
+        self._marked_safe = False
+        self.rules = fedbadges.rules.RuleSet()
+        # The rules built from each file: {path: (content hash, [BadgeRule])}
+        self._files = {}
+        # The result of the last load, until it is accepted: (rules, files, head, load time)
+        self._pending = None
+        self._cache_path = self.config.get("rules_cache")
 
     def setup(self):
-        self._mark_safe()
+        if self._git_dirs is None:
+            log.warning(
+                "%s is not in a git repository, the rules will be reloaded every time",
+                self.directory,
+            )
 
     def _mark_safe(self):
+        # Only needed when running git, so it's done the first time we have to.
+        if self._marked_safe:
+            return
+        self._marked_safe = True
         result = subprocess.run(
             ["/usr/bin/git", "config", "--get-all", "safe.directory"],  # noqa: S603
             text=True,
@@ -51,63 +175,277 @@ class RulesRepo:
                 check=True,
             )
 
-    def load_all(self, tahrir_client, force=False):
+    def load_all(self, tahrir_client, force=False, accept=True):
+        """Load the rules if the repo has changed.
+
+        Arguments:
+            tahrir_client (tahrir_api.dbapi.TahrirDatabase): the tahrir client
+            force: load the rules even if the repo has not changed
+            accept: use the loaded rules right away. Otherwise they are only used once they are
+                passed to :meth:`accept`, and the same commit will be loaded again until then.
+
+        Returns:
+            The loaded :class:`fedbadges.rules.RuleSet`, or the current one if nothing changed.
+        """
         if force or self._needs_update():
-            self.rules = self._load_all(tahrir_client)
+            load_time = datetime.datetime.now(tz=datetime.timezone.utc)
+            head = self._get_head_commit()
+            files, complete = self._load_all(tahrir_client)
+            if not complete:
+                # Some badges could not be registered: don't remember the commit, so that the
+                # next reload tries them again even if the repo hasn't changed.
+                head = None
+            rule_set = fedbadges.rules.RuleSet(
+                [rule for _content_hash, rules in files.values() for rule in rules]
+            )
+            self._pending = (rule_set, files, head, load_time)
+            if not accept:
+                return rule_set
+            self.accept(rule_set)
         return self.rules
 
+    def accept(self, rule_set):
+        """Use the rules returned by :meth:`load_all`, and remember what they were loaded from."""
+        if self._pending is None or self._pending[0] is not rule_set:
+            raise ValueError("This rule set was not the last one loaded")
+        rule_set, files, head, load_time = self._pending
+        self._pending = None
+        if files != self._files:
+            self._write_cache(files)
+        self._files = files
+        self._last_head = head
+        self._last_rules_load = load_time
+        self.rules = rule_set
+
+    def cached_definitions(self):
+        """Return the definitions of the rules the previous run used, from the rules cache."""
+        return [
+            cached_rule["definition"]
+            for cached_file in self._read_cache().values()
+            for cached_rule in cached_file["rules"]
+        ]
+
+    def cached_rules(self):
+        """Build the rules the previous run used, from the rules cache."""
+        badge_rules = []
+        for fname, cached_file in self._read_cache().items():
+            badge_rules.extend(self._build_rules_from_cache(fname, cached_file["rules"]) or [])
+        return fedbadges.rules.RuleSet(badge_rules)
+
     def _load_all(self, tahrir_client):
-        self._last_rules_load = datetime.datetime.now(tz=datetime.timezone.utc)
+        start = time.perf_counter()
         rules_dir = os.path.join(self.directory, "rules")
-        # badges indexed by trigger
-        badges = []
         log.info("Looking in %r to load badge definitions", rules_dir)
-        for root, _dirs, files in os.walk(rules_dir):
-            for partial_fname in files:
+        # On the first load, start from what the previous run has compiled and registered
+        cached_files = self._read_cache() if not self._files else {}
+        files = {}
+        changed = []
+        to_parse = []
+        from_cache = 0
+        for root, _dirs, filenames in os.walk(rules_dir):
+            for partial_fname in filenames:
                 fname = root + "/" + partial_fname
-                badge = self._load_badge_from_yaml(fname)
-
-                if not badge:
+                content = self._read_file(fname)
+                if content is None:
                     continue
+                content_hash = hashlib.sha256(content).hexdigest()
+                previous = self._files.get(fname)
+                if previous is not None and previous[0] == content_hash:
+                    # Unchanged, keep the compiled rules and their badge ids
+                    files[fname] = previous
+                    continue
+                cached = cached_files.get(fname)
+                if cached is not None and cached["hash"] == content_hash:
+                    badge_rules = self._build_rules_from_cache(fname, cached["rules"])
+                    if badge_rules is not None:
+                        files[fname] = (content_hash, badge_rules)
+                        from_cache += 1
+                        continue
+                to_parse.append((fname, content))
+                # Keep the files order
+                files[fname] = (content_hash, None)
+
+        for fname, badge in self._parse_files(to_parse).items():
+            badge_rules = self._build_rules(fname, badge)
+            changed.extend(badge_rules)
+            files[fname] = (files[fname][0], badge_rules)
+
+        removed = set(self._files) - set(files)
+        modified = len([fname for fname in files if files[fname] is not self._files.get(fname)])
+        modified -= from_cache
+        # Register the badges of the new or modified rules in one go
+        registered = fedbadges.rules.register_badges(tahrir_client, changed)
+        complete = len(registered) == len(changed)
+        if not complete:
+            # Forget about the files whose badge could not be registered, so that they are
+            # processed again on the next reload.
+            failed_ids = {id(rule) for rule in changed} - {id(rule) for rule in registered}
+            files = {
+                fname: (content_hash, rules)
+                for fname, (content_hash, rules) in files.items()
+                if not any(id(rule) in failed_ids for rule in rules)
+            }
+
+        log.info(
+            "Loaded %s total badge definitions in %.2f seconds "
+            "(%s files added or modified, %s from the cache, %s removed)",
+            sum(len(rules) for _content_hash, rules in files.values()),
+            time.perf_counter() - start,
+            modified,
+            from_cache,
+            len(removed),
+        )
+        return files, complete
 
-                try:
-                    badge_rule = fedbadges.rules.BadgeRule(
-                        badge, self.issuer_id, self.config, self.fasjson
+    def _read_file(self, fname):
+        try:
+            with open(fname, "rb") as f:
+                return f.read()
+        except OSError as e:
+            log.error("Reading %r failed with %r", fname, e)
+            return None
+
+    def _parse_files(self, contents):
+        threshold = self.config.get("yaml_parallel_threshold", DEFAULT_YAML_PARALLEL_THRESHOLD)
+        if len(contents) < threshold:
+            return self._parse_files_serially(contents)
+        log.debug("Parsing %s rule files in parallel", len(contents))
+        try:
+            # Don't fork, the consumer is running threads.
+            with ProcessPoolExecutor(
+                max_workers=self.config.get("yaml_parallel_workers"),
+                mp_context=multiprocessing.get_context("forkserver"),
+            ) as executor:
+                results = list(
+                    executor.map(
+                        parse_yaml, [content for _fname, content in contents], chunksize=16
                     )
-                    badge_rule.setup(tahrir_client)
-                    badges.append(badge_rule)
-                except ValueError as e:
-                    log.error("Initializing rule for %r failed with %r", fname, e)
+                )
+        except (OSError, BrokenProcessPool) as e:
+            log.warning("Could not parse the rule files in parallel: %r", e)
+            return self._parse_files_serially(contents)
+        return {
+            fname: self._check_parsed(fname, len(content), *result)
+            for (fname, content), result in zip(contents, results, strict=True)
+        }
 
-        log.info("Loaded %s total badge definitions", len(badges))
-        return badges
+    def _parse_files_serially(self, contents):
+        return {fname: self._load_badge_from_yaml(fname, content) for fname, content in contents}
 
-    def _load_badge_from_yaml(self, fname):
-        log.debug(f"Loading {fname!r}")
+    def _build_rules(self, fname, badge):
+        if not badge:
+            return []
+        try:
+            return [fedbadges.rules.BadgeRule(badge, self.issuer_id, self.config, self.fasjson)]
+        except ValueError as e:
+            log.error("Initializing rule for %r failed with %r", fname, e)
+            return []
+
+    def _build_rules_from_cache(self, fname, cached_rules):
         try:
-            with open(fname) as f:
-                return yaml.safe_load(f.read())
-        except Exception as e:
-            log.error("Loading %r failed with %r", fname, e)
+            badge_rules = []
+            for cached_rule in cached_rules:
+                rule = fedbadges.rules.BadgeRule(
+                    cached_rule["definition"], self.issuer_id, self.config, self.fasjson
+                )
+                rule._set_badge_id(cached_rule["badge_id"])
+                badge_rules.append(rule)
+        except (KeyError, TypeError, ValueError) as e:
+            log.warning("Could not use the cached rules for %r: %r", fname, e)
             return None
+        return badge_rules
 
-    def _needs_update(self):
-        if self._last_rules_load is None:
-            return True
+    # The rules cache: the validated definitions and the badge ids of the rules, by file. It
+    # is only valid for the same version of fedbadges and the same tahrir database.
+
+    def _get_cache_key(self):
+        database_uri = self.config.get("database_uri", "")
+        return {
+            "format": RULES_CACHE_FORMAT,
+            "version": get_fedbadges_version(),
+            "issuer_id": self.issuer_id,
+            "database": hashlib.sha256(database_uri.encode("utf-8")).hexdigest(),
+        }
+
+    def _read_cache(self):
+        if not self._cache_path or not os.path.exists(self._cache_path):
+            return {}
+        try:
+            with open(self._cache_path, "rb") as f:
+                cache = json.loads(zlib.decompress(f.read()))
+        except (OSError, ValueError, zlib.error) as e:
+            log.warning("Could not read the rules cache %r: %r", self._cache_path, e)
+            return {}
+        if cache.get("key") != self._get_cache_key():
+            log.info("The rules cache %r is outdated, ignoring it", self._cache_path)
+            return {}
+        return cache.get("files", {})
+
+    def _write_cache(self, files):
+        if not self._cache_path:
+            return
+        cache = {
+            "key": self._get_cache_key(),
+            "files": {
+                fname: {
+                    "hash": content_hash,
+                    "rules": [
+                        {
+                            "badge_id": rule.badge_id,
+                            "definition": {
+                                key: value for key, value in rule._d.items() if key != "badge_id"
+                            },
+                        }
+                        for rule in badge_rules
+                    ],
+                }
+                for fname, (content_hash, badge_rules) in files.items()
+            },
+        }
+        tmp_path = f"{self._cache_path}.tmp"
+        try:
+            serialized = zlib.compress(json.dumps(cache, separators=(",", ":")).encode("utf-8"))
+            with open(tmp_path, "wb") as f:
+                f.write(serialized)
+            os.replace(tmp_path, self._cache_path)
+        except (OSError, TypeError, ValueError) as e:
+            log.warning("Could not write the rules cache %r: %r", self._cache_path, e)
+
+    def _load_badge_from_yaml(self, fname, content):
+        log.debug(f"Loading {fname!r}")
+        return self._check_parsed(fname, len(content), *parse_yaml(content))
+
+    def _check_parsed(self, fname, size, badge, error, duration):
+        if error is not None:
+            log.error("Loading %r failed with %s", fname, error)
+            return None
+        if duration > SLOW_PARSE_TIME:
+            log.warning("Parsing %r (%s bytes) took %.2f seconds", fname, size, duration)
+        else:
+            log.debug("Parsed %r (%s bytes) in %.3f seconds", fname, size, duration)
+        return badge
+
+    def _get_head_commit(self):
+        if self._git_dirs is None:
+            return None
+        commit = read_head_commit(*self._git_dirs)
+        if commit is not None:
+            return commit
+        # Can't read the refs (unknown storage format, etc): ask git.
+        self._mark_safe()
         result = subprocess.run(
-            [  # noqa: S603
-                "/usr/bin/git",
-                "-C",
-                self.directory,
-                "log",
-                "-1",
-                r"--pretty=format:%aI",
-            ],
-            check=True,
+            ["/usr/bin/git", "-C", self.directory, "rev-parse", "HEAD"],  # noqa: S603
             stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
             text=True,
         )
-        last_commit_time = datetime.datetime.fromisoformat(result.stdout.strip())
-        if last_commit_time.tzinfo is None:
-            last_commit_time = last_commit_time.replace(tzinfo=datetime.timezone.utc)
-        return last_commit_time > self._last_rules_load
+        if result.returncode != 0:
+            return None
+        return result.stdout.strip()
+
+    def _needs_update(self):
+        if self._last_rules_load is None:
+            return True
+        head = self._get_head_commit()
+        # Without a commit to compare to, reload: unchanged files won't be parsed again anyway.
+        return head is None or head != self._last_head
@@ -0,0 +1,108 @@
+""" Keep the in-process caches warm across restarts.
+
+The consumer writes a snapshot of its in-process caches to a local file at intervals and when it
+shuts down, and loads it back when it starts. The snapshot is ignored if it was written by another
+version of fedbadges or if it is too old.
+"""
+
+import logging
+import os
+import pickle
+import threading
+import time
+
+from .utils import get_fedbadges_version
+
+
+log = logging.getLogger(__name__)
+
+# Bump this when the format of the snapshot changes
+SNAPSHOT_FORMAT = 1
+DEFAULT_SNAPSHOT_INTERVAL = 10  # in minutes
+DEFAULT_SNAPSHOT_MAX_AGE = 3600  # seconds
+
+
+class Snapshot:
+    """Save and restore the content of in-process caches.
+
+    Each cache is registered with a function returning its picklable content (or ``None`` if
+    there's nothing to save), and a function loading that content back.
+    """
+
+    def __init__(self, path: str, max_age: float = DEFAULT_SNAPSHOT_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self._sources = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, dump, load):
+        self._sources[name] = (dump, load)
+
+    def save(self):
+        start = time.perf_counter()
+        data = {}
+        for name, (dump, _load) in self._sources.items():
+            try:
+                content = dump()
+            except Exception:
+                log.exception("Could not snapshot %s", name)
+                continue
+            if content is not None:
+                data[name] = content
+        snapshot = {
+            "format": SNAPSHOT_FORMAT,
+            "version": get_fedbadges_version(),
+            "created": time.time(),
+            "data": data,
+        }
+        tmp_path = f"{self.path}.tmp"
+        with self._lock:
+            try:
+                with open(tmp_path, "wb") as f:
+                    pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, self.path)
+            except (OSError, pickle.PicklingError) as e:
+                log.warning("Could not write the snapshot to %s: %r", self.path, e)
+                return
+        log.debug(
+            "Wrote a snapshot of %s in %.2f seconds", ", ".join(data), time.perf_counter() - start
+        )
+
+    def restore(self):
+        """Load the snapshot into the registered caches.
+
+        Returns:
+            The names of the caches that were restored.
+        """
+        try:
+            with open(self.path, "rb") as f:
+                # We wrote this file ourselves
+                snapshot = pickle.load(f)  # noqa: S301
+        except FileNotFoundError:
+            return []
+        except Exception as e:
+            log.warning("Could not read the snapshot from %s: %r", self.path, e)
+            return []
+        if not isinstance(snapshot, dict) or snapshot.get("format") != SNAPSHOT_FORMAT:
+            log.info("Ignoring the snapshot in %s: unknown format", self.path)
+            return []
+        if snapshot.get("version") != get_fedbadges_version():
+            log.info("Ignoring the snapshot in %s: written by another version", self.path)
+            return []
+        age = time.time() - snapshot.get("created", 0)
+        if age > self.max_age:
+            log.info("Ignoring the snapshot in %s: too old (%d seconds)", self.path, age)
+            return []
+        restored = []
+        for name, content in snapshot.get("data", {}).items():
+            if name not in self._sources:
+                continue
+            try:
+                self._sources[name][1](content)
+            except Exception:
+                log.exception("Could not restore %s from the snapshot", name)
+                continue
+            restored.append(name)
+        if restored:
+            log.info("Restored %s from the snapshot (%d seconds old)", ", ".join(restored), age)
+        return restored
@@ -4,6 +4,7 @@
 # for compiling lambda expressions
 import datetime
 import hashlib
+import importlib.metadata
 import json
 import logging
 import re
@@ -24,12 +25,20 @@ from twisted.internet import reactor, threads
 log = logging.getLogger(__name__)
 
 
+def get_fedbadges_version():
+    try:
+        return importlib.metadata.version("fedbadges")
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
 def lambda_factory(expression: str, args: tuple[str] = ("value",)):
     """Compile a lambda expression with a list of arguments"""
 
     code = compile(f"lambda {', '.join(args)}: {expression}", __file__, "eval")
     lambda_globals = {
         "__builtins__": __builtins__,
+        "datetime": datetime,
         "json": json,
         "re": re,
     }
@@ -70,7 +79,8 @@ def list_of_lambdas(
 
 
 def json_hash(d):
-    str_repr = json.dumps(d, sort_keys=True)
+    # The values computed by lambdas may be datetimes
+    str_repr = json.dumps(d, sort_keys=True, default=str)
     return hashlib.md5(str_repr.encode("utf-8")).hexdigest()  # noqa: S324
 
 
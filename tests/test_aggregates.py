@@ -0,0 +1,66 @@
+from unittest.mock import Mock, patch
+
+import pytest
+from fedora_messaging.message import Message
+
+import fedbadges.rules
+from fedbadges.aggregates import ActivityAggregates, get_category
+from fedbadges.db import SessionProvider
+
+
+@pytest.fixture()
+def activity(tmp_path):
+    aggregates = ActivityAggregates(state_check_interval=0)
+    aggregates.configure(SessionProvider.from_config(f"sqlite:///{tmp_path.as_posix()}/agg.db"))
+    return aggregates
+
+
+def _message(topic, users):
+    message = Mock(name="message", topic=topic, usernames=users)
+    message._properties.headers = Message(topic=topic)._properties.headers
+    return message
+
+
+def test_get_category():
+    assert get_category("org.fedoraproject.prod.bodhi.update.comment") == "bodhi"
+    assert get_category("/topic/VirtualTopic.eg.koji.build") == "koji"
+    assert get_category("nothing") == "Unclassified"
+
+
+def test_record_and_count(activity):
+    activity.record(_message("org.fedoraproject.prod.bodhi.update.comment", ["alice", "bob"]))
+    activity.record(_message("org.fedoraproject.prod.bodhi.update.comment", ["alice"]))
+    activity.record(_message("org.fedoraproject.prod.koji.build.state.change", ["alice"]))
+    assert activity.count(["alice"]) == 3
+    assert activity.count(["alice"], categories=["bodhi"]) == 2
+    assert activity.count(["alice"], topics=["org.fedoraproject.prod.koji.build.state.change"]) == 1
+    assert activity.count(["bob"]) == 1
+    assert activity.count(["carol"]) == 0
+
+
+def test_can_answer(activity):
+    # Not backfilled yet
+    assert not activity.can_answer({"users": ["alice"]})
+    activity.mark_complete()
+    assert activity.can_answer({"users": ["alice"], "categories": ["bodhi"]})
+    assert not activity.can_answer({"users": ["alice", "bob"]})
+    assert not activity.can_answer({"categories": ["bodhi"]})
+    assert not activity.can_answer({"users": ["alice"], "packages": ["foo"]})
+
+
+def test_datanommer_counter_uses_aggregates(activity):
+    activity.mark_complete()
+    activity.record(_message("org.fedoraproject.prod.bodhi.update.comment", ["alice"]))
+    counter = fedbadges.rules.DatanommerCounter(
+        {
+            "filter": {"users": ["recipient"], "categories": ["'bodhi'"]},
+            "operation": "count",
+        }
+    )
+    message = Message(topic="org.fedoraproject.prod.bodhi.update.comment")
+    with (
+        patch("fedbadges.rules.aggregates", activity),
+        patch("datanommer.models.Message.grep") as grep,
+    ):
+        assert counter.count(message, "alice") == 1
+    grep.assert_not_called()
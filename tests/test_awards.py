@@ -0,0 +1,72 @@
+from tahrir_api.model import Person
+
+from fedbadges.awards import Award, AwardWriter
+
+
+def _add_badge(tahrir_client, name="Test badge"):
+    badge_id = tahrir_client.add_badge(
+        name=name, image="http://example.com/badge.png", desc="desc", criteria="crit", issuer_id=1
+    )
+    tahrir_client.session.commit()
+    return badge_id
+
+
+def test_award_writer(tahrir_client, notification_callback_mock):
+    badge_id = _add_badge(tahrir_client)
+    writer = AwardWriter()
+    added = writer.write(
+        tahrir_client,
+        [
+            Award("alice", badge_id, "http://example.com/msg"),
+            Award("bob", badge_id),
+            # Duplicate
+            Award("alice", badge_id, "http://example.com/msg"),
+            # No such badge
+            Award("carol", "does-not-exist"),
+        ],
+    )
+    assert added == [Award("alice", badge_id, "http://example.com/msg"), Award("bob", badge_id)]
+    assert tahrir_client.assertion_exists(badge_id, "alice@fedoraproject.org")
+    assert tahrir_client.assertion_exists(badge_id, "bob@fedoraproject.org")
+    assert notification_callback_mock.call_count == 2
+    body = notification_callback_mock.call_args_list[0][0][0].body
+    assert body["badge"]["badge_id"] == badge_id
+    assert body["user"]["username"] == "alice"
+
+
+def test_award_writer_existing(tahrir_client, notification_callback_mock):
+    badge_id = _add_badge(tahrir_client)
+    tahrir_client.add_person("alice@fedoraproject.org", nickname="alice2")
+    tahrir_client.add_assertion(badge_id, "alice@fedoraproject.org", None)
+    tahrir_client.session.commit()
+    notification_callback_mock.reset_mock()
+
+    writer = AwardWriter()
+    added = writer.write(tahrir_client, [Award("alice", badge_id), Award("bob", badge_id)])
+    assert added == [Award("bob", badge_id)]
+    notification_callback_mock.assert_called_once()
+    # The persons are remembered
+    assert set(writer._known_persons) == {"alice@fedoraproject.org", "bob@fedoraproject.org"}
+    assert writer._known_persons["alice@fedoraproject.org"][1] == "alice2"
+
+
+def test_award_writer_known_persons_size(tahrir_client):
+    badge_id = _add_badge(tahrir_client)
+    writer = AwardWriter(known_persons_size=1)
+    writer.write(tahrir_client, [Award("alice", badge_id), Award("bob", badge_id)])
+    assert len(writer._known_persons) == 1
+
+
+def test_award_writer_email_case(tahrir_client):
+    badge_id = _add_badge(tahrir_client)
+    # Tahrir compares the emails in lower case
+    tahrir_client.add_person("Alice@fedoraproject.org", nickname="alice")
+    tahrir_client.session.commit()
+
+    writer = AwardWriter()
+    assert writer.write(tahrir_client, [Award("alice", badge_id)]) == [Award("alice", badge_id)]
+    # No duplicate person was created
+    assert tahrir_client.session.query(Person).count() == 1
+    assert list(writer._known_persons) == ["alice@fedoraproject.org"]
+    assert writer.write(tahrir_client, [Award("ALICE", badge_id)]) == []
+    assert tahrir_client.session.query(Person).count() == 1
@@ -0,0 +1,310 @@
+import os
+import pickle
+import time
+from unittest.mock import Mock, patch
+
+from dogpile.cache import make_region, register_backend
+from dogpile.cache.api import BytesBackend, NO_VALUE
+from dogpile.cache.backends.memcached import PyMemcacheBackend
+from dogpile.cache.backends.redis import RedisBackend
+
+from fedbadges.cached import (
+    BoundedMemoryBackend,
+    cache,
+    claim_message,
+    CodecProxy,
+    configure,
+    get_cached_messages_counts,
+    get_counter_versions,
+    get_messages_counts,
+    is_message_processed,
+    record_counter_versions,
+    set_messages_counts,
+    SharedInvalidationStrategy,
+    TwoTierProxy,
+)
+
+
+def test_bounded_lru():
+    backend = BoundedMemoryBackend({"max_items": 2})
+    backend.set("a", 1)
+    backend.set("b", 2)
+    # Use "a" so that "b" is the least recently used
+    assert backend.get("a") == 1
+    backend.set("c", 3)
+    assert backend.get("b") is NO_VALUE
+    assert backend.get_multi(["a", "c"]) == [1, 3]
+    assert backend.stats()["evictions"] == 1
+
+
+def test_bounded_size():
+    backend = BoundedMemoryBackend({"max_size": 1000})
+    backend.set_multi({f"key-{i}": "x" * 100 for i in range(20)})
+    stats = backend.stats()
+    assert stats["size"] <= 1000
+    assert 0 < stats["items"] < 20
+    # Too large to be stored at all
+    backend.set("large", "x" * 2000)
+    assert backend.get("large") is NO_VALUE
+    assert backend.stats()["too_large"] == 1
+
+
+def test_bounded_family_limits():
+    backend = BoundedMemoryBackend({"family_limits": {"datanommer_count": 2}})
+    for i in range(5):
+        backend.set(f"datanommer_count|{i}", i)
+        backend.set(f"messages_count|{i}", i)
+    assert backend.get("datanommer_count|2") is NO_VALUE
+    assert backend.get("datanommer_count|4") == 4
+    assert backend.get("messages_count|0") == 0
+    stats = backend.stats()
+    assert stats["items"] == 7
+    assert stats["evictions.datanommer_count"] == 3
+
+
+def test_bounded_ttl():
+    backend = BoundedMemoryBackend({"ttl": 0.01})
+    backend.set("a", 1)
+    time.sleep(0.02)
+    assert backend.get("a") is NO_VALUE
+    assert backend.stats()["expirations"] == 1
+    assert backend.stats()["size"] == 0
+
+
+def test_bounded_dump():
+    backend = BoundedMemoryBackend({})
+    backend.set("first_seen|topics|a.b.c", 1)
+    backend.set("messages_count|badge|user", 2)
+    backend.set("processed_message|msg1", True)
+    # The mutable values are not snapshotted
+    assert backend.dump() == {"first_seen|topics|a.b.c": 1}
+    restarted = BoundedMemoryBackend({})
+    restarted.load({"first_seen|topics|a.b.c": 1, "messages_count|badge|user": 2})
+    assert restarted.get("messages_count|badge|user") is NO_VALUE
+    assert restarted.get("first_seen|topics|a.b.c") == 1
+
+
+def test_two_tier():
+    l2 = {}
+    proxy = TwoTierProxy(families=["datanommer_count"])
+    region = make_region().configure(
+        "dogpile.cache.memory", arguments={"cache_dict": l2}, wrap=[proxy]
+    )
+    region.set_multi({"datanommer_count|msg1": 1, "messages_count|badge|user": 2})
+    assert set(l2) == {"datanommer_count|msg1", "messages_count|badge|user"}
+    assert proxy.l1.dump().keys() == {"datanommer_count|msg1"}
+    # Values that are only in the shared tier are fetched in a single call
+    with patch.object(proxy.proxied, "get_multi", wraps=proxy.proxied.get_multi) as get_multi:
+        assert region.get_multi(["datanommer_count|msg1", "messages_count|badge|user"]) == [1, 2]
+    get_multi.assert_called_once_with(["messages_count|badge|user"])
+
+
+def test_shared_invalidation():
+    l2 = {}
+    regions = [make_region(), make_region()]
+    for region in regions:
+        region.configure(
+            "dogpile.cache.memory",
+            arguments={"cache_dict": l2},
+            wrap=[TwoTierProxy(families=["datanommer_count"])],
+            region_invalidator=SharedInvalidationStrategy(region, check_interval=0),
+        )
+    regions[0].set("datanommer_count|msg1", 1)
+    assert regions[1].get("datanommer_count|msg1") == 1
+    time.sleep(0.01)
+    regions[0].invalidate()
+    # The other process sees the invalidation, even for the values it keeps in process
+    assert regions[1].get("datanommer_count|msg1") is NO_VALUE
+
+
+def test_get_cached_messages_counts(cache_configured):
+    previous_count = Mock(side_effect=lambda candidate: 3)
+    with patch.object(cache, "set_multi") as set_multi:
+        counts = get_cached_messages_counts("badge", ["user1", "user2"], previous_count)
+    assert counts == {"user1": 3, "user2": 3}
+    set_multi.assert_called_once_with(
+        {"messages_count|badge|user1": 3, "messages_count|badge|user2": 3}
+    )
+
+
+def test_counter_versions():
+    region = make_region().configure("dogpile.cache.memory")
+    previous_count = Mock(side_effect=lambda candidate: 3)
+    with patch("fedbadges.cached.cache", region):
+        counts = [
+            get_cached_messages_counts("badge", ["user1"], previous_count, version)
+            for version in ("v1", "v1", "v2")
+        ]
+        # A new version of the rule starts a new count
+        assert counts == [{"user1": 3}, {"user1": 4}, {"user1": 3}]
+
+        assert record_counter_versions({"badge": "v1", "other": "v1"}) == {}
+        assert record_counter_versions({"badge": "v2", "other": "v1"}) == {"badge": ("v1", "v2")}
+        assert get_counter_versions() == {"badge": "v2", "other": "v1"}
+
+
+def test_processed_messages_expire():
+    values = {}
+    region = make_region().configure("dogpile.cache.memory", arguments={"cache_dict": values})
+    with patch("fedbadges.cached.cache", region):
+        assert claim_message("msg1", window=0.01)
+        assert is_message_processed("msg1", window=60)
+        assert not claim_message("msg1", window=60)
+        time.sleep(0.02)
+        assert claim_message("msg2", window=0.01)
+        # The memory backend never evicts anything, the old marks are deleted
+        assert list(values) == ["processed_message|msg2"]
+
+
+def test_claim_message_memcached():
+    values = {}
+
+    def add(key, value, expire, noreply):
+        if key in values:
+            return False
+        values[key] = value
+        return True
+
+    client = Mock(name="client")
+    client.get.side_effect = values.get
+    client.add.side_effect = add
+    with patch.object(PyMemcacheBackend, "_create_client", return_value=client):
+        region = make_region().configure(
+            "dogpile.cache.pymemcache", arguments={"url": ["127.0.0.1"]}
+        )
+        with patch("fedbadges.cached.cache", region):
+            assert claim_message("msg1", window=3600)
+            assert not claim_message("msg1", window=3600)
+            assert is_message_processed("msg1", window=3600)
+    # Added only if absent, and expired by the server
+    client.add.assert_called_with("processed_message|msg1", 1, 3600, noreply=False)
+
+
+def test_claim_message_redis():
+    backend = Mock(spec=RedisBackend)
+    backend.writer_client = Mock(name="writer_client")
+    backend.writer_client.set.side_effect = [True, None]
+    region = Mock(name="region", actual_backend=backend, key_mangler=None)
+    with patch("fedbadges.cached.cache", region):
+        assert claim_message("msg1", window=0.5)
+        assert not claim_message("msg1", window=0.5)
+    backend.writer_client.set.assert_called_with("processed_message|msg1", 1, nx=True, ex=1)
+    region.set.assert_not_called()
+
+
+def test_legacy_counters():
+    region = make_region().configure("dogpile.cache.memory")
+    previous_count = Mock(side_effect=lambda candidate: 3)
+    with patch("fedbadges.cached.cache", region):
+        # Counters stored before they were versioned
+        set_messages_counts("badge", {"user1": 10})
+        record_counter_versions({"badge": "v1"})
+        assert get_cached_messages_counts("badge", ["user1", "user2"], previous_count, "v1") == {
+            "user1": 11,
+            "user2": 3,
+        }
+        previous_count.assert_called_once_with("user2")
+        assert get_messages_counts("badge", ["user1"], "v1") == {"user1": 11}
+        # Once the definition changes, they are not used anymore
+        record_counter_versions({"badge": "v2"})
+        assert get_cached_messages_counts("badge", ["user1"], previous_count, "v2") == {"user1": 3}
+
+
+class BytesMemoryBackend(BytesBackend):
+    """A memory backend that stores bytes, like memcached."""
+
+    def __init__(self, arguments):
+        self.values = arguments["cache_dict"]
+        self.serializer = pickle.dumps
+        self.deserializer = pickle.loads
+
+    def get_serialized(self, key):
+        return self.values.get(key, NO_VALUE)
+
+    def get_serialized_multi(self, keys):
+        return [self.values.get(key, NO_VALUE) for key in keys]
+
+    def set_serialized(self, key, value):
+        self.values[key] = value
+
+    def set_serialized_multi(self, mapping):
+        self.values.update(mapping)
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+
+register_backend("tests.bytes_memory", "tests.test_cached", "BytesMemoryBackend")
+
+
+def test_codec():
+    values = {}
+    region = make_region().configure(
+        "tests.bytes_memory",
+        arguments={"cache_dict": values},
+        wrap=[CodecProxy(compress_threshold=100, max_item_size=1000, compression="zlib")],
+    )
+    region.set("small", "x")
+    region.set("large", "x" * 10000)
+    region.set("huge", os.urandom(5000))
+    assert not values["small"].startswith(CodecProxy.MARKER)
+    assert values["large"].startswith(CodecProxy.MARKER + CodecProxy.ZLIB)
+    assert len(values["large"]) < 1000
+    assert values["huge"].startswith(CodecProxy.MARKER + CodecProxy.CHUNKED)
+    assert all(len(value) <= 1000 for value in values.values())
+    assert region.get("small") == "x"
+    assert region.get("large") == "x" * 10000
+    assert len(region.get("huge")) == 5000
+    # A missing chunk is a cache miss
+    chunk_key = next(key for key in values if key.startswith("huge|chunk|"))
+    del values[chunk_key]
+    assert region.get("huge") is NO_VALUE
+
+
+def test_codec_pymemcache():
+    # The memcached backends serialize the values themselves
+    values = {}
+    client = Mock(name="client")
+    client.get.side_effect = values.get
+    client.get_multi.side_effect = lambda keys: {key: values[key] for key in keys if key in values}
+    client.set.side_effect = lambda key, value, **kwargs: values.__setitem__(key, value)
+    client.set_multi.side_effect = lambda mapping, **kwargs: values.update(mapping)
+    with patch.object(PyMemcacheBackend, "_create_client", return_value=client):
+        region = make_region().configure(
+            "dogpile.cache.pymemcache",
+            arguments={"url": ["127.0.0.1"]},
+            wrap=[CodecProxy(compress_threshold=100, max_item_size=1000, compression="zlib")],
+        )
+        region.set("small", "x")
+        region.set("large", "x" * 100000)
+        region.set("huge", os.urandom(5000))
+        region.set_multi({"multi": "y" * 100000})
+        assert not isinstance(values["small"], bytes)
+        assert values["large"].startswith(CodecProxy.MARKER + CodecProxy.ZLIB)
+        assert len(values["large"]) < 1000
+        assert values["multi"].startswith(CodecProxy.MARKER + CodecProxy.ZLIB)
+        assert values["huge"].startswith(CodecProxy.MARKER + CodecProxy.CHUNKED)
+        assert all(len(value) <= 1000 for value in values.values() if isinstance(value, bytes))
+        assert region.get("small") == "x"
+        assert region.get("large") == "x" * 100000
+        assert region.get_multi(["multi", "small"]) == ["y" * 100000, "x"]
+        assert len(region.get("huge")) == 5000
+        # A missing chunk is a cache miss
+        chunk_key = next(key for key in values if key.startswith("huge|chunk|"))
+        del values[chunk_key]
+        assert region.get("huge") is NO_VALUE
+
+
+def test_codec_only_for_remote_backends():
+    values = {}
+    with patch("fedbadges.cached.cache", make_region()) as region:
+        configure(backend="dogpile.cache.memory", arguments={"cache_dict": values})
+        unpicklable = lambda: None  # noqa: E731
+        region.set("key", unpicklable)
+        # Stored as it is
+        assert values["key"].payload is unpicklable
+        assert region.get("key") is unpicklable
+        assert not isinstance(region.backend, CodecProxy)
+    with patch("fedbadges.cached.cache", make_region()) as region:
+        configure(backend="tests.bytes_memory", arguments={"cache_dict": {}})
+        assert isinstance(region.backend, CodecProxy)
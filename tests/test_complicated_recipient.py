@@ -1,10 +1,9 @@
 from types import SimpleNamespace
-from unittest.mock import patch
 
 import pytest
 from fedora_messaging.message import Message
 
-from .utils import get_rule
+from .utils import get_rule, patch_messages_count
 
 
 class MockQuery:
@@ -18,8 +17,7 @@ def user_exists(fasjson_client):
 
 @pytest.fixture
 def above_threshold():
-    with patch("fedbadges.rules.get_cached_messages_count") as get_cached_messages_count:
-        get_cached_messages_count.return_value = float("inf")
+    with patch_messages_count(float("inf")):
         yield
 
 
@@ -1,11 +1,11 @@
 import logging
 from types import SimpleNamespace
-from unittest.mock import Mock, patch
+from unittest.mock import Mock
 
 import pytest
 from fedora_messaging.message import Message
 
-from .utils import get_rule
+from .utils import get_rule, patch_messages_count
 
 
 @pytest.fixture
@@ -69,6 +69,5 @@ def test_complicated_trigger_against_full_match(rule, message, tahrir_client, fa
             return float("inf")  # Master tagger
 
     fasjson_client.get_user.return_value = SimpleNamespace(result={"username": "dummy-user"})
-    with patch("fedbadges.rules.get_cached_messages_count") as get_cached_messages_count:
-        get_cached_messages_count.return_value = float("inf")
+    with patch_messages_count(float("inf")):
         assert rule.matches(message, tahrir_client) == {"ralph"}
@@ -0,0 +1,115 @@
+from unittest.mock import patch
+
+import pytest
+from dogpile.cache import make_region
+from fedora_messaging.message import Message
+
+from fedbadges.rules import RuleSet
+
+
+def test_startup_timings(consumer):
+    """Test that the duration of each startup stage is recorded."""
+    assert set(consumer.startup_timings) == {
+        "cache",
+        "tahrir",
+        "datanommer",
+        "fasjson",
+        "rules",
+        "total",
+    }
+    assert consumer.startup_timings["total"] >= consumer.startup_timings["rules"]
+
+
+def test_skip_processed_messages(consumer):
+    message = Message(topic="org.fedoraproject.dev.something.sometopic")
+    with (
+        patch.object(consumer, "_process_message") as process_message,
+        patch("fedbadges.consumer.claim_message", return_value=True) as claim_message,
+    ):
+        consumer(message)
+        process_message.assert_called_once_with(message)
+        claim_message.assert_called_once_with(message.id, 3600)
+
+    # Redelivered
+    with (
+        patch.object(consumer, "_process_message") as process_message,
+        patch("fedbadges.consumer.claim_message", return_value=False),
+    ):
+        consumer(message)
+        process_message.assert_not_called()
+
+
+def test_mark_processed_before_counting(consumer):
+    # The message is remembered even if processing is interrupted
+    message = Message(topic="org.fedoraproject.dev.something.sometopic")
+    with patch("fedbadges.cached.cache", make_region().configure("dogpile.cache.memory")):
+        with (
+            patch.object(consumer, "_process_message", side_effect=RuntimeError("crash")),
+            pytest.raises(RuntimeError),
+        ):
+            consumer(message)
+        # The message is skipped when it is redelivered
+        with patch.object(consumer, "_process_message") as process_message:
+            consumer(message)
+    process_message.assert_not_called()
+
+
+def test_rejected_rules_reload(consumer):
+    rules = consumer.badge_rules
+    repo = consumer._rules_repo
+    with (
+        patch.object(repo, "_needs_update", return_value=True),
+        patch.object(repo, "_load_all", return_value=({}, True)),
+    ):
+        consumer._reload_rules()
+    # None of the rules could be loaded, the previous ones are kept
+    assert consumer.badge_rules is rules
+    assert repo.rules is rules
+    assert len(repo._files) == len(rules)
+
+
+def test_rules_reload_removed_ratio(consumer):
+    rules = consumer.badge_rules
+    repo = consumer._rules_repo
+    remaining = dict(list(repo._files.items())[:1])
+    with (
+        patch.object(repo, "_needs_update", return_value=True),
+        patch.object(repo, "_load_all", return_value=(remaining, True)),
+    ):
+        consumer._reload_rules()
+        # Most of the rules are missing
+        assert consumer.badge_rules is rules
+        # Unless it is allowed
+        with patch.dict(consumer.config, {"rules_max_removed_ratio": 1}):
+            consumer._reload_rules()
+    assert len(consumer.badge_rules) == 1
+    assert repo.rules is consumer.badge_rules
+
+
+def test_rules_reload_removed_ratio_on_startup(consumer, tmp_path):
+    repo = consumer._rules_repo
+    repo._cache_path = tmp_path.joinpath("rules.cache").as_posix()
+    repo._write_cache(repo._files)
+    names = {rule["name"] for rule in consumer.badge_rules}
+    # As after a restart
+    consumer.badge_rules = RuleSet()
+    repo._files = {}
+    remaining = dict(list(repo._read_cache().items())[:1])
+    with (
+        patch.object(repo, "_needs_update", return_value=True),
+        patch.object(
+            repo,
+            "_load_all",
+            return_value=(
+                {
+                    fname: (cached["hash"], repo._build_rules_from_cache(fname, cached["rules"]))
+                    for fname, cached in remaining.items()
+                },
+                True,
+            ),
+        ),
+    ):
+        consumer._reload_rules()
+    # The rules of the previous run are used
+    assert {rule["name"] for rule in consumer.badge_rules} == names
+    assert repo.rules is not consumer.badge_rules
@@ -1,13 +1,23 @@
-from unittest.mock import patch
+import datetime
+from contextlib import contextmanager
+from unittest.mock import Mock, patch
 
 import pytest
 from fedora_messaging.message import Message
 
 import fedbadges.rules
+from fedbadges.cached import get_message_memo, message_memo
 
 from .utils import example_real_bodhi_message, MockedDatanommerMessage
 
 
+@pytest.fixture(autouse=True)
+def no_first_seen():
+    # There's no datanommer DB to look the topics up in
+    with patch.object(fedbadges.rules.DatanommerCounter, "_query_first_seen", return_value={}):
+        yield
+
+
 class MockQuery:
     def __init__(self, returned_count):
         self.returned_count = returned_count
@@ -119,3 +129,159 @@ def test_datanommer_with_lambda_filter(cache_configured):
         result = counter.count(message, "dummy-user")
         assert result == returned_count
         grep.assert_called_once_with(users=["lmacken"], defer=True)
+
+
+def test_datanommer_message_memo(cache_configured):
+    counters = [
+        fedbadges.rules.DatanommerCounter(
+            {"filter": {"topics": ["message.topic"]}, "operation": "count"}
+        )
+        for _i in range(2)
+    ]
+    message = Message(topic="org.fedoraproject.dev.something.sometopic")
+    with patch("datanommer.models.Message.grep") as grep:
+        grep.return_value = 42, 1, MockQuery(42)
+        with message_memo(message.id):
+            assert [counter.count(message, "dummy-user") for counter in counters] == [42, 42]
+        # The second counter reused the result of the first one
+        grep.assert_called_once()
+        # The memo is dropped once the message is processed
+        assert get_message_memo(message.id) is None
+        counters[0].count(message, "dummy-user")
+        assert grep.call_count == 2
+
+
+def test_datanommer_message_memo_windowed(cache_configured):
+    counter = fedbadges.rules.DatanommerCounter(
+        {
+            "filter": {
+                "topics": ["message.topic"],
+                "start": "datetime.datetime(2024, 1, 1)",
+            },
+            "operation": "count",
+        }
+    )
+    message = Message(topic="org.fedoraproject.dev.something.sometopic")
+    with patch("datanommer.models.Message.grep") as grep:
+        grep.return_value = 42, 1, MockQuery(42)
+        with message_memo(message.id):
+            assert counter.count(message, "dummy-user") == 42
+            assert counter.count(message, "dummy-user") == 42
+        grep.assert_called_once()
+        assert grep.call_args.kwargs["start"] == datetime.datetime(2024, 1, 1)
+
+
+def test_datanommer_first_seen_budget(cache_configured):
+    counter = fedbadges.rules.DatanommerCounter(
+        {"filter": {"topics": ["message.topic"]}, "operation": "count"}
+    )
+    message = Message(topic="org.fedoraproject.dev.something.sometopic")
+    in_budget = []
+
+    @contextmanager
+    def statement_timeout(session):
+        in_budget.append(True)
+        yield
+        in_budget.pop()
+
+    def query_first_seen(kind, values):
+        # The first-seen lookup runs within the query time budget
+        assert in_budget
+        return {}
+
+    with (
+        patch("fedbadges.rules.statement_timeout", statement_timeout),
+        patch.object(counter, "_query_first_seen", side_effect=query_first_seen) as query,
+        patch("datanommer.models.Message.grep") as grep,
+    ):
+        grep.return_value = 42, 1, MockQuery(42)
+        assert counter.count(message, "dummy-user") == 42
+    query.assert_called_once()
+
+
+def test_datanommer_count_grouped(cache_configured):
+    counter = fedbadges.rules.DatanommerCounter(
+        {"filter": {"users": ["recipient"], "topics": ["message.topic"]}, "operation": "count"}
+    )
+    message = Message(topic="org.fedoraproject.dev.something.sometopic")
+    with patch("datanommer.models.session") as session:
+        session.get_bind.return_value.dialect.name = "sqlite"
+        session.execute.return_value.all.return_value = [("user1", 3), ("user2", 1)]
+        counts = counter.count_grouped([(message, f"user{index}") for index in range(1, 4)])
+    assert counts == {"user1": 3, "user2": 1, "user3": 0}
+    # A single query, grouped by user
+    session.execute.assert_called_once()
+    sql = str(session.execute.call_args.args[0])
+    assert "GROUP BY users.name" in sql
+    assert "messages.topic =" in sql
+
+
+def test_datanommer_count_grouped_unsupported(cache_configured):
+    message = Message(topic="org.fedoraproject.dev.something.sometopic")
+    filters = [
+        # The candidate is not the only user
+        {"users": ["recipient", "'someone'"]},
+        # The rest of the filter depends on the candidate
+        {"users": ["recipient"], "packages": ["[recipient]"]},
+        # Not supported by the grouped query
+        {"users": ["recipient"], "rows_per_page": "1"},
+    ]
+    for search_filter in filters:
+        counter = fedbadges.rules.DatanommerCounter({"filter": search_filter, "operation": "count"})
+        assert counter.count_grouped([(message, "user1"), (message, "user2")]) is None
+    counter = fedbadges.rules.DatanommerCounter(
+        {"filter": {"users": ["recipient"]}, "operation": {"lambda": "len(results)"}}
+    )
+    assert counter.count_grouped([(message, "user1")]) is None
+
+
+def test_datanommer_first_seen_start(cache_configured):
+    counter = fedbadges.rules.DatanommerCounter(
+        {
+            "filter": {"topics": ["message.topic"], "categories": ["'bodhi'"]},
+            "operation": "count",
+        }
+    )
+    message = Message(topic="org.fedoraproject.dev.bodhi.update.comment")
+    first_seen = {
+        "topics": {message.topic: datetime.datetime(2020, 1, 1)},
+        "categories": {"bodhi": datetime.datetime(2015, 1, 1)},
+    }
+    with (
+        patch.object(
+            counter, "_query_first_seen", side_effect=lambda kind, values: first_seen[kind]
+        ),
+        patch("datanommer.models.Message.grep") as grep,
+    ):
+        grep.return_value = 42, 1, MockQuery(42)
+        counter.count(message, "dummy-user")
+    # The latest of the bounds
+    assert grep.call_args.kwargs["start"] == datetime.datetime(2020, 1, 1)
+
+
+def test_datanommer_time_bounds_utc(cache_configured):
+    counter = fedbadges.rules.DatanommerCounter(
+        {"filter": {"users": ["recipient"], "topics": ["message.topic"]}, "operation": "count"}
+    )
+    counter.fasjson = Mock(name="fasjson")
+    # An aware creation time, in another timezone
+    counter.fasjson.get_user_creation_time.return_value = datetime.datetime(
+        2020, 1, 2, 2, 0, tzinfo=datetime.timezone(datetime.timedelta(hours=2))
+    )
+    message = Message(topic="org.fedoraproject.dev.something.sometopic")
+    with (
+        patch.object(
+            counter,
+            "_query_first_seen",
+            return_value={message.topic: datetime.datetime(2019, 1, 1)},
+        ),
+        patch("datanommer.models.Message.grep") as grep,
+    ):
+        grep.return_value = 42, 1, MockQuery(42)
+        counter.count(message, "dummy-user")
+    # Naive and in UTC, like the datanommer timestamps
+    assert grep.call_args.kwargs["start"] == datetime.datetime(2020, 1, 1, 0, 0)
+    end = grep.call_args.kwargs["end"]
+    assert end.tzinfo is None
+    utc_now = datetime.datetime.now(tz=datetime.timezone.utc).replace(tzinfo=None)
+    assert abs(utc_now - end) < datetime.timedelta(minutes=1)
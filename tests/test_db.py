@@ -0,0 +1,83 @@
+from unittest.mock import Mock
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+from fedbadges.db import (
+    make_engine,
+    PoolWaitStats,
+    query_time_budget,
+    QueryTimeoutError,
+    SessionProvider,
+    statement_timeout,
+    TimedQueuePool,
+)
+
+
+def test_pool_wait_stats():
+    stats = PoolWaitStats()
+    stats.record(0.5)
+    stats.record(1.5)
+    assert stats.as_dict() == {
+        "checkouts": 2,
+        "total_wait": 2.0,
+        "max_wait": 1.5,
+        "avg_wait": 1.0,
+    }
+    stats.reset()
+    assert stats.as_dict()["checkouts"] == 0
+
+
+def test_timed_queue_pool(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path.as_posix()}/test.db", poolclass=TimedQueuePool)
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+    assert engine.pool.wait_stats.checkouts == 1
+    # The stats survive a pool re-creation
+    engine.dispose()
+    assert engine.pool.wait_stats.checkouts == 1
+
+
+def test_session_provider_read_only(tmp_path):
+    provider = SessionProvider.from_config(
+        f"sqlite:///{tmp_path.as_posix()}/test.db", read_only=True
+    )
+    assert provider.session.scalar(text("SELECT 1")) == 1
+    # pysqlite's autocommit mode
+    dbapi_connection = provider.session.connection().connection.dbapi_connection
+    assert dbapi_connection.isolation_level is None
+    provider.release()
+    assert "pool" in provider.stats()
+
+
+def test_make_engine_pool_args():
+    engine = make_engine(
+        "postgresql+psycopg2://user@localhost/db", pool_size=2, max_overflow=0, pool_timeout=3
+    )
+    assert isinstance(engine.pool, TimedQueuePool)
+    assert engine.pool.size() == 2
+    assert engine.pool._timeout == 3
+
+
+def test_statement_timeout():
+    session = Mock(name="session")
+    session.get_bind.return_value.dialect.name = "postgresql"
+    canceled = OperationalError("SELECT", {}, Mock(pgcode="57014"))
+    # No budget, no timeout
+    with statement_timeout(session):
+        pass
+    session.execute.assert_not_called()
+    with query_time_budget(1.5):
+        with pytest.raises(QueryTimeoutError):
+            with statement_timeout(session):
+                raise canceled
+    statements = [str(call.args[0]) for call in session.execute.call_args_list]
+    assert statements == ["SET statement_timeout = 1500", "RESET statement_timeout"]
+    # Only on PostgreSQL
+    session.reset_mock()
+    session.get_bind.return_value.dialect.name = "sqlite"
+    with query_time_budget(1.5):
+        with statement_timeout(session):
+            pass
+    session.execute.assert_not_called()
@@ -0,0 +1,94 @@
+import threading
+from unittest.mock import Mock
+
+from fedbadges.awards import Award
+from fedbadges.db import QueryTimeoutError
+from fedbadges.deferral import DeferralLane
+
+
+def _make_rule(badge_id, results):
+    rule = Mock(name=badge_id)
+    rule.badge_id = badge_id
+    rule.query_timeout = 1
+    rule.matches.side_effect = results
+    return rule
+
+
+def _make_lane(**kwargs):
+    consumer = Mock(name="consumer")
+    consumer._get_link.return_value = "http://example.com/msg"
+    return consumer, DeferralLane(consumer, retry_delay=0, **kwargs)
+
+
+def test_deferral_lane():
+    consumer, lane = _make_lane(retries=2)
+    message = Mock(id="msg-id")
+    rule = _make_rule("slow", [QueryTimeoutError("too slow"), {"dummy-user"}])
+    assert not lane.is_deferred(rule)
+    lane.defer(rule, message)
+    assert lane.is_deferred(rule)
+    lane.shutdown()
+    # It failed once and was retried
+    assert rule.matches.call_count == 2
+    consumer.award_badges.assert_called_once_with(
+        [Award("dummy-user", "slow", "http://example.com/msg")]
+    )
+    consumer.tahrir.session.rollback.assert_called_once_with()
+    assert consumer._datanommer_sessions.release.call_count == 2
+    assert lane.stats() == {
+        "deferred_rules": 1,
+        "pending": 0,
+        "blocked": 0,
+        "blocked_time": 0,
+    }
+
+
+def test_deferral_lane_give_up(caplog):
+    consumer, lane = _make_lane(retries=1)
+    rule = _make_rule("slow", [QueryTimeoutError("too slow")] * 2)
+    lane.submit(rule, Mock(id="msg-id"))
+    lane.shutdown()
+    assert rule.matches.call_count == 2
+    consumer.award_badges.assert_not_called()
+    assert "Giving up on rule slow for message msg-id" in caplog.text
+
+
+def test_deferral_period():
+    _consumer, lane = _make_lane(period=0)
+    rule = _make_rule("slow", [set()])
+    lane.defer(rule, Mock(id="msg-id"))
+    lane.shutdown()
+    # It's tried inline again right away
+    assert not lane.is_deferred(rule)
+
+
+def test_deferral_lane_serialized():
+    _consumer, lane = _make_lane(workers=4, max_pending=3)
+    release = threading.Event()
+    running = []
+    order = []
+
+    def matches(message, tahrir):
+        running.append(message.id)
+        assert len(running) == 1, "the messages of a rule must not run concurrently"
+        release.wait(5)
+        order.append(message.id)
+        running.remove(message.id)
+        return set()
+
+    rule = _make_rule("slow", None)
+    rule.matches.side_effect = matches
+    for index in range(3):
+        lane.submit(rule, Mock(id=f"msg-{index}"))
+    # The lane is full, the next message waits for room instead of being dropped
+    submitter = threading.Thread(target=lane.submit, args=(rule, Mock(id="msg-3")))
+    submitter.start()
+    submitter.join(0.1)
+    assert submitter.is_alive()
+    release.set()
+    submitter.join(5)
+    assert not submitter.is_alive()
+    lane.shutdown()
+    assert order == ["msg-0", "msg-1", "msg-2", "msg-3"]
+    assert lane.stats()["pending"] == 0
+    assert lane.stats()["blocked"] == 1
@@ -0,0 +1,88 @@
+import datetime
+import json
+import os
+from unittest.mock import Mock, patch
+
+import fasjson_client
+import pytest
+
+from fedbadges.fas import CachedSpecClient, FASProxy, UserCreationTimes
+
+
+SPEC = {
+    "swagger": "2.0",
+    "info": {"title": "FASJSON", "version": "1.0"},
+    "basePath": "/v1",
+    "paths": {
+        "/users/{username}/": {
+            "get": {
+                "operationId": "get_user",
+                "tags": ["users"],
+                "parameters": [
+                    {"name": "username", "in": "path", "required": True, "type": "string"}
+                ],
+                "responses": {"200": {"description": "Success"}},
+            }
+        }
+    },
+}
+URL = "http://fasjson.example.com/"
+
+
+@pytest.fixture
+def spec_cache(tmp_path):
+    path = tmp_path.joinpath("spec.json")
+    path.write_text(json.dumps({"url": f"{URL}specs/v1.json", "spec": SPEC}))
+    return path
+
+
+def test_fasproxy_lazy_client():
+    """The FASJSON client is only built when it's needed."""
+    with patch("fedbadges.fas.fasjson_client.Client") as client_class:
+        proxy = FASProxy(URL)
+        client_class.assert_not_called()
+        proxy.get_user("dummy")
+        client_class.assert_called_once_with(URL)
+
+
+def test_cached_spec(spec_cache):
+    with patch.object(fasjson_client.Client, "_make_bravado_client") as make_bravado_client:
+        client = CachedSpecClient(URL, spec_cache=spec_cache.as_posix(), auth=False)
+    make_bravado_client.assert_not_called()
+    assert client.operations == ["get_user"]
+
+
+def test_cached_spec_invalid(spec_cache):
+    spec_cache.write_text(json.dumps({"url": f"{URL}specs/v1.json", "spec": {"paths": 42}}))
+    remote_api = Mock()
+    remote_api.swagger_spec.client_spec_dict = SPEC
+    remote_api.swagger_spec.resources = {}
+    with patch.object(fasjson_client.Client, "_make_bravado_client", return_value=remote_api):
+        CachedSpecClient(URL, spec_cache=spec_cache.as_posix(), auth=False)
+    # The spec was downloaded again and cached
+    assert json.loads(spec_cache.read_text())["spec"] == SPEC
+
+
+def test_cached_spec_stale_server_down(spec_cache):
+    os.utime(spec_cache, (0, 0))
+    error = fasjson_client.errors.ClientSetupError("error loading remote spec", 103)
+    with patch.object(fasjson_client.Client, "_make_bravado_client", side_effect=error):
+        client = CachedSpecClient(URL, spec_cache=spec_cache.as_posix(), auth=False)
+    assert client.operations == ["get_user"]
+
+
+def test_user_creation_times(tmp_path):
+    path = tmp_path.joinpath("creation-times.sqlite").as_posix()
+    with patch("fedbadges.fas.fasjson_client.Client") as client_class:
+        client_class.return_value.get_user.return_value.result = {
+            "username": "dummy",
+            "creation": "2020-01-01T10:00:00",
+        }
+        proxy = FASProxy(URL, creation_times=path)
+        expected = datetime.datetime(2020, 1, 1, 10, 0)
+        assert proxy.get_user_creation_time("dummy") == expected
+        assert proxy.get_user_creation_time("dummy") == expected
+        client_class.return_value.get_user.assert_called_once_with(username="dummy")
+    # It survives a restart
+    assert UserCreationTimes(path).get("dummy") == expected
+    assert UserCreationTimes(path).get("other") is None
@@ -0,0 +1,75 @@
+from unittest.mock import Mock
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+from fedbadges.awards import Award
+from fedbadges.outbox import AwardOutbox
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    outbox = AwardOutbox(tmp_path.joinpath("outbox.sqlite").as_posix())
+    yield outbox
+    outbox.close()
+
+
+def test_outbox_drain(outbox):
+    awards = [Award(f"user{i}", "dummy-badge", f"http://example.com/{i}") for i in range(5)]
+    outbox.append(awards[:3])
+    outbox.append(awards[3:])
+    assert outbox.pending() == 5
+
+    writer = Mock(name="writer")
+    tahrir = Mock(name="tahrir")
+    assert outbox.drain(writer, tahrir, batch_size=2) == 5
+    assert outbox.pending() == 0
+    # In order, in batches
+    assert [call.args[1] for call in writer.write.call_args_list] == [
+        awards[:2],
+        awards[2:4],
+        awards[4:],
+    ]
+
+
+def test_outbox_drain_failure(outbox):
+    awards = [Award(f"user{i}", "dummy-badge") for i in range(3)]
+    outbox.append(awards)
+    writer = Mock(name="writer")
+    writer.write.side_effect = [None, RuntimeError("tahrir is down")]
+    with pytest.raises(RuntimeError):
+        outbox.drain(writer, Mock(name="tahrir"), batch_size=2)
+    # The failed batch is still there
+    assert outbox.pending() == 1
+    writer.write.side_effect = None
+    assert outbox.drain(writer, Mock(name="tahrir")) == 1
+    assert writer.write.call_args.args[1] == awards[2:]
+
+
+def test_outbox_dead_awards(outbox):
+    awards = [Award(f"user{i}", "dummy-badge") for i in range(4)]
+    outbox.append(awards)
+    written = []
+
+    def write(tahrir, batch):
+        if awards[1] in batch:
+            raise IntegrityError("INSERT", {}, Exception("constraint violated"))
+        written.extend(batch)
+
+    writer = Mock(name="writer")
+    writer.write.side_effect = write
+    assert outbox.drain(writer, Mock(name="tahrir"), batch_size=3) == 4
+    # The awards after the broken one are not blocked
+    assert written == [awards[0], awards[2], awards[3]]
+    assert outbox.pending() == 0
+    assert outbox.dead() == 1
+
+
+def test_outbox_persistent(tmp_path):
+    path = tmp_path.joinpath("outbox.sqlite").as_posix()
+    outbox = AwardOutbox(path)
+    outbox.append([Award("dummy-user", "dummy-badge")])
+    outbox.close()
+    outbox = AwardOutbox(path)
+    assert outbox.pending() == 1
+    outbox.close()
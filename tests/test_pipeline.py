@@ -0,0 +1,101 @@
+import asyncio
+from unittest.mock import Mock
+
+from fedora_messaging.message import Message
+
+from fedbadges.awards import Award
+from fedbadges.db import QueryTimeoutError
+from fedbadges.pipeline import Pipeline
+
+
+def _make_rule(badge_id, triggers=True, candidates=("dummy-user",), awardees=("dummy-user",)):
+    rule = Mock(name=badge_id)
+    rule.badge_id = badge_id
+    rule.query_timeout = None
+    rule.trigger.matches.return_value = triggers
+    rule.get_candidates.return_value = set(candidates)
+    rule.get_awardees.return_value = set(awardees)
+    return rule
+
+
+def _make_consumer(rules):
+    consumer = Mock(name="consumer")
+    consumer.badge_rules.for_message.return_value = rules
+    consumer._get_link.return_value = "http://example.com/msg"
+    consumer.deferral_lane.is_deferred.side_effect = lambda rule: rule.badge_id == "deferred"
+    return consumer
+
+
+def _process(pipeline, message):
+    # Don't use asyncio.run(), it would unset the event loop that the consumer uses.
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(pipeline.process(message))
+    finally:
+        loop.close()
+
+
+def test_pipeline_awards():
+    rules = [
+        _make_rule("awarded"),
+        _make_rule("not-triggered", triggers=False),
+        _make_rule("no-candidates", candidates=()),
+        _make_rule("no-awardees", awardees=()),
+    ]
+    consumer = _make_consumer(rules)
+    message = Message(topic="org.fedoraproject.dev.something.sometopic")
+    _process(Pipeline(consumer, workers=2, queue_size=1), message)
+
+    consumer.award_badges.assert_called_once_with(
+        [Award("dummy-user", "awarded", "http://example.com/msg")]
+    )
+    rules[1].get_candidates.assert_not_called()
+    rules[2].get_awardees.assert_not_called()
+    # The datanommer connection is given back after each stage
+    assert consumer._datanommer_sessions.release.call_count == 6
+
+
+def test_pipeline_rule_failure(caplog):
+    failing = _make_rule("failing")
+    failing.get_awardees.side_effect = ValueError("boom")
+    rules = [failing, _make_rule("awarded")]
+    consumer = _make_consumer(rules)
+    message = Message(topic="org.fedoraproject.dev.something.sometopic")
+    _process(Pipeline(consumer), message)
+
+    consumer.award_badges.assert_called_once_with(
+        [Award("dummy-user", "awarded", "http://example.com/msg")]
+    )
+    consumer.tahrir.session.rollback.assert_called_once_with()
+    assert "Rule: " in caplog.text
+
+
+def test_pipeline_deferral():
+    slow = _make_rule("slow")
+    slow.get_awardees.side_effect = QueryTimeoutError("too slow")
+    rules = [slow, _make_rule("deferred"), _make_rule("awarded")]
+    consumer = _make_consumer(rules)
+    message = Message(topic="org.fedoraproject.dev.something.sometopic")
+    _process(Pipeline(consumer), message)
+
+    consumer.award_badges.assert_called_once_with(
+        [Award("dummy-user", "awarded", "http://example.com/msg")]
+    )
+    # The slow rule goes to the deferral lane, the deferred one doesn't run inline
+    consumer.deferral_lane.defer.assert_called_once_with(slow, message)
+    consumer.deferral_lane.submit.assert_called_once_with(rules[1], message)
+    rules[1].get_candidates.assert_not_called()
+    consumer.tahrir.session.rollback.assert_not_called()
+
+
+def test_pipeline_stage_failure(caplog):
+    consumer = _make_consumer([_make_rule("failing"), _make_rule("awarded")])
+    # Not caught by the stage itself
+    consumer._datanommer_sessions.release.side_effect = [RuntimeError("boom"), None, None, None]
+    message = Message(topic="org.fedoraproject.dev.something.sometopic")
+    # It would hang if the worker died
+    _process(Pipeline(consumer, workers=1), message)
+    assert "Pipeline stage" in caplog.text
+    consumer.award_badges.assert_called_once_with(
+        [Award("dummy-user", "awarded", "http://example.com/msg")]
+    )
@@ -0,0 +1,94 @@
+import time
+from unittest.mock import patch
+
+from fedora_messaging import exceptions as fm_exceptions
+from fedora_messaging.message import Message
+
+from fedbadges.publisher import NotificationPublisher
+
+
+def _wait_for(condition, timeout=5):
+    start = time.monotonic()
+    while not condition():
+        if time.monotonic() - start > timeout:
+            raise AssertionError("Timed out")
+        time.sleep(0.01)
+
+
+def test_publisher():
+    messages = [Message(topic=f"dummy.topic.{i}", body={"i": i}) for i in range(3)]
+    publisher = NotificationPublisher()
+    with patch("fedbadges.publisher.fm_api.publish") as publish:
+        publisher.start()
+        for message in messages:
+            publisher(message)
+        _wait_for(lambda: publisher.pending == 0)
+        publisher.stop()
+    assert [call.kwargs["message"] for call in publish.call_args_list] == messages
+
+
+def test_publisher_retry():
+    message = Message(topic="dummy.topic", body={})
+    publisher = NotificationPublisher(retry_delay=0.01)
+    with patch("fedbadges.publisher.fm_api.publish") as publish:
+        publish.side_effect = [fm_exceptions.ConnectionException(reason="boom"), None]
+        publisher.start()
+        publisher(message)
+        _wait_for(lambda: publisher.pending == 0)
+        publisher.stop()
+    assert publish.call_count == 2
+
+
+def test_publisher_permanent_error(caplog):
+    messages = [Message(topic=f"dummy.topic.{i}", body={"i": i}) for i in range(2)]
+    publisher = NotificationPublisher(retry_delay=60)
+    with patch("fedbadges.publisher.fm_api.publish") as publish:
+        publish.side_effect = [fm_exceptions.PublishForbidden(reason="nope"), None]
+        for message in messages:
+            publisher(message)
+        publisher.start()
+        # The next message is not blocked
+        _wait_for(lambda: publisher.pending == 0)
+        publisher.stop()
+    assert publish.call_count == 2
+    assert publish.call_args.kwargs["message"] == messages[1]
+    assert f"Dropping the notification {messages[0].id}" in caplog.text
+
+
+def test_publisher_unexpected_error():
+    message = Message(topic="dummy.topic", body={})
+    publisher = NotificationPublisher(retry_delay=0.01)
+    with patch("fedbadges.publisher.fm_api.publish") as publish:
+        publish.side_effect = [RuntimeError("boom"), None]
+        publisher.start()
+        publisher(message)
+        # The thread survived and retried
+        _wait_for(lambda: publisher.pending == 0)
+        publisher.stop()
+    assert publish.call_count == 2
+
+
+def test_publisher_spool(tmp_path):
+    spool_path = tmp_path.joinpath("spool.jsonl").as_posix()
+    message = Message(topic="dummy.topic", body={"foo": "bar"})
+    # The broker is down, the message stays in the spool
+    publisher = NotificationPublisher(spool_path=spool_path, retry_delay=60)
+    with patch("fedbadges.publisher.fm_api.publish") as publish:
+        publish.side_effect = fm_exceptions.ConnectionException(reason="boom")
+        publisher.start()
+        publisher(message)
+        _wait_for(lambda: publish.call_count > 0)
+        publisher.stop()
+    assert publisher.pending == 1
+
+    # After a restart, it is sent
+    publisher = NotificationPublisher(spool_path=spool_path)
+    with patch("fedbadges.publisher.fm_api.publish") as publish:
+        publisher.start()
+        _wait_for(lambda: publisher.pending == 0)
+        publisher.stop()
+    publish.assert_called_once()
+    assert publish.call_args.kwargs["message"].id == message.id
+    assert publish.call_args.kwargs["message"].body == {"foo": "bar"}
+    with open(spool_path) as spool:
+        assert spool.read() == ""
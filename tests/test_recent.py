@@ -0,0 +1,74 @@
+import datetime
+import time
+from unittest.mock import Mock, patch
+
+from fedora_messaging.message import Message
+
+import fedbadges.rules
+from fedbadges.recent import RecentMessages
+
+
+def _message(topic, users, packages=(), sent_at=None):
+    message = Mock(name="message", topic=topic, usernames=users, packages=list(packages))
+    message.id = f"msg-{time.perf_counter_ns()}"
+    message._properties.headers = {
+        "sent-at": (sent_at or datetime.datetime.now(tz=datetime.timezone.utc)).isoformat()
+    }
+    return message
+
+
+def test_count():
+    recent = RecentMessages()
+    recent.configure(days=1)
+    start = time.time() + 0.5
+    # Not covered
+    assert not recent.can_answer({"users": ["alice"], "start": time.time() - 1})
+    assert recent.can_answer({"users": ["alice"], "start": start})
+    recent.add(_message("org.fedoraproject.prod.bodhi.update.comment", ["alice", "bob"], ["pkg"]))
+    recent.add(_message("org.fedoraproject.prod.koji.build.state.change", ["alice"]))
+    now = time.time() - 1
+    assert recent.count(["alice"], now) == 2
+    # Counted once
+    assert recent.count(["alice", "bob"], now) == 2
+    assert recent.count(["alice"], now, categories=["koji"]) == 1
+    assert recent.count(["bob"], now, packages=["pkg"]) == 1
+    assert recent.count(["alice"], now, end=now) == 0
+    assert not recent.can_answer({"users": ["alice"], "start": start, "agents": ["alice"]})
+
+
+def test_eviction():
+    recent = RecentMessages()
+    recent.configure(days=1, max_size=1000)
+    for _i in range(10):
+        recent.add(_message("org.fedoraproject.prod.bodhi.update.comment", ["alice"]))
+    assert recent.size <= 1000
+    assert 0 < len(recent) < 10
+    # Too old
+    old = datetime.datetime.now(tz=datetime.timezone.utc) - datetime.timedelta(days=2)
+    recent.add(_message("org.fedoraproject.prod.bodhi.update.comment", ["bob"], sent_at=old))
+    assert recent.count(["bob"], 0) == 0
+
+
+def test_datanommer_counter_uses_recent_messages():
+    recent = RecentMessages()
+    recent.configure(days=1)
+    # As if the consumer had been running for a while
+    recent.covers_since -= 7200
+    recent.add(_message("org.fedoraproject.prod.bodhi.update.comment", ["alice"]))
+    counter = fedbadges.rules.DatanommerCounter(
+        {
+            "filter": {
+                "users": ["recipient"],
+                "start": "datetime.datetime.now() - datetime.timedelta(hours=1)",
+                "end": "datetime.datetime.now()",
+            },
+            "operation": "count",
+        }
+    )
+    message = Message(topic="org.fedoraproject.prod.bodhi.update.comment")
+    with (
+        patch("fedbadges.rules.recent_messages", recent),
+        patch("datanommer.models.Message.grep") as grep,
+    ):
+        assert counter.count(message, "alice") == 1
+    grep.assert_not_called()
@@ -0,0 +1,109 @@
+from unittest.mock import Mock, patch
+
+from dogpile.cache import make_region
+
+from fedbadges.awards import Award
+from fedbadges.cached import get_messages_counts, set_messages_counts
+from fedbadges.reconcile import CounterReconciler, PendingCounters
+
+
+def _make_rule(badge_id, actual_counts):
+    rule = Mock(name=badge_id)
+    rule.badge_id = badge_id
+    rule.counting_version = "v1"
+    rule.previous.count.side_effect = lambda msg, candidate: actual_counts[candidate]
+    # Counted one by one
+    rule.previous.count_grouped.return_value = None
+    rule.condition.side_effect = lambda value: value >= 10
+    return rule
+
+
+def test_pending_counters():
+    pending = PendingCounters(max_size=2)
+    rule = _make_rule("badge", {})
+    pending.add(rule, "msg1", ["user1", "user2"])
+    pending.add(rule, "msg2", ["user3", "user1"])
+    # user2 was the least recently used
+    assert len(pending) == 2
+    assert pending.pop(1) == [(("badge", "user3"), (rule, "msg2"))]
+    assert len(pending) == 1
+    # Disabled
+    pending = PendingCounters()
+    pending.add(rule, "msg1", ["user1"])
+    assert len(pending) == 0
+
+
+def test_reconcile():
+    region = make_region().configure("dogpile.cache.memory")
+    rule = _make_rule("badge", {"user1": 5, "user2": 10, "user3": 7, "user4": 12})
+    consumer = Mock(name="consumer")
+    consumer._get_link.return_value = "http://example.com/msg"
+    # Mocks refuse attributes starting with "assert" by default
+    tahrir = Mock(name="tahrir", unsafe=True)
+    tahrir.assertion_exists.side_effect = lambda badge_id, email: email.startswith("user4@")
+    tahrir.person_opted_out.return_value = False
+    consumer._get_tahrir_client.return_value = tahrir
+    pending = PendingCounters(max_size=10)
+    pending.add(rule, "msg", ["user1", "user2", "user3", "user4", "user5"])
+    with patch("fedbadges.cached.cache", region):
+        set_messages_counts("badge", {"user1": 5, "user2": 9, "user3": 8, "user4": 11}, "v1")
+        CounterReconciler(consumer, queries_per_second=None, pending=pending).run()
+        counts = get_messages_counts("badge", ["user1", "user2", "user3", "user4", "user5"], "v1")
+        assert counts == {
+            "user1": 5,
+            "user2": 10,
+            "user3": 7,
+            "user4": 12,
+            "user5": None,
+        }
+    # The badge that was held back, user4 already has it
+    consumer.award_badges.assert_called_once_with(
+        [Award("user2", "badge", "http://example.com/msg")]
+    )
+    assert len(pending) == 0
+
+
+def test_reconcile_concurrent_increment():
+    region = make_region().configure("dogpile.cache.memory")
+    rule = _make_rule("badge", {"user1": 10, "user2": 10})
+    consumer = Mock(name="consumer")
+    pending = PendingCounters(max_size=10)
+    pending.add(rule, "msg", ["user1", "user2"])
+
+    def count(msg, candidate):
+        if candidate == "user1":
+            # A live message is counted while datanommer is queried
+            set_messages_counts("badge", {"user1": 6}, "v1")
+        return 10
+
+    rule.previous.count.side_effect = count
+    rule.condition.side_effect = lambda value: False
+    with patch("fedbadges.cached.cache", region):
+        set_messages_counts("badge", {"user1": 5, "user2": 5}, "v1")
+        CounterReconciler(consumer, queries_per_second=None, pending=pending).run()
+        # The live increment is not overwritten
+        assert get_messages_counts("badge", ["user1", "user2"], "v1") == {"user1": 6, "user2": 10}
+
+
+def test_reconcile_grouped():
+    region = make_region().configure("dogpile.cache.memory")
+    rule = _make_rule("badge", {})
+    rule.previous.count_grouped.side_effect = lambda items: {
+        candidate: 10 for _msg, candidate in items
+    }
+    consumer = Mock(name="consumer")
+    tahrir = Mock(name="tahrir", unsafe=True)
+    tahrir.assertion_exists.return_value = True
+    consumer._get_tahrir_client.return_value = tahrir
+    pending = PendingCounters(max_size=10)
+    pending.add(rule, "msg", ["user1", "user2", "user3"])
+    with patch("fedbadges.cached.cache", region):
+        set_messages_counts("badge", {"user1": 5, "user2": 9}, "v1")
+        CounterReconciler(consumer, queries_per_second=None, pending=pending).run()
+        assert get_messages_counts("badge", ["user1", "user2"], "v1") == {
+            "user1": 10,
+            "user2": 10,
+        }
+    # A single query for the candidates whose counter is in the cache
+    rule.previous.count_grouped.assert_called_once_with([("msg", "user1"), ("msg", "user2")])
+    rule.previous.count.assert_not_called()
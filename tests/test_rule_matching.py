@@ -7,7 +7,7 @@ from noggin_messages import MemberSponsorV1
 
 import fedbadges.rules
 
-from .utils import example_real_bodhi_message
+from .utils import example_real_bodhi_message, patch_messages_count
 
 
 class MockQuery:
@@ -69,11 +69,49 @@ def test_full_simple_success(fasproxy, tahrir_client, user_exists):
 
     msg = example_real_bodhi_message
 
-    with patch("fedbadges.rules.get_cached_messages_count") as get_cached_messages_count:
-        get_cached_messages_count.return_value = 1
+    with patch_messages_count(1):
         assert rule.matches(msg, tahrir_client) == {"lmacken"}
 
 
+def test_windowed_count(fasproxy, tahrir_client, user_exists):
+    """Windowed counts are not kept in the cache, messages leave the window"""
+    rule = fedbadges.rules.BadgeRule(
+        dict(
+            name="Test",
+            description="Doesn't matter...",
+            creator="Somebody",
+            discussion="http://somelink.com",
+            issuer_id="fedora-project",
+            image_url="http://somelinke.com/something.png",
+            trigger=dict(category="bodhi"),
+            condition={"greater than or equal to": 2},
+            previous=dict(
+                filter=dict(
+                    categories=["pkgdb"],
+                    start="datetime.datetime.now() - datetime.timedelta(days=30)",
+                ),
+                operation="count",
+            ),
+        ),
+        1,
+        None,
+        fasproxy,
+    )
+    rule.setup(tahrir_client)
+    assert rule.previous.is_windowed
+
+    msg = example_real_bodhi_message
+
+    with (
+        patch_messages_count(1) as get_cached_messages_counts,
+        patch.object(rule.previous, "count", side_effect=[2, 1]) as count,
+    ):
+        assert rule.matches(msg, tahrir_client) == {"lmacken"}
+        assert rule.matches(msg, tahrir_client) == set()
+    get_cached_messages_counts.assert_not_called()
+    assert count.call_count == 2
+
+
 def test_full_simple_match_almost_succeed(fasproxy, tahrir_client):
     """A simple integration test for messages with zero users"""
     rule = fedbadges.rules.BadgeRule(
@@ -102,8 +140,7 @@ def test_full_simple_match_almost_succeed(fasproxy, tahrir_client):
     # we should *fail* the ``matches`` call.
     msg = Message(topic="org.fedoraproject.prod.bodhi.mashtask.complete", body={"success": False})
 
-    with patch("fedbadges.rules.get_cached_messages_count") as get_cached_messages_count:
-        get_cached_messages_count.return_value = 0
+    with patch_messages_count(0):
         assert rule.matches(msg, tahrir_client) == set()
 
 
@@ -148,8 +185,7 @@ def test_yaml_specified_awardee_success(fasproxy, tahrir_client, user_exists):
         },
     )
 
-    with patch("fedbadges.rules.get_cached_messages_count") as get_cached_messages_count:
-        get_cached_messages_count.return_value = 1
+    with patch_messages_count(1):
         assert rule.matches(msg, tahrir_client) == {"toshio", "ralph"}
 
 
@@ -187,8 +223,7 @@ def test_yaml_specified_awardee_failure(fasproxy, tahrir_client, user_exists):
         },
     )
 
-    with patch("fedbadges.rules.get_cached_messages_count") as get_cached_messages_count:
-        get_cached_messages_count.return_value = 1
+    with patch_messages_count(1):
         assert rule.matches(msg, tahrir_client) == {"toshio"}
 
 
@@ -234,8 +269,7 @@ def test_against_duplicates(fasproxy, tahrir_client, user_exists):
         },
     )
 
-    with patch("fedbadges.rules.get_cached_messages_count") as get_cached_messages_count:
-        get_cached_messages_count.return_value = 1
+    with patch_messages_count(1):
         assert rule.matches(msg, tahrir_client) == set(["ralph"])
 
 
@@ -269,8 +303,7 @@ def test_github_awardee(fasproxy, tahrir_client, fasjson_client, user_exists):
         body={"user": "https://api.github.com/users/dummygh"},
     )
 
-    with patch("fedbadges.rules.get_cached_messages_count") as get_cached_messages_count:
-        get_cached_messages_count.return_value = 1
+    with patch_messages_count(1):
         fasjson_client.search.return_value = SimpleNamespace(result=[{"username": "dummy"}])
         assert rule.matches(msg, tahrir_client) == set(["dummy"])
         fasjson_client.search.assert_called_once_with(
@@ -336,6 +369,5 @@ def test_krb_awardee(fasproxy, tahrir_client, user_exists):
         body={"owner": "packagerbot/os-master02.iad2.fedoraproject.org"},
     )
 
-    with patch("fedbadges.rules.get_cached_messages_count") as get_cached_messages_count:
-        get_cached_messages_count.return_value = 1
+    with patch_messages_count(1):
         assert rule.matches(msg, tahrir_client) == set(["packagerbot"])
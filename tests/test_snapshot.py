@@ -0,0 +1,53 @@
+import os
+import pickle
+
+from fedbadges.awards import AwardWriter
+from fedbadges.snapshot import Snapshot
+
+
+def _make_snapshot(path, writer, **kwargs):
+    snapshot = Snapshot(path.as_posix(), **kwargs)
+    snapshot.register("known_persons", writer.dump_known_persons, writer.load_known_persons)
+    return snapshot
+
+
+def test_snapshot_roundtrip(tmp_path):
+    path = tmp_path.joinpath("snapshot")
+    writer = AwardWriter()
+    writer._remember_persons({"dummy@fedoraproject.org": (1, "dummy")})
+    _make_snapshot(path, writer).save()
+
+    restarted = AwardWriter()
+    assert _make_snapshot(path, restarted).restore() == ["known_persons"]
+    assert restarted.dump_known_persons() == [("dummy@fedoraproject.org", (1, "dummy"))]
+
+
+def test_snapshot_too_old(tmp_path):
+    path = tmp_path.joinpath("snapshot")
+    writer = AwardWriter()
+    writer._remember_persons({"dummy@fedoraproject.org": (1, "dummy")})
+    _make_snapshot(path, writer).save()
+
+    restarted = AwardWriter()
+    assert _make_snapshot(path, restarted, max_age=-1).restore() == []
+    assert restarted.dump_known_persons() == []
+
+
+def test_snapshot_other_version(tmp_path):
+    path = tmp_path.joinpath("snapshot")
+    writer = AwardWriter()
+    writer._remember_persons({"dummy@fedoraproject.org": (1, "dummy")})
+    _make_snapshot(path, writer).save()
+    with open(path, "rb") as f:
+        content = pickle.load(f)  # noqa: S301
+    content["version"] = "0.0.1"
+    with open(path, "wb") as f:
+        pickle.dump(content, f)
+
+    assert _make_snapshot(path, AwardWriter()).restore() == []
+
+
+def test_snapshot_missing(tmp_path):
+    path = tmp_path.joinpath("snapshot")
+    assert not os.path.exists(path)
+    assert _make_snapshot(path, AwardWriter()).restore() == []
@@ -116,3 +116,80 @@ def test_malformed_trigger():
                 watwat="does not exist",
             )
         )
+
+
+def test_invalid_lambda():
+    """Test that invalid lambdas are rejected when the rule is loaded."""
+    with pytest.raises(ValueError):
+        fedbadges.rules.Trigger({"lambda": "message.body["})
+
+
+@pytest.mark.parametrize(
+    "trigger,expected",
+    [
+        ({"category": "bodhi"}, {"bodhi"}),
+        ({"category": {"any": ["bodhi", "git"]}}, None),
+        ({"topic": "bodhi.update.comment"}, None),
+        ({"any": [{"category": "bodhi"}, {"category": "koji"}]}, {"bodhi", "koji"}),
+        ({"any": [{"category": "bodhi"}, {"topic": "koji.tag"}]}, None),
+        ({"all": [{"category": "bodhi"}, {"topic": "bodhi.update.comment"}]}, {"bodhi"}),
+        ({"not": {"category": "bodhi"}}, None),
+    ],
+)
+def test_trigger_categories(trigger, expected):
+    """Test the categories a trigger is restricted to."""
+    categories = fedbadges.rules.Trigger(trigger).categories()
+    assert categories == (frozenset(expected) if expected is not None else None)
+
+
+
+class FakeRule(dict):
+    def __init__(self, name, trigger):
+        super().__init__(name=name)
+        self.trigger = fedbadges.rules.Trigger(trigger)
+
+
+def test_rule_set_for_message():
+    """Test that a rule set only returns the rules that may be triggered, in order."""
+    rule_set = fedbadges.rules.RuleSet(
+        [
+            FakeRule("bodhi", {"category": "bodhi"}),
+            FakeRule("topic", {"topic": "org.fedoraproject.prod.koji.tag"}),
+            FakeRule("koji", {"category": "koji"}),
+        ]
+    )
+    assert len(rule_set) == 3
+    message = Message(topic="org.fedoraproject.prod.koji.tag")
+    assert [rule["name"] for rule in rule_set.for_message(message)] == ["topic", "koji"]
+    message = Message(topic="short.topic")
+    assert [rule["name"] for rule in rule_set.for_message(message)] == ["topic"]
+
+
+def test_rule_set_validation():
+    """Test that an empty rule set can't replace a non-empty one."""
+    previous = fedbadges.rules.RuleSet([FakeRule("Rule 1", {"category": "bodhi"})])
+    empty = fedbadges.rules.RuleSet()
+    assert empty.validate_against(previous) == ["no rule could be loaded"]
+    assert previous.validate_against(empty) == []
+
+
+def test_rule_set_validation_missing_rules():
+    """Test that a rule set missing most of the previous rules is rejected."""
+    previous = fedbadges.rules.RuleSet(
+        [FakeRule(f"Rule {i}", {"category": "bodhi"}) for i in range(4)]
+    )
+    half = fedbadges.rules.RuleSet(list(previous)[:2])
+    assert half.validate_against(previous) == []
+    quarter = fedbadges.rules.RuleSet(list(previous)[:1])
+    assert quarter.validate_against(previous) == ["3 of the 4 rules are missing"]
+    assert quarter.validate_against(previous, max_removed_ratio=1) == []
+
+
+def test_counting_version():
+    rule = {"name": "Some badge", "trigger": {"category": "bodhi"}, "previous": {"filter": {}}}
+    version = fedbadges.rules.counting_version(rule)
+    # Only the counting definition matters
+    assert fedbadges.rules.counting_version({**rule, "trigger": {"category": "koji"}}) == version
+    assert fedbadges.rules.counting_version({**rule, "previous": {"filter": {"topics": []}}}) != (
+        version
+    )
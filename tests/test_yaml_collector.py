@@ -1,3 +1,13 @@
+import shutil
+from unittest.mock import patch
+
+import pytest
+from fedora_messaging.config import conf
+
+import fedbadges.rules
+from fedbadges.rulesrepo import find_git_dir, read_head_commit, RulesRepo
+
+
 def test_load_badges_number(consumer):
     """Determine that we can load badges from file."""
     assert len(consumer.badge_rules) == 5
@@ -13,3 +23,173 @@ def test_load_badges_contents(consumer):
         "Speak Up!",
         "Long Life to Pagure (Pagure I)",
     }
+
+
+@pytest.fixture
+def rules_repo(tmp_path, fm_config, fasjson_client):
+    shutil.copytree("tests/test_badges/rules", tmp_path.joinpath("badges", "rules"))
+    config = conf["consumer_config"].copy()
+    config["badges_repo"] = tmp_path.joinpath("badges").as_posix()
+    return RulesRepo(config, 1, fasjson_client)
+
+
+def test_reload_incremental(rules_repo, tmp_path, tahrir_client):
+    rules = rules_repo.load_all(tahrir_client, force=True)
+    assert len(rules) == 5
+    by_name = {rule["name"]: rule for rule in rules}
+
+    rules_dir = tmp_path.joinpath("badges", "rules")
+    rules_dir.joinpath("irc-speak-up.yml").unlink()
+    tagger = rules_dir.joinpath("tagger-01.yml")
+    tagger.write_text(tagger.read_text().replace("Junior Tagger (Tagger I)", "Junior Tagger"))
+
+    with patch.object(rules_repo, "_load_badge_from_yaml", wraps=rules_repo._load_badge_from_yaml):
+        reloaded = rules_repo.load_all(tahrir_client, force=True)
+        # Only the modified file was parsed again
+        rules_repo._load_badge_from_yaml.assert_called_once()
+
+    reloaded_by_name = {rule["name"]: rule for rule in reloaded}
+    assert set(reloaded_by_name) == {
+        "Like a Rock",
+        "The Zen of Foo Bar Baz",
+        "Junior Tagger",
+        "Long Life to Pagure (Pagure I)",
+    }
+    # Unchanged rules are the same objects
+    assert reloaded_by_name["Like a Rock"] is by_name["Like a Rock"]
+    assert reloaded_by_name["Junior Tagger"].badge_id == "junior-tagger"
+    assert tahrir_client.badge_exists("junior-tagger")
+
+
+def _write_git_ref(git_dir, ref, commit):
+    path = git_dir.joinpath(*ref.split("/"))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(f"{commit}\n")
+
+
+def test_change_detection(rules_repo, tmp_path, tahrir_client):
+    git_dir = tmp_path.joinpath("badges", ".git")
+    git_dir.mkdir()
+    git_dir.joinpath("HEAD").write_text("ref: refs/heads/main\n")
+    git_dir.joinpath("packed-refs").write_text(
+        "# pack-refs with: peeled fully-peeled sorted\n"
+        "1111111111111111111111111111111111111111 refs/heads/main\n"
+    )
+    # The git directory did not exist when the repo was created
+    rules_repo._git_dirs = (git_dir.as_posix(), git_dir.as_posix())
+    with patch("fedbadges.rulesrepo.subprocess.run") as run:
+        rules_repo.load_all(tahrir_client)
+        assert rules_repo._last_head == "1" * 40
+        assert not rules_repo._needs_update()
+        # A loose ref takes precedence over the packed one
+        _write_git_ref(git_dir, "refs/heads/main", "2" * 40)
+        assert rules_repo._needs_update()
+        rules_repo.load_all(tahrir_client)
+        assert not rules_repo._needs_update()
+    # Git was never run
+    run.assert_not_called()
+
+
+def test_rejected_reload(rules_repo, tmp_path, tahrir_client):
+    git_dir = tmp_path.joinpath("badges", ".git")
+    _write_git_ref(git_dir, "HEAD", "1" * 40)
+    rules_repo._git_dirs = (git_dir.as_posix(), git_dir.as_posix())
+    rules = rules_repo.load_all(tahrir_client)
+    assert len(rules) == 5
+
+    _write_git_ref(git_dir, "HEAD", "2" * 40)
+    tmp_path.joinpath("badges", "rules", "irc-speak-up.yml").unlink()
+    reloaded = rules_repo.load_all(tahrir_client, accept=False)
+    assert len(reloaded) == 4
+    # Not accepted (yet): the current rules are unchanged and the commit will be loaded again
+    assert rules_repo.rules is rules
+    assert rules_repo._last_head == "1" * 40
+    assert len(rules_repo._files) == 5
+    assert rules_repo._needs_update()
+
+    reloaded = rules_repo.load_all(tahrir_client, accept=False)
+    rules_repo.accept(reloaded)
+    assert rules_repo.rules is reloaded
+    assert rules_repo._last_head == "2" * 40
+    assert not rules_repo._needs_update()
+    # Only the last loaded rules can be accepted
+    with pytest.raises(ValueError):
+        rules_repo.accept(rules)
+
+
+def test_retry_registration(rules_repo, tmp_path, tahrir_client):
+    git_dir = tmp_path.joinpath("badges", ".git")
+    _write_git_ref(git_dir, "HEAD", "1" * 40)
+    rules_repo._git_dirs = (git_dir.as_posix(), git_dir.as_posix())
+    # Tahrir fails to register one of the badges
+    register_badges = fedbadges.rules.register_badges
+    with patch(
+        "fedbadges.rules.register_badges",
+        side_effect=lambda tahrir, rules: register_badges(tahrir, rules[1:]),
+    ):
+        rules = rules_repo.load_all(tahrir_client)
+    assert len(rules) == 4
+    # The repo has not changed, but the failed file is tried again
+    assert rules_repo._needs_update()
+    with patch.object(rules_repo, "_load_badge_from_yaml", wraps=rules_repo._load_badge_from_yaml):
+        rules = rules_repo.load_all(tahrir_client)
+        rules_repo._load_badge_from_yaml.assert_called_once()
+    assert len(rules) == 5
+    assert not rules_repo._needs_update()
+
+
+def test_find_git_dir_worktree(tmp_path):
+    common_dir = tmp_path.joinpath("repo.git")
+    git_dir = common_dir.joinpath("worktrees", "badges")
+    git_dir.mkdir(parents=True)
+    git_dir.joinpath("commondir").write_text("../..\n")
+    git_dir.joinpath("HEAD").write_text("ref: refs/heads/main\n")
+    _write_git_ref(common_dir, "refs/heads/main", "3" * 40)
+    worktree = tmp_path.joinpath("badges")
+    worktree.joinpath("rules").mkdir(parents=True)
+    worktree.joinpath(".git").write_text(f"gitdir: {git_dir.as_posix()}\n")
+
+    git_dirs = find_git_dir(worktree.joinpath("rules").as_posix())
+    assert git_dirs == (git_dir.as_posix(), common_dir.as_posix())
+    assert read_head_commit(*git_dirs) == "3" * 40
+
+
+def test_rules_cache(rules_repo, tmp_path, tahrir_client, fasjson_client):
+    rules_repo._cache_path = tmp_path.joinpath("rules.cache").as_posix()
+    rules = rules_repo.load_all(tahrir_client, force=True)
+    assert len(rules) == 5
+
+    # A new instance, as after a restart
+    restarted = RulesRepo(rules_repo.config, 1, fasjson_client)
+    restarted._cache_path = rules_repo._cache_path
+    with (
+        patch.object(restarted, "_load_badge_from_yaml") as load_badge_from_yaml,
+        patch("fedbadges.rules.register_badges", return_value=[]) as register_badges,
+    ):
+        cached_rules = restarted.load_all(tahrir_client, force=True)
+    # Nothing was parsed or registered
+    load_badge_from_yaml.assert_not_called()
+    register_badges.assert_called_once_with(tahrir_client, [])
+    assert {rule["name"]: rule.badge_id for rule in cached_rules} == {
+        rule["name"]: rule.badge_id for rule in rules
+    }
+
+    # The cache is not used by another issuer
+    other_issuer = RulesRepo(rules_repo.config, 2, fasjson_client)
+    other_issuer._cache_path = rules_repo._cache_path
+    assert other_issuer._read_cache() == {}
+
+
+def test_load_in_parallel(rules_repo, tahrir_client):
+    rules_repo.config["yaml_parallel_threshold"] = 2
+    with patch.object(rules_repo, "_load_badge_from_yaml") as load_badge_from_yaml:
+        rules = rules_repo.load_all(tahrir_client, force=True)
+    # The files were not parsed in this process
+    load_badge_from_yaml.assert_not_called()
+    assert {rule["name"] for rule in rules} == {
+        "Like a Rock",
+        "The Zen of Foo Bar Baz",
+        "Junior Tagger (Tagger I)",
+        "Speak Up!",
+        "Long Life to Pagure (Pagure I)",
+    }
@@ -1,6 +1,7 @@
 """ Utilities for tests """
 
 import datetime
+from unittest.mock import patch
 
 from bodhi.messages.schemas.update import UpdateRequestTestingV1
 
@@ -11,6 +12,14 @@ def get_rule(rules, name):
             return rule
 
 
+def patch_messages_count(value):
+    """Make every candidate have this messages count."""
+    return patch(
+        "fedbadges.rules.get_cached_messages_counts",
+        side_effect=lambda badge_id, candidates, *args: dict.fromkeys(candidates, value),
+    )
+
+
 class MockedDatanommerMessage:
     def __init__(self, message):
         self.msg_id = message.id